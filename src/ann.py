@@ -0,0 +1,230 @@
+from __future__ import print_function
+
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from utils import gVar, corpus_search
+
+
+def kmeans(x, n_clusters, n_iter=20, batch_size=65536, seed=42):
+    """
+    Lloyd's k-means on the rows of x.
+    :return: [n_clusters x dim] float32 centroids
+    """
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), n_clusters, replace=len(x) < n_clusters)].copy()
+    for _ in range(n_iter):
+        assign = assign_nearest(x, centroids, batch_size)
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed empty clusters with random points
+        centroids[empty] = x[rng.choice(len(x), empty.sum())]
+    return centroids
+
+
+def assign_nearest(x, centroids, batch_size=65536):
+    """index of the nearest (L2) centroid of every row of x"""
+    centroid_norms = (centroids ** 2).sum(1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), batch_size):
+        block = np.asarray(x[start: start + batch_size], dtype=np.float32)
+        assign[start: start + len(block)] = (centroid_norms[None, :] - 2 * block.dot(centroids.T)).argmin(1)
+    return assign
+
+
+def top_n(scores, n):
+    """indices of the n largest scores, best first"""
+    n = min(n, len(scores))
+    best = np.argpartition(-scores, n - 1)[:n]
+    return best[np.argsort(-scores[best])]
+
+
+class IVFPQIndex:
+    """
+    Inverted file index with product-quantized residuals for inner-product search over normalized code vectors.
+    A vector x in list l is stored as the codes of its residual x - coarse[l] in n_subvector sub-codebooks of
+    256 centroids, so that q.x ~ q.coarse[l] + sum_j q_j.pq[j, code_j] only needs table lookups (ADC).
+    """
+    def __init__(self, dim, n_list=1024, n_subvector=50):
+        assert dim % n_subvector == 0, "dim %d is not a multiple of n_subvector %d" % (dim, n_subvector)
+        self.dim = dim
+        self.n_list = n_list
+        self.n_subvector = n_subvector
+        self.sub_dim = dim // n_subvector
+        self.coarse = None  # [n_list x dim]
+        self.pq = None  # [n_subvector x 256 x sub_dim]
+        self.codes = np.zeros((0, n_subvector), dtype=np.uint8)
+        self.lists = np.zeros(0, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self._order, self._offsets = None, None
+
+    def train(self, x, n_iter=20, seed=42):
+        x = np.asarray(x, dtype=np.float32)
+        self.coarse = kmeans(x, self.n_list, n_iter=n_iter, seed=seed)
+        residuals = x - self.coarse[assign_nearest(x, self.coarse)]
+        self.pq = np.stack([kmeans(residuals[:, j * self.sub_dim: (j + 1) * self.sub_dim], 256, n_iter=n_iter,
+                                   seed=seed + j) for j in range(self.n_subvector)])
+        return self
+
+    def encode(self, x):
+        """coarse lists and PQ codes of the rows of x"""
+        x = np.asarray(x, dtype=np.float32)
+        lists = assign_nearest(x, self.coarse)
+        residuals = x - self.coarse[lists]
+        codes = np.stack([assign_nearest(residuals[:, j * self.sub_dim: (j + 1) * self.sub_dim], self.pq[j])
+                          for j in range(self.n_subvector)], axis=1).astype(np.uint8)
+        return lists, codes
+
+    def add(self, x, ids=None, batch_size=65536):
+        """add vectors (default ids: their insertion order)"""
+        if ids is None:
+            ids = np.arange(len(self.ids), len(self.ids) + len(x))
+        for start in range(0, len(x), batch_size):
+            lists, codes = self.encode(x[start: start + batch_size])
+            self.lists = np.concatenate([self.lists, lists])
+            self.codes = np.concatenate([self.codes, codes])
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self._order = None
+        return self
+
+    def _inverted_lists(self):
+        if self._order is None:
+            self._order = np.argsort(self.lists, kind="stable")
+            self._offsets = np.concatenate([[0], np.cumsum(np.bincount(self.lists, minlength=self.n_list))])
+        return self._order, self._offsets
+
+    def search(self, queries, k, nprobe=8, refine_repr=None, refine_factor=4):
+        """
+        Approximate top-k inner-product search, scanning the nprobe closest lists of every query.
+        With refine_repr (the exact vectors, indexed by id, e.g. the memory-mapped embeddings), the
+        refine_factor * k best ADC candidates are re-scored exactly.
+        :return: scores and ids [n_query x k], padded with -inf and -1
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        order, offsets = self._inverted_lists()
+        coarse_scores = queries.dot(self.coarse.T)
+        probes = np.argsort(-coarse_scores, axis=1)[:, :nprobe]
+        # lookup tables: [n_query x n_subvector x 256]
+        tables = np.einsum("qjd,jcd->qjc", queries.reshape(len(queries), self.n_subvector, self.sub_dim), self.pq)
+        n_candidate = k if refine_repr is None else k * refine_factor
+
+        topk_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        topk_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        sub_index = np.arange(self.n_subvector)
+        for i, probe in enumerate(probes):
+            rows = np.concatenate([order[offsets[l]: offsets[l + 1]] for l in probe])
+            if len(rows) == 0:
+                continue
+            scores = coarse_scores[i, self.lists[rows]] + tables[i][sub_index, self.codes[rows]].sum(1)
+            best = top_n(scores, n_candidate)
+            scores, ids = scores[best], self.ids[rows[best]]
+            if refine_repr is not None:
+                rows = np.sort(ids)
+                scores, ids = np.asarray(refine_repr[rows], dtype=np.float32).dot(queries[i]), rows
+                best = top_n(scores, k)
+                scores, ids = scores[best], ids[best]
+            topk_scores[i, :len(ids)] = scores
+            topk_ids[i, :len(ids)] = ids
+        return topk_scores, topk_ids
+
+    def save(self, path):
+        np.savez(path, dim=self.dim, n_list=self.n_list, n_subvector=self.n_subvector, coarse=self.coarse,
+                 pq=self.pq, codes=self.codes, lists=self.lists, ids=self.ids)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(int(data["dim"]), n_list=int(data["n_list"]), n_subvector=int(data["n_subvector"]))
+        index.coarse, index.pq = data["coarse"], data["pq"]
+        index.codes, index.lists, index.ids = data["codes"], data["lists"], data["ids"]
+        return index
+
+
+##########
+# Report #
+##########
+def recall_latency_report(index, queries_repr, corpus_repr, k=10, nprobes=(1, 2, 4, 8, 16, 32, 64),
+                          refine_factor=0):
+    """
+    Compares IVF-PQ search with exact search: recall@k is the fraction of the exact top-k found by the index.
+    With refine_factor > 0, the ADC candidates are re-scored with the exact vectors of corpus_repr.
+    """
+    start = time.time()
+    _, exact_ids = corpus_search(torch.from_numpy(queries_repr), corpus_repr, k)
+    exact_ms = (time.time() - start) * 1000.0 / len(queries_repr)
+    exact_ids = exact_ids.numpy()
+    print("exact: %.3f ms/query" % exact_ms)
+
+    report = []
+    for nprobe in nprobes:
+        if nprobe > index.n_list:
+            break
+        start = time.time()
+        if refine_factor > 0:
+            _, ann_ids = index.search(queries_repr, k, nprobe=nprobe, refine_repr=corpus_repr,
+                                      refine_factor=refine_factor)
+        else:
+            _, ann_ids = index.search(queries_repr, k, nprobe=nprobe)
+        ann_ms = (time.time() - start) * 1000.0 / len(queries_repr)
+        recall = np.mean([len(np.intersect1d(a, e)) / float(k) for a, e in zip(ann_ids, exact_ids)])
+        print("nprobe=%-3d recall@%d=%.4f  %.3f ms/query" % (nprobe, k, recall, ann_ms))
+        report.append((nprobe, recall, ann_ms))
+    return exact_ms, report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("IVF-PQ approximate index over the code embeddings of build_index.py.")
+    parser.add_argument("mode", choices=["build", "report"])
+    parser.add_argument("--index_dir", type=str, required=True, help="Index written by build_index.py.")
+    parser.add_argument("--ann_path", type=str, default="", help="IVF-PQ file (default: <index_dir>/ivfpq.npz).")
+    parser.add_argument("--n_list", type=int, default=1024, help="Number of coarse k-means lists.")
+    parser.add_argument("--n_subvector", type=int, default=50, help="Number of PQ sub-vectors (bytes per code).")
+    parser.add_argument("--n_train", type=int, default=100000, help="Number of vectors used to train.")
+    parser.add_argument("--k", type=int, default=10, help="Number of results for the report.")
+    parser.add_argument("--refine_factor", type=int, default=0,
+                        help="If > 0, re-score refine_factor * k ADC candidates with the exact vectors.")
+    parser.add_argument("--lang", type=str, default="Python", help="Dataset of the report queries.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from serve import SearchEngine
+
+    args = parse_args()
+    ann_path = args.ann_path or os.path.join(args.index_dir, "ivfpq.npz")
+    engine = SearchEngine(args.index_dir)
+    corpus_repr = engine.embeddings
+
+    if args.mode == "build":
+        sample = np.random.RandomState(42).choice(len(corpus_repr), min(args.n_train, len(corpus_repr)),
+                                                  replace=False)
+        print("Training IVF-PQ (%d lists, %d bytes/code) on %d vectors..." %
+              (args.n_list, args.n_subvector, len(sample)))
+        index = IVFPQIndex(corpus_repr.shape[1], n_list=args.n_list, n_subvector=args.n_subvector)
+        index.train(corpus_repr[np.sort(sample)])
+        index.add(corpus_repr)
+        index.save(ann_path)
+        print("Saved to %s" % ann_path)
+    else:
+        from data import load_qc_data, my_collate
+
+        index = IVFPQIndex.load(ann_path)
+        dataset = load_qc_data(test=True, lang=args.lang)["test"]
+        data_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=1024, shuffle=False,
+                                                  drop_last=False, num_workers=1, collate_fn=my_collate)
+        queries_repr = []
+        with torch.no_grad():
+            for batch in data_loader:
+                qts_repr = engine.model.query_encoding(gVar(batch["query"]))
+                queries_repr.append((qts_repr / qts_repr.norm(dim=1)[:, None]).cpu().numpy())
+        print("%d test queries, corpus of %d code snippets" % (sum(map(len, queries_repr)), len(corpus_repr)))
+        recall_latency_report(index, np.concatenate(queries_repr), corpus_repr, k=args.k,
+                              refine_factor=args.refine_factor)
@@ -0,0 +1,149 @@
+from __future__ import print_function
+
+import copy
+import time
+import traceback
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+import torch
+import torch.multiprocessing as mp
+
+
+class EvalCall:
+    """picklable evaluate(model) closure over an evaluation function and its other arguments"""
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self, model):
+        return self.fn(model, *self.args, **self.kwargs)
+
+
+class Snapshot:
+    """frozen copy of the weights of a model, which can stand in for the model when saving it"""
+    def __init__(self, model):
+        self.state = dict((k, v.detach().cpu().clone()) for k, v in model.state_dict().items())
+
+    def state_dict(self):
+        return self.state
+
+
+def _apply(fn, model):
+    """fn applied to a model, or to every model of a dict of models, where some may be None"""
+    if isinstance(model, dict):
+        return dict((k, fn(v) if v is not None else None) for k, v in model.items())
+    return fn(model)
+
+
+def snapshot(model):
+    return _apply(Snapshot, model)
+
+
+def load_snapshot(model, snap):
+    if isinstance(model, dict):
+        for k, v in model.items():
+            if v is not None:
+                v.load_state_dict(snap[k].state_dict())
+    else:
+        model.load_state_dict(snap.state_dict())
+    return model
+
+
+def _worker(model, evaluate, requests, results, start_method):
+    # the data loaders of evaluate start their workers like in the training process, not by spawn
+    mp.set_start_method(start_method, force=True)
+    if torch.cuda.is_available():
+        model = _apply(lambda m: m.cuda(), model)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        epoch, snap = request
+        try:
+            results.put((epoch, evaluate(load_snapshot(model, snap)), None))
+        except Exception:
+            results.put((epoch, None, traceback.format_exc()))
+
+
+class SyncValidator:
+    """Evaluates each submitted model right away, in the training process."""
+    def __init__(self, model, evaluate):
+        self.evaluate = evaluate
+        self.done = []
+
+    def submit(self, epoch, model):
+        self.done.append((epoch, model, self.evaluate(model)))
+
+    def results(self, wait=False):
+        done, self.done = self.done, []
+        return done
+
+    def close(self):
+        pass
+
+
+class AsyncValidator:
+    """
+    Evaluates weight snapshots in a worker process while training goes on.
+    submit() hands over a copy of the current weights and returns immediately; results() returns the
+    (epoch, snapshot, evaluation result) of every finished evaluation, in submission order. Snapshots are kept until
+    their result is back, so that the evaluated weights, not the current ones, are saved. At most max_pending
+    evaluations are in flight; submitting more waits for the oldest one.
+    """
+    def __init__(self, model, evaluate, max_pending=2):
+        ctx = mp.get_context("spawn")  # safe with CUDA, unlike fork
+        self.requests, self.responses = ctx.Queue(), ctx.Queue()
+        template = _apply(lambda m: copy.deepcopy(m).cpu(), model)
+        self.process = ctx.Process(target=_worker, args=(template, evaluate, self.requests, self.responses,
+                                                                 mp.get_start_method()))
+        self.process.start()
+        self.max_pending = max_pending
+        self.pending = []  # [(epoch, snapshot, submit time)]
+        self.done = []
+
+    def submit(self, epoch, model):
+        while len(self.pending) >= self.max_pending:
+            self._receive(block=True)
+        snap = snapshot(model)
+        self.requests.put((epoch, snap))
+        self.pending.append((epoch, snap, time.time()))
+
+    def _receive(self, block):
+        """moves the oldest evaluation to done, False if it is not finished and block is not set"""
+        while True:
+            try:
+                epoch, result, error = self.responses.get(timeout=1.0 if block else None, block=block)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("Validation worker died with exit code %s" % self.process.exitcode)
+                if not block:
+                    return False
+        if error is not None:
+            raise RuntimeError("Validation of epoch %d failed:\n%s" % (epoch, error))
+        _, snap, start = self.pending.pop(0)
+        print("Validation of epoch %d done in %.1fs" % (epoch, time.time() - start))
+        self.done.append((epoch, snap, result))
+        return True
+
+    def results(self, wait=False):
+        """finished evaluations; with wait, blocks until every submitted evaluation is finished"""
+        while self.pending and self._receive(block=wait):
+            pass
+        done, self.done = self.done, []
+        return done
+
+    def close(self):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+def make_validator(model, evaluate, async_valid=False):
+    return AsyncValidator(model, evaluate) if async_valid else SyncValidator(model, evaluate)
@@ -0,0 +1,152 @@
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import torch
+
+# batch fields holding padded token ids
+TOKEN_FIELDS = ("query", "pos", "neg", "neg_query", "qts", "adv_neg")
+
+
+def sequence_lengths(dataset, field="pos"):
+    """number of non-padding tokens of a field of every item of a dataset"""
+    return np.array([np.count_nonzero(np.asarray(dataset[i][field])) for i in range(len(dataset))])
+
+
+class EpochBatchSampler(torch.utils.data.Sampler):
+    """
+    Base of the training batch samplers. The batches of an epoch are drawn from a RandomState seeded with
+    (seed, epoch), so that set_epoch(epoch, skip) replays an epoch without its first skip batches, to resume training
+    in the middle of it. The epoch goes up by one after every full pass.
+    generator, given to the DataLoader, is reseeded from (seed, epoch) as well: the DataLoader draws the base seed of
+    its workers from it, so the random state of the dataset in the workers is the same for an epoch after a resume.
+    Within an epoch resumed in the middle, it only matches for datasets that don't use it.
+    """
+    def __init__(self, batch_size, drop_last=False, seed=42):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.generator = torch.Generator()
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch, skip=0):
+        self.epoch, self.skip = epoch, skip
+        self.generator.manual_seed(int(np.random.RandomState([self.seed, epoch, 1]).randint(2 ** 31)))
+
+    def batches(self, rng):
+        """the item indices of every batch of an epoch"""
+        raise NotImplementedError
+
+    def __iter__(self):
+        batches = self.batches(np.random.RandomState([self.seed, self.epoch]))
+        for batch in batches[self.skip:]:
+            yield batch.tolist()
+        self.set_epoch(self.epoch + 1)
+
+
+class ShuffleBatchSampler(EpochBatchSampler):
+    """batches of shuffled items"""
+    def __init__(self, n_items, batch_size, drop_last=False, seed=42):
+        super(ShuffleBatchSampler, self).__init__(batch_size, drop_last=drop_last, seed=seed)
+        self.n_items = n_items
+
+    def batches(self, rng):
+        order = rng.permutation(self.n_items)
+        batches = [order[i: i + self.batch_size] for i in range(0, self.n_items, self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        return batches
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_items // self.batch_size
+        return (self.n_items + self.batch_size - 1) // self.batch_size
+
+
+class BucketBatchSampler(EpochBatchSampler):
+    """
+    Batches items of similar lengths together: every epoch, the shuffled items are split into buckets of
+    bucket_size items, each bucket is sorted by length and cut into batches, and the batches of all buckets
+    are shuffled.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=None, drop_last=False, seed=42):
+        super(BucketBatchSampler, self).__init__(batch_size, drop_last=drop_last, seed=seed)
+        self.lengths = np.asarray(lengths)
+        self.bucket_size = bucket_size or 100 * batch_size
+
+    def batches(self, rng):
+        order = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start: start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches.extend(bucket[i: i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __len__(self):
+        sizes = [min(self.bucket_size, len(self.lengths) - start)
+                 for start in range(0, len(self.lengths), self.bucket_size)]
+        if self.drop_last:
+            return sum(size // self.batch_size for size in sizes)
+        return sum((size + self.batch_size - 1) // self.batch_size for size in sizes)
+
+
+class TrimCollate:
+    """wraps a collate function and cuts the trailing all-padding positions of the token fields of each batch"""
+    def __init__(self, collate_fn, fields=TOKEN_FIELDS):
+        self.collate_fn = collate_fn
+        self.fields = fields
+
+    def __call__(self, items):
+        batch = self.collate_fn(items)
+        for field in self.fields:
+            tokens = batch.get(field)
+            if not isinstance(tokens, torch.Tensor) or tokens.dim() < 2:
+                continue
+            used = tokens.ne(0).reshape(-1, tokens.size(-1)).any(0).nonzero()
+            length = int(used.max()) + 1 if len(used) else 1
+            batch[field] = tokens[..., :length].contiguous()
+        return batch
+
+
+def make_train_loader(dataset, batch_size, collate_fn, bucket=False, drop_last=False, length_field="pos"):
+    """
+    shuffled training DataLoader; with bucket, batches are made of similar lengths and trimmed.
+    Its batch_sampler is an EpochBatchSampler, whose generator gives the worker seeds, so that creating an iterator
+    leaves the global torch RNG alone and the workers of an epoch are seeded the same after a resume.
+    """
+    if not bucket:
+        sampler = ShuffleBatchSampler(len(dataset), batch_size, drop_last=drop_last)
+    else:
+        sampler = BucketBatchSampler(sequence_lengths(dataset, length_field), batch_size, drop_last=drop_last)
+        collate_fn = TrimCollate(collate_fn)
+    return torch.utils.data.DataLoader(dataset=dataset, batch_sampler=sampler, num_workers=1, collate_fn=collate_fn,
+                                       generator=sampler.generator)
+
+
+class TokenMeter:
+    """training throughput: non-padding tokens per second and share of padding in the token fields"""
+    def __init__(self, fields=TOKEN_FIELDS):
+        self.fields = fields
+        self.reset()
+
+    def reset(self):
+        self.tokens, self.slots = 0, 0
+        self.start = time.time()
+
+    def update(self, batch):
+        for field in self.fields:
+            tokens = batch.get(field)
+            if isinstance(tokens, torch.Tensor) and tokens.dim() >= 2:
+                self.tokens += int(tokens.ne(0).sum())
+                self.slots += tokens.numel()
+
+    def report(self):
+        """'tok/s=... pad=...%' since the last report"""
+        elapsed = max(time.time() - self.start, 1e-9)
+        string = 'tok/s=%.0f  pad=%.0f%%' % (self.tokens / elapsed, 100.0 * (1 - self.tokens / max(self.slots, 1.0)))
+        self.reset()
+        return string
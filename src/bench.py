@@ -0,0 +1,179 @@
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from configs import get_config
+from batching import make_train_loader, TokenMeter
+from sparseopt import SparseDenseOptimizer, dense_parameters, with_sparse_adam
+import models
+
+
+def timeit(fn, n_iter=20, n_warmup=3):
+    """average seconds per call of fn"""
+    for _ in range(n_warmup):
+        fn()
+    start = time.time()
+    for _ in range(n_iter):
+        fn()
+    return (time.time() - start) / n_iter
+
+
+def random_batch(batch_size, seq_len, n_words, mean_len, rng, bucketed=False):
+    """
+    padded token ids with log-normally distributed lengths, like our code snippets and questions;
+    bucketed: a batch of similar lengths, taken from the middle of a sorted sample of 20 batches
+    """
+    lengths = np.clip(rng.lognormal(np.log(mean_len), 0.6, batch_size * 20).astype(int), 1, seq_len)
+    if bucketed:
+        lengths = np.sort(lengths)[batch_size * 10: batch_size * 11]
+    else:
+        lengths = lengths[:batch_size]
+    batch = np.zeros((batch_size, seq_len), dtype=np.int64)
+    for i, length in enumerate(lengths):
+        batch[i, :length] = rng.randint(2, n_words, length)
+    return torch.from_numpy(batch)
+
+
+def bench_seqenc(conf, batch, n_iter):
+    """ms per batch of a SeqEncoder in inference and training, padded vs packed"""
+    results = {}
+    for packed in [False, True]:
+        conf['seqenc_packed'] = packed
+        torch.manual_seed(42)
+        encoder = models.SeqEncoder(conf['code_n_words'], conf['emb_size'], conf['lstm_dims'], conf)
+        optimizer = torch.optim.SGD(encoder.parameters(), lr=0.0)
+
+        def inference():
+            with torch.no_grad():
+                encoder(batch)
+
+        def train_step():
+            optimizer.zero_grad()
+            encoder(batch).sum().backward()
+            optimizer.step()
+
+        encoder.eval()
+        results[(packed, "inference")] = timeit(inference, n_iter) * 1000
+        encoder.train()
+        results[(packed, "train")] = timeit(train_step, n_iter) * 1000
+    return results
+
+
+def collate_pos(items):
+    return {"pos": torch.from_numpy(np.stack([item["pos"] for item in items]))}
+
+
+def bench_bucket(conf, batch_size, mean_len, n_batches, rng):
+    """tokens/sec of SeqEncoder training steps on shuffled batches vs length-bucketed, trimmed batches"""
+    dataset = [{"pos": tokens} for tokens in random_batch(batch_size * 200, conf['code_len'], conf['code_n_words'],
+                                                          mean_len, rng).numpy()]
+    results = {}
+    for bucket in [False, True]:
+        torch.manual_seed(42)
+        encoder = models.SeqEncoder(conf['code_n_words'], conf['emb_size'], conf['lstm_dims'], conf)
+        optimizer = torch.optim.SGD(encoder.parameters(), lr=0.0)
+        loader = make_train_loader(dataset, batch_size, collate_pos, bucket=bucket)
+        meter = TokenMeter()
+        for itr, batch in enumerate(loader):
+            if itr == n_batches:
+                break
+            optimizer.zero_grad()
+            encoder(batch["pos"]).sum().backward()
+            optimizer.step()
+            meter.update(batch)
+        results[bucket] = meter.report()
+    return results
+
+
+def tensor_mb(tensors):
+    """MB held by some (dense or sparse) tensors"""
+    n_bytes = 0
+    for t in tensors:
+        parts = [t.coalesce().indices(), t.coalesce().values()] if t.is_sparse else [t]
+        n_bytes += sum(part.nelement() * part.element_size() for part in parts)
+    return n_bytes / float(1 << 20)
+
+
+def bench_sparse(conf, qts, codes, n_iter):
+    """QCModel training with Adam: ms per step and MB of gradients and optimizer state, dense vs sparse embeddings"""
+    results = {}
+    for sparse in [False, True]:
+        conf['sparse_emb'] = sparse
+        torch.manual_seed(42)
+        model = models.QCModel(conf)
+        optimizer = with_sparse_adam(torch.optim.Adam(dense_parameters(model), lr=0.001), model)
+
+        def backward():
+            optimizer.zero_grad()
+            model.scoring(model.query_encoding(qts), model.cand_encoding(codes)).sum().backward()
+
+        def train_step():
+            backward()
+            optimizer.step()
+
+        results[(sparse, "train ms")] = timeit(train_step, n_iter) * 1000
+        backward()
+        results[(sparse, "optimizer step ms")] = timeit(optimizer.step, n_iter) * 1000
+        optimizers = [optimizer.dense, optimizer.sparse] if isinstance(optimizer, SparseDenseOptimizer) else [optimizer]
+        results[(sparse, "grad MB")] = tensor_mb(p.grad for p in model.parameters() if p.grad is not None)
+        results[(sparse, "optimizer state MB")] = tensor_mb(v for o in optimizers for state in o.state.values()
+                                                            for v in state.values() if torch.is_tensor(v) and v.dim())
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("CPU micro-benchmarks of the encoders.")
+    parser.add_argument("bench", choices=["seqenc", "bucket", "sparse"])
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--emb_size", type=int, default=200)
+    parser.add_argument("--lstm_dims", type=int, default=400)
+    parser.add_argument("--mean_len", type=float, default=40.0, help="Mean number of non-padding tokens.")
+    parser.add_argument("--bucketed", type=int, default=0, help="Bench a batch of similar lengths if bucketed>0.")
+    parser.add_argument("--n_iter", type=int, default=10)
+    parser.add_argument("--seqenc_packed", type=int, default=1, help="Length-aware SeqEncoder in the bucket bench.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads (0: torch default).")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    conf = get_config(args)
+    conf['emb_size'] = args.emb_size
+    conf['lstm_dims'] = args.lstm_dims
+
+    rng = np.random.RandomState(42)
+    if args.bench == "bucket":
+        conf['seqenc_packed'] = args.seqenc_packed > 0
+        results = bench_bucket(conf, args.batch_size, args.mean_len, args.n_iter, rng)
+        print("SeqEncoder training, %d batches of %d, %d threads, seqenc_packed=%s" %
+              (args.n_iter, args.batch_size, torch.get_num_threads(), conf['seqenc_packed']))
+        print("shuffled: %s" % results[False])
+        print("bucketed: %s" % results[True])
+    elif args.bench == "sparse":
+        qts = random_batch(args.batch_size, conf['qt_len'], conf['qt_n_words'], 9.0, rng)
+        codes = random_batch(args.batch_size, conf['code_len'], conf['code_n_words'], args.mean_len, rng)
+        print("QCModel training, batch %d, vocab %d/%d, %d distinct code tokens, %d threads" %
+              (args.batch_size, conf['qt_n_words'], conf['code_n_words'], len(codes.unique()), torch.get_num_threads()))
+        results = bench_sparse(conf, qts, codes, args.n_iter)
+        for key in ["train ms", "optimizer step ms", "grad MB", "optimizer state MB"]:
+            print("%-18s dense %8.1f  sparse %8.1f  ratio %.2f" %
+                  (key, results[(False, key)], results[(True, key)], results[(True, key)] / results[(False, key)]))
+    else:
+        batch = random_batch(args.batch_size, conf['code_len'], conf['code_n_words'], args.mean_len, rng,
+                             bucketed=args.bucketed > 0)
+        print("SeqEncoder, batch %d x %d, %.1f non-padding tokens on average (max %d), %d threads" %
+              (args.batch_size, conf['code_len'], batch.ne(0).sum(1).float().mean(), batch.ne(0).sum(1).max(),
+               torch.get_num_threads()))
+        results = bench_seqenc(conf, batch, args.n_iter)
+        for mode in ["inference", "train"]:
+            print("%-9s padded %8.1f ms  packed %8.1f ms  speedup %.2fx" %
+                  (mode, results[(False, mode)], results[(True, mode)], results[(False, mode)] / results[(True, mode)]))
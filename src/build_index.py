@@ -0,0 +1,148 @@
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+
+from configs import get_config
+
+EMBEDDING_FILE = "embeddings.npy"
+ID_MAP_FILE = "ids.json"
+MANIFEST_FILE = "manifest.json"
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def build_index(searcher, model, datasets, index_dir, ckpt_path, batch_size=1024):
+    """
+    Encodes the code corpus of some datasets once and writes it to index_dir:
+    embeddings.npy: [n_snippet x dim] float32 L2-normalized code vectors, to be memory-mapped;
+    ids.json: snippet id -> row of embeddings.npy;
+    manifest.json: checkpoint hash and model config the embeddings were computed with.
+    """
+    from codesearcher import create_model_name_string
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    snippets, snippet_ids, _ = searcher.collect_code_corpus(datasets, batch_size=batch_size)
+    print("Encoding %d distinct code snippets..." % len(snippet_ids))
+
+    # both code encoders output 2 * lstm_dims features
+    dim = 2 * searcher.conf['lstm_dims']
+    embeddings = np.lib.format.open_memmap(os.path.join(index_dir, EMBEDDING_FILE), mode="w+",
+                                           dtype=np.float32, shape=(len(snippet_ids), dim))
+    searcher.encode_corpus(model, snippets, batch_size=batch_size, out=embeddings)
+    embeddings.flush()
+    del embeddings
+
+    with open(os.path.join(index_dir, ID_MAP_FILE), "w") as f:
+        json.dump(dict((snippet_id, row) for row, snippet_id in enumerate(snippet_ids)), f)
+
+    manifest = {
+        "checkpoint": os.path.abspath(ckpt_path),
+        "checkpoint_sha1": file_sha1(ckpt_path),
+        "model_string": create_model_name_string(searcher.conf),
+        "config": dict((key, searcher.conf[key]) for key in
+                       ["qt_len", "code_len", "qt_n_words", "code_n_words", "compact_vocab", "emb_size", "lstm_dims",
+                        "code_encoder", "seqenc_packed", "lang"]),
+        "datasets": [dataset.data_name for dataset in datasets],
+        "size": len(snippet_ids),
+        "dim": dim,
+    }
+    with open(os.path.join(index_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print("Index saved to %s" % index_dir)
+    return manifest
+
+
+def load_index(index_dir, mmap_mode="r"):
+    """
+    Loads an index written by build_index.
+    :return: embeddings (memory-mapped by default), row -> snippet id list, manifest
+    """
+    embeddings = np.load(os.path.join(index_dir, EMBEDDING_FILE), mmap_mode=mmap_mode)
+    with open(os.path.join(index_dir, ID_MAP_FILE)) as f:
+        id_map = json.load(f)
+    snippet_ids = [None] * len(id_map)
+    for snippet_id, row in id_map.items():
+        snippet_ids[row] = snippet_id
+    with open(os.path.join(index_dir, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    assert embeddings.shape == (manifest["size"], manifest["dim"]), "Index files do not match the manifest"
+    return embeddings, snippet_ids, manifest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Build the code embedding index of a trained QC model.")
+    parser.add_argument("--reload_path", type=str, required=True,
+                        help="Enclosing folder of the QC model, e.g. ../checkpoint_qcwqq/QC.")
+    parser.add_argument("--index_dir", type=str, default="",
+                        help="Where to write the index (default: <model directory>/index).")
+    parser.add_argument("--splits", type=str, default="train,dev,test", help="Data splits making up the corpus.")
+    parser.add_argument("--encode_batch_size", type=int, default=1024, help="Snippets encoded at once.")
+
+    # model setup, to find the model directory as codesearcher.py names it
+    parser.add_argument("--dropout", type=float, default=0.0, help="What is the dropout?", required=True)
+    parser.add_argument("--emb_size", type=int, default=100, help="What is the embedding size?", required=True)
+    parser.add_argument("--lstm_dims", type=int, default=200, help="What is the lstm dimension?", required=True)
+    parser.add_argument("--seqenc_packed", type=int, default=0,
+                        help="Run the sequence encoders on packed sequences, skipping padding, if seqenc_packed>0.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--batch_size", type=int, default=32, help="What is the batch size?", required=True)
+    parser.add_argument("--lr", type=float, default=0.001, help="What is the learning rate?")
+    parser.add_argument("--optimizer", type=str,
+                        choices=["adam", "adagrad", "sgd", "rmsprop", "asgd", "adadelta"],
+                        default="adam", help="Which optimizer to use?")
+    parser.add_argument("--lang", type=str, default="SQL", help="Which language dataset to use.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    # the data and training modules are only needed to build an index, not to load one (see serve.py)
+    from data import load_qc_data
+    from models import QCModel
+    from codesearcher import CodeSearcher, create_model_name_string
+
+    args = parse_args()
+    conf = get_config(args)
+
+    conf['model'] = "qc"
+    conf['bow_dropout'] = args.dropout
+    conf['seqenc_dropout'] = args.dropout
+    conf['seqenc_packed'] = args.seqenc_packed > 0
+    conf['emb_size'] = args.emb_size
+    conf['lstm_dims'] = args.lstm_dims
+    conf['batch_size'] = args.batch_size
+    conf['lr'] = args.lr
+    conf['optimizer'] = args.optimizer
+    conf['lang'] = args.lang
+
+    conf['model_directory'] = os.path.join(args.reload_path, create_model_name_string(conf))
+    index_dir = args.index_dir or os.path.join(conf['model_directory'], "index")
+    print(" Model Directory : ")
+    print(conf['model_directory'])
+
+    searcher = CodeSearcher(conf)
+    model = QCModel(conf)
+    searcher.load_model(model)
+    if torch.cuda.is_available():
+        print('using GPU')
+        model = model.cuda()
+    else:
+        print('using CPU')
+
+    data = load_qc_data(test=True, lang=args.lang)
+    build_index(searcher, model, [data[split] for split in args.splits.split(",")], index_dir,
+                os.path.join(conf['model_directory'], 'best_model.ckpt'), batch_size=args.encode_batch_size)
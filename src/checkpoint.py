@@ -0,0 +1,201 @@
+from __future__ import print_function
+
+import os
+import re
+import glob
+import random
+import threading
+
+import numpy as np
+import torch
+
+CKPT_PATTERN = "ckpt_e%05d_i%08d.pt"
+CKPT_REGEX = re.compile(r"ckpt_e(\d+)_i(\d+)\.pt$")
+
+
+def cpu_copy(obj):
+    """copy of nested dicts/lists of tensors (state dicts) with every tensor cloned to the cpu"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return dict((k, cpu_copy(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+
+def state_dicts(obj):
+    """state dict of a model or optimizer, or {key: state dict} of a dict of them, where some may be None"""
+    if isinstance(obj, dict):
+        return dict((k, v.state_dict()) for k, v in obj.items() if v is not None)
+    return obj.state_dict()
+
+
+def load_state_dicts(obj, state):
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if v is not None and k in state:
+                v.load_state_dict(state[k])
+    else:
+        obj.load_state_dict(state)
+
+
+def queue_states(model):
+    """state of the negative queue (models.NegativeQueue) of a model, or {key: state} of a dict of models"""
+    if isinstance(model, dict):
+        return dict((k, queue_states(v)) for k, v in model.items() if v is not None)
+    queue = getattr(model, "neg_queue", None)
+    return queue.state_dict() if queue is not None else None
+
+
+def load_queue_states(model, state):
+    if isinstance(model, dict):
+        for k, v in model.items():
+            if v is not None and k in state:
+                load_queue_states(v, state[k])
+    elif getattr(model, "neg_queue", None) is not None and state is not None:
+        model.neg_queue.load_state_dict(state, device=next(model.parameters()).device)
+
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_checkpoint(path):
+    try:
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location="cpu")
+
+
+def save_state_dict(state_dict, path):
+    """
+    torch.save into a temporary file renamed into place: processes that mapped the previous file (see load_weights)
+    keep reading it instead of crashing on a truncated mapping.
+    """
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    torch.save(state_dict, tmp_path)
+    os.rename(tmp_path, path)
+
+
+def load_state_dict_file(path, mmap=True):
+    """
+    State dict of a file written by torch.save, on the cpu. With mmap, the tensors are views of the file mapped copy
+    on write instead of being read into memory: the OS reads only the pages used and shares them between all the
+    processes that map the same file. Falls back to a full read on torch < 2.1 or for legacy (pre zip) files.
+    """
+    if mmap:
+        try:
+            return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        except (TypeError, RuntimeError):
+            pass
+    return torch.load(path, map_location="cpu")
+
+
+def load_weights(model, path, mmap=True, transform=None):
+    """
+    Loads a state dict file into a model. When mmap is set and the model is on the cpu, the parameters are replaced
+    by the mapped tensors (see load_state_dict_file) rather than copied into, so that the weights stay shared with
+    the page cache until they are written to.
+    :param transform: function applied to the state dict before it is loaded
+    """
+    state_dict = load_state_dict_file(path, mmap)
+    assign = mmap and transform is None and all(t.device.type == "cpu" for t in model.state_dict().values())
+    if transform is not None:  # may tie tensors (e.g. init_qq_with_qc), which must be copied, not assigned
+        state_dict = transform(state_dict)
+    try:
+        model.load_state_dict(state_dict, assign=assign)
+    except TypeError:  # torch < 2.1
+        model.load_state_dict(state_dict)
+
+
+class Checkpointer:
+    """
+    Full training state checkpoints: model(s), optimizer(s), negative queue(s), position in the training data, RNG
+    states and any extra loop state (e.g. best MRR and patience), enough to resume training exactly where it stopped.
+
+    save() copies the state to the cpu right away and writes it from a background thread, into a temporary file
+    renamed into place, so that a preempted run never leaves a partial checkpoint. Only the last keep checkpoints
+    are kept.
+    """
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        self.thread = None
+        self.error = None
+
+    def checkpoints(self):
+        """paths of the checkpoints of the directory, oldest first"""
+        paths = [p for p in glob.glob(os.path.join(self.directory, "ckpt_e*_i*.pt")) if CKPT_REGEX.search(p)]
+        return sorted(paths, key=lambda p: tuple(int(x) for x in CKPT_REGEX.search(p).groups()))
+
+    def latest(self):
+        paths = self.checkpoints()
+        return paths[-1] if paths else None
+
+    def save(self, epoch, itr, model, optimizer, **extra):
+        """
+        :param epoch: epoch to resume at
+        :param itr: number of batches of that epoch already trained
+        :param extra: other picklable loop state, given back by restore
+        """
+        self.wait()
+        state = {"epoch": epoch, "itr": itr, "model": cpu_copy(state_dicts(model)),
+                 "optimizer": cpu_copy(state_dicts(optimizer)), "queues": cpu_copy(queue_states(model)),
+                 "rng": rng_state(), "extra": cpu_copy(extra)}
+        path = os.path.join(self.directory, CKPT_PATTERN % (epoch, itr))
+        self.thread = threading.Thread(target=self._write, args=(state, path))
+        self.thread.start()
+
+    def _write(self, state, path):
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            tmp_path = "%s.tmp%d" % (path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+            for old in self.checkpoints()[:-self.keep]:
+                os.remove(old)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """waits for the last save to be written"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Checkpoint write failed: %s" % error)
+
+    def restore(self, model, optimizer, path=None):
+        """
+        loads the latest (or given) checkpoint into model(s) and optimizer(s) and restores the RNG states
+        :return: (epoch, itr, extra) of the checkpoint
+        """
+        path = path or self.latest()
+        state = load_checkpoint(path)
+        load_state_dicts(model, state["model"])
+        load_state_dicts(optimizer, state["optimizer"])
+        if state.get("queues") is not None:  # absent from checkpoints written before the queue was saved
+            load_queue_states(model, state["queues"])
+        set_rng_state(state["rng"])
+        print("Resumed from %s: epoch %d, %d batches done" % (path, state["epoch"], state["itr"]))
+        return state["epoch"], state["itr"], state["extra"]
+
+    def close(self):
+        self.wait()
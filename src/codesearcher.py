@@ -14,6 +14,10 @@ from tensorboardX import SummaryWriter
 
 from utils import *
 from configs import get_config
+from batching import make_train_loader, TokenMeter
+from asyncval import make_validator, EvalCall
+from checkpoint import Checkpointer, save_state_dict, load_weights
+from sparseopt import dense_parameters, with_sparse_adam
 from data import load_qc_data, load_cc_data, load_qq_data, my_collate, load_qc_data_codenn
 
 ADD_ATTN = True
@@ -36,6 +40,7 @@ torch.cuda.manual_seed_all(42)
 class CodeSearcher:
     def __init__(self, conf):
         self.conf = conf
+        self.cand_cache = None  # tokencache.TokenStateCache of the code corpus, used in evaluation if set
 
     ##########################
     # Model loading / saving #
@@ -43,30 +48,33 @@ class CodeSearcher:
     def save_model(self, model):
         if not os.path.exists(self.conf['model_directory']):
             os.makedirs(self.conf['model_directory'])
-        torch.save(model.state_dict(), os.path.join(self.conf['model_directory'], 'best_model.ckpt'))
+        save_state_dict(model.state_dict(), os.path.join(self.conf['model_directory'], 'best_model.ckpt'))
 
     def load_model(self, model):
         assert os.path.exists(os.path.join(self.conf['model_directory'], 'best_model.ckpt')), \
             'Weights for saved model not found'
-        model.load_state_dict(torch.load(os.path.join(self.conf['model_directory'], 'best_model.ckpt')))
+        load_weights(model, os.path.join(self.conf['model_directory'], 'best_model.ckpt'))
 
     def init_qq_with_qc(self, model, qc_model_path):
         assert os.path.exists(os.path.join(qc_model_path, 'best_model.ckpt')), 'Weights for saved model not found'
-        statedict = torch.load(os.path.join(qc_model_path, 'best_model.ckpt'))
-        statedict["cand_encoder.embedding.weight"] = statedict["query_encoder.embedding.weight"]
-        statedict["cand_encoder.lstm.weight_ih_l0"] = statedict["query_encoder.lstm.weight_ih_l0"]
-        statedict["cand_encoder.lstm.weight_hh_l0"] = statedict["query_encoder.lstm.weight_hh_l0"]
-        statedict["cand_encoder.lstm.bias_ih_l0"] = statedict["query_encoder.lstm.bias_ih_l0"]
-        statedict["cand_encoder.lstm.bias_hh_l0"] = statedict["query_encoder.lstm.bias_hh_l0"]
-        statedict["cand_encoder.lstm.weight_ih_l0_reverse"] = statedict["query_encoder.lstm.weight_ih_l0_reverse"]
-        statedict["cand_encoder.lstm.weight_hh_l0_reverse"] = statedict["query_encoder.lstm.weight_hh_l0_reverse"]
-        statedict["cand_encoder.lstm.bias_ih_l0_reverse"] = statedict["query_encoder.lstm.bias_ih_l0_reverse"]
-        statedict["cand_encoder.lstm.bias_hh_l0_reverse"] = statedict["query_encoder.lstm.bias_hh_l0_reverse"]
-        model.load_state_dict(statedict)
+
+        def tie_encoders(statedict):
+            statedict["cand_encoder.embedding.weight"] = statedict["query_encoder.embedding.weight"]
+            statedict["cand_encoder.lstm.weight_ih_l0"] = statedict["query_encoder.lstm.weight_ih_l0"]
+            statedict["cand_encoder.lstm.weight_hh_l0"] = statedict["query_encoder.lstm.weight_hh_l0"]
+            statedict["cand_encoder.lstm.bias_ih_l0"] = statedict["query_encoder.lstm.bias_ih_l0"]
+            statedict["cand_encoder.lstm.bias_hh_l0"] = statedict["query_encoder.lstm.bias_hh_l0"]
+            statedict["cand_encoder.lstm.weight_ih_l0_reverse"] = statedict["query_encoder.lstm.weight_ih_l0_reverse"]
+            statedict["cand_encoder.lstm.weight_hh_l0_reverse"] = statedict["query_encoder.lstm.weight_hh_l0_reverse"]
+            statedict["cand_encoder.lstm.bias_ih_l0_reverse"] = statedict["query_encoder.lstm.bias_ih_l0_reverse"]
+            statedict["cand_encoder.lstm.bias_hh_l0_reverse"] = statedict["query_encoder.lstm.bias_hh_l0_reverse"]
+            return statedict
+
+        load_weights(model, os.path.join(qc_model_path, 'best_model.ckpt'), transform=tie_encoders)
 
     def load_other_model(self, model, model_path):
         assert os.path.exists(os.path.join(model_path, 'best_model.ckpt')), 'Weights for saved model not found'
-        model.load_state_dict(torch.load(os.path.join(model_path, 'best_model.ckpt')))
+        load_weights(model, os.path.join(model_path, 'best_model.ckpt'))
 
     ############
     # Training #
@@ -83,6 +91,7 @@ class CodeSearcher:
         batch_size = self.conf['batch_size']
         nb_epoch = self.conf['nb_epoch']
         max_patience = self.conf['patience']
+        ckpt_every = self.conf['ckpt_every']
 
         # Load data
         if self.conf['negadv'] > 0:
@@ -100,23 +109,35 @@ class CodeSearcher:
             data = load_qq_data(test=False, lang=self.conf["lang"])
         else:
             raise ValueError("Unknown model: %s" % self.conf["model"])
-        train_loader = torch.utils.data.DataLoader(dataset=data["train"], batch_size=batch_size, shuffle=True,
-                                                   drop_last=False, num_workers=1, collate_fn=my_collate)
-
+        train_loader = make_train_loader(data["train"], batch_size, my_collate, bucket=self.conf['bucket'] > 0,
+                                         drop_last=False)
+
+        # Full-state checkpoints; with resume > 0, training goes on from the latest one
+        checkpointer = Checkpointer(self.conf['checkpoint_directory'], keep=self.conf['keep_ckpt'])
+        start_epoch, start_itr, patience = self.conf['reload'] + 1, 0, 0
+        if self.conf['resume'] > 0 and checkpointer.latest() is not None:
+            start_epoch, start_itr, extra = checkpointer.restore(model, optimizer)
+            max_mrr, patience = extra["max_mrr"], extra["patience"]
         # MRR for the Best Saved model, if reload > 0, else -1
-        if self.conf['reload'] > 0:
+        elif self.conf['reload'] > 0:
             _, max_mrr, _, _ = self.eval(model, 50, data["dev"], given_candidates=self.conf["negadv"] > 0)
         else:
             max_mrr = -1
 
-        patience = 0
-        for epoch in range(self.conf['reload'] + 1, nb_epoch):
-            itr = 1
+        # Dev evaluation, in a worker process with async_valid
+        evaluate = EvalCall(self.eval, 50, data["dev"], given_candidates=self.conf["negadv"] > 0)
+        validator = make_validator(model, evaluate, self.conf['async_valid'] > 0)
+
+        for epoch in range(start_epoch, nb_epoch):
+            itr, start_itr = start_itr + 1, 0
+            meter = TokenMeter()
             losses, all_losses = [], []
 
             model = model.train()
 
+            train_loader.batch_sampler.set_epoch(epoch, skip=itr - 1)
             for batch in train_loader:
+                meter.update(batch)
                 if self.conf["negadv"] > 0:
                     qts, good_cands, bad_cands = batch["query"], batch["pos"], batch["adv_neg"]
                 else:
@@ -131,8 +152,11 @@ class CodeSearcher:
                 loss.backward()
                 optimizer.step()
                 if itr % log_every == 0:
-                    print('epo:[%d/%d]  itr:%d  Loss=%.5f' % (epoch, nb_epoch, itr, np.mean(losses)))
+                    print('epo:[%d/%d]  itr:%d  Loss=%.5f  %s' % (
+                        epoch, nb_epoch, itr, np.mean(losses), meter.report()))
                     losses = []
+                if ckpt_every > 0 and itr % ckpt_every == 0:
+                    checkpointer.save(epoch, itr, model, optimizer, max_mrr=max_mrr, patience=patience)
                 itr = itr + 1
 
             # Write to tensorboard
@@ -141,23 +165,27 @@ class CodeSearcher:
 
             if epoch % valid_every == 0:
                 print("validating..")
-                acc1, mrr, map, ndcg = self.eval(model, 50, data["dev"], given_candidates=self.conf["negadv"] > 0)
+                validator.submit(epoch, model)
+            for valid_epoch, valid_model, (acc1, mrr, map, ndcg) in validator.results(wait=epoch == nb_epoch - 1):
                 if mrr > max_mrr:
-                    self.save_model(model)
+                    self.save_model(valid_model)
                     patience = 0
-                    print("Model improved. Saved model at %d epoch" % epoch)
+                    print("Model improved. Saved model at %d epoch" % valid_epoch)
                     max_mrr = mrr
                 else:
                     print("Model didn't improve for ", patience + 1, " epochs")
                     patience += 1
                 if writer is not None:
-                    writer.add_scalar('Valid/%s_MRR' % conf['model'].upper(), mrr, epoch)
-                    writer.add_scalar('Valid/%s_MAP' % conf['model'].upper(), map, epoch)
-                    writer.add_scalar('Valid/%s_nDCG' % conf['model'].upper(), ndcg, epoch)
+                    writer.add_scalar('Valid/%s_MRR' % conf['model'].upper(), mrr, valid_epoch)
+                    writer.add_scalar('Valid/%s_MAP' % conf['model'].upper(), map, valid_epoch)
+                    writer.add_scalar('Valid/%s_nDCG' % conf['model'].upper(), ndcg, valid_epoch)
+            checkpointer.save(epoch + 1, 0, model, optimizer, max_mrr=max_mrr, patience=patience)
 
             if patience >= max_patience:
                 print("Patience Limit Reached. Stopping Training")
                 break
+        validator.close()
+        checkpointer.close()
 
     ####################################
     # Training with adversarial sample #
@@ -174,6 +202,7 @@ class CodeSearcher:
         batch_size = self.conf['batch_size']
         nb_epoch = self.conf['nb_epoch']
         max_patience = self.conf['patience']
+        ckpt_every = self.conf['ckpt_every']
 
         # Load data
         if self.conf["model"] == "qc":
@@ -184,21 +213,35 @@ class CodeSearcher:
             data = load_qq_data(test=False, lang=self.conf["lang"])
         else:
             raise ValueError("Unknown model: %s" % self.conf["model"])
-        train_loader = torch.utils.data.DataLoader(dataset=data["train"], batch_size=batch_size, shuffle=True,
-                                                   drop_last=False, num_workers=1, collate_fn=my_collate)
-
+        train_loader = make_train_loader(data["train"], batch_size, my_collate, bucket=self.conf['bucket'] > 0,
+                                         drop_last=False)
+
+        # Full-state checkpoints; with resume > 0, training goes on from the latest one
+        checkpointer = Checkpointer(self.conf['checkpoint_directory'], keep=self.conf['keep_ckpt'])
+        start_epoch, start_itr, patience = self.conf['reload'] + 1, 0, 0
+        if self.conf['resume'] > 0 and checkpointer.latest() is not None:
+            start_epoch, start_itr, extra = checkpointer.restore(model, optimizer)
+            max_mrr, patience = extra["max_mrr"], extra["patience"]
         # MRR for the Best Saved model, if reload > 0, else -1
-        if self.conf['reload'] > 0:
+        elif self.conf['reload'] > 0:
             _, max_mrr, _, _ = self.eval(model, 50, data["dev"], given_candidates=self.conf["negadv"] > 0)
+        else:
+            max_mrr = -1
+
+        # Dev evaluation, in a worker process with async_valid
+        evaluate = EvalCall(self.eval, 50, data["dev"], given_candidates=self.conf["negadv"] > 0)
+        validator = make_validator(model, evaluate, self.conf['async_valid'] > 0)
 
-        patience = 0
-        for epoch in range(self.conf['reload'] + 1, nb_epoch):
-            itr = 1
+        for epoch in range(start_epoch, nb_epoch):
+            itr, start_itr = start_itr + 1, 0
+            meter = TokenMeter()
             losses, all_losses = [], []
 
             model = model.train()
 
+            train_loader.batch_sampler.set_epoch(epoch, skip=itr - 1)
             for batch in train_loader:
+                meter.update(batch)
                 qts, good_cands, bad_cands = batch["query"], batch["pos"], batch["neg"]
                 qts, good_cands, bad_cands = gVar(qts), gVar(good_cands), gVar(bad_cands)
 
@@ -210,8 +253,10 @@ class CodeSearcher:
                 loss.backward()
                 optimizer.step()
                 if itr % log_every == 0:
-                    print('epo:[%d/%d] itr:%d Loss=%.5f' % (epoch, nb_epoch, itr, np.mean(losses)))
+                    print('epo:[%d/%d] itr:%d Loss=%.5f  %s' % (epoch, nb_epoch, itr, np.mean(losses), meter.report()))
                     losses = []
+                if ckpt_every > 0 and itr % ckpt_every == 0:
+                    checkpointer.save(epoch, itr, model, optimizer, max_mrr=max_mrr, patience=patience)
                 itr = itr + 1
 
             # Write to tensorboard
@@ -220,23 +265,27 @@ class CodeSearcher:
 
             if epoch % valid_every == 0:
                 print("validating..")
-                acc1, mrr, map, ndcg = self.eval(model, 50, data["dev"], given_candidates=self.conf["negadv"] > 0)
+                validator.submit(epoch, model)
+            for valid_epoch, valid_model, (acc1, mrr, map, ndcg) in validator.results(wait=epoch == nb_epoch - 1):
                 if mrr > max_mrr:
-                    self.save_model(model)
+                    self.save_model(valid_model)
                     patience = 0
-                    print("Model improved. Saved model at %d epoch" % epoch)
+                    print("Model improved. Saved model at %d epoch" % valid_epoch)
                     max_mrr = mrr
                 else:
                     print("Model didn't improve for ", patience + 1, " epochs")
                     patience += 1
                 if writer is not None:
-                    writer.add_scalar('Valid/%s_MRR' % conf['model'].upper(), mrr, epoch)
-                    writer.add_scalar('Valid/%s_MAP' % conf['model'].upper(), map, epoch)
-                    writer.add_scalar('Valid/%s_nDCG' % conf['model'].upper(), ndcg, epoch)
+                    writer.add_scalar('Valid/%s_MRR' % conf['model'].upper(), mrr, valid_epoch)
+                    writer.add_scalar('Valid/%s_MAP' % conf['model'].upper(), map, valid_epoch)
+                    writer.add_scalar('Valid/%s_nDCG' % conf['model'].upper(), ndcg, valid_epoch)
+            checkpointer.save(epoch + 1, 0, model, optimizer, max_mrr=max_mrr, patience=patience)
 
             if patience >= max_patience:
                 print("Patience Limit Reached. Stopping Training")
                 break
+        validator.close()
+        checkpointer.close()
 
     #######################
     # Evaluation on StaQC #
@@ -250,6 +299,12 @@ class CodeSearcher:
                 model, poolsize, dataset, bool_collect=bool_collect, f_qual=f_qual)
         return acc, mrr, map, ndcg
 
+    def encode_cands(self, model, cands):
+        """model.cand_encoding of candidates, read from the token state cache for the cached ones if there is one"""
+        if self.cand_cache is not None:
+            return self.cand_cache.cand_encoding(model, cands)
+        return model.cand_encoding(gVar(cands))
+
     def _eval(self, model, poolsize, dataset, bool_collect=False, f_qual=None):
         """
         simple validation in a code pool.
@@ -267,37 +322,27 @@ class CodeSearcher:
         sims_collection = []
         for batch in data_loader:
             qts, cands, all_pos = batch["query"], batch["pos"], batch["all_pos"]
-            qts, cands = gVar(qts), gVar(cands)
-            qts_repr = model.query_encoding(qts)
-            cands_repr = model.cand_encoding(cands)
-
-            all_pos_number = [x.size(0) for x in all_pos]
-            all_pos_stack = torch.cat(all_pos)
-            all_pos_stack = gVar(all_pos_stack)
-            all_pos_repr = model.cand_encoding(all_pos_stack)
-            all_pos_repr = torch.split(all_pos_repr, all_pos_number)
-
             _poolsize = len(qts) if bool_collect else min(poolsize, len(qts))  # true poolsize
-            for i in range(_poolsize):
-                cands_repr_w_all_pos = torch.cat([all_pos_repr[i], cands_repr[:i], cands_repr[i+1:]])
-                if not ADD_ATTN:
-                    _qts_repr = qts_repr[i].expand(cands_repr_w_all_pos.size(0), -1)
-                else:
-                    _qts_repr = qts_repr[i].expand(cands_repr_w_all_pos.size(0), -1, -1)
-                scores = model.scoring(_qts_repr, cands_repr_w_all_pos).data.cpu().numpy()
-                neg_scores = np.negative(scores)
-                predict = np.argsort(neg_scores)
-                predict = [int(k) for k in predict]
-                real = list(range(all_pos_repr[i].size(0)))  # index of positive sample
-                accs.append(ACC(real, predict))
-                mrrs.append(MRR(real, predict))
-                maps.append(MAP(real, predict))
-                ndcgs.append(NDCG(real, predict))
-                sims_collection.append(scores)
-
-                if f_qual is not None:
-                    dataset.print_qualitative(file=f_qual, batch=batch, scores=scores, index=i,
-                                              mrr=mrrs[-1], map=maps[-1], ndcg=ndcgs[-1])
+            all_pos_number = [x.size(0) for x in all_pos[:_poolsize]]
+
+            with torch.no_grad():
+                qts_repr = model.query_encoding(gVar(qts[:_poolsize]))
+                cands_repr = self.encode_cands(model, cands)
+                all_pos_repr = self.encode_cands(model, torch.cat(all_pos[:_poolsize]))
+                scores, valid, pos_mask = score_pool(model, qts_repr, cands_repr, all_pos_repr, all_pos_number)
+
+            batch_accs, batch_mrrs, batch_maps, batch_ndcgs = ranking_metrics(scores, pos_mask, valid)
+            accs.extend(batch_accs)
+            mrrs.extend(batch_mrrs)
+            maps.extend(batch_maps)
+            ndcgs.extend(batch_ndcgs)
+
+            if bool_collect or f_qual is not None:
+                for i in range(_poolsize):
+                    sims_collection.append(scores[i][valid[i]])
+                    if f_qual is not None:
+                        dataset.print_qualitative(file=f_qual, batch=batch, scores=sims_collection[-1], index=i,
+                                                  mrr=batch_mrrs[i], map=batch_maps[i], ndcg=batch_ndcgs[i])
 
         if bool_collect:
             save_path = os.path.join(self.conf['model_directory'], "collect_sims_staqc_%s.pkl" % dataset.data_name)
@@ -318,38 +363,38 @@ class CodeSearcher:
         sims_collection = []
         for batch in data_loader:
             qts, all_pos, adv_neg = batch["query"], batch["all_pos"], batch["adv_neg"]
-            qts, adv_neg = gVar(qts), gVar(adv_neg)
-            qts_repr = model.query_encoding(qts)
-            adv_neg_repr = model.cand_encoding(adv_neg.view(-1, adv_neg.size(-1))).reshape(
-                adv_neg.size(0), adv_neg.size(1), -1)
-
-            all_pos_number = [x.size(0) for x in all_pos]
-            all_pos_stack = torch.cat(all_pos)
-            all_pos_stack = gVar(all_pos_stack)
-            all_pos_repr = model.cand_encoding(all_pos_stack)
-            all_pos_repr = torch.split(all_pos_repr, all_pos_number)
-
             _poolsize = len(qts) if bool_collect else min(poolsize, len(qts))  # true poolsize
-            for i in range(_poolsize):
-                cands_repr_w_adv_neg = torch.cat([all_pos_repr[i], adv_neg_repr[i][: _poolsize - 1]])
-                _qts_repr = qts_repr[i].expand(cands_repr_w_adv_neg.size(0), -1)
-                scores = model.scoring(_qts_repr, cands_repr_w_adv_neg).data.cpu().numpy()
-                neg_scores = np.negative(scores)
-                predict = np.argsort(neg_scores)
-                predict = [int(k) for k in predict]
-                real = list(range(all_pos_repr[i].size(0)))  # index of positive sample
-                accs.append(ACC(real, predict))
-                mrrs.append(MRR(real, predict))
-                maps.append(MAP(real, predict))
-                ndcgs.append(NDCG(real, predict))
-                sims_collection.append(scores)
-
-                if f_qual is not None:
-                    self._print_qualitative(f_qual=f_qual, qvocab=dataset.qvocab, cvocab=dataset.cvocab,
-                                            query=qts[i].tolist(), pos=all_pos[i].tolist(),
-                                            neg=(adv_neg[i][: _poolsize - 1].tolist()),
-                                            labels=real, preds=scores,
-                                            MRR=mrrs[-1], MAP=maps[-1], nDCG=ndcgs[-1])
+            all_pos_number = [x.size(0) for x in all_pos[:_poolsize]]
+            adv_neg = adv_neg[:_poolsize, : _poolsize - 1]
+            n_neg = adv_neg.size(1)
+
+            with torch.no_grad():
+                qts_repr = model.query_encoding(gVar(qts[:_poolsize]))
+                adv_neg_repr = model.cand_encoding(gVar(adv_neg.reshape(-1, adv_neg.size(-1))))
+                all_pos_repr = model.cand_encoding(gVar(torch.cat(all_pos[:_poolsize])))
+
+                owner = gVar(torch.from_numpy(np.repeat(np.arange(_poolsize), all_pos_number)))
+                pos_scores = model.scoring(qts_repr.index_select(0, owner), all_pos_repr)
+                _qts_repr = qts_repr.unsqueeze(1).expand(-1, n_neg, -1).reshape(_poolsize * n_neg, -1)
+                neg_scores = model.scoring(_qts_repr, adv_neg_repr).view(_poolsize, n_neg)
+            scores, valid, pos_mask = pool_score_matrix(pos_scores.data.cpu().numpy(), all_pos_number,
+                                                        neg_scores.data.cpu().numpy())
+
+            batch_accs, batch_mrrs, batch_maps, batch_ndcgs = ranking_metrics(scores, pos_mask, valid)
+            accs.extend(batch_accs)
+            mrrs.extend(batch_mrrs)
+            maps.extend(batch_maps)
+            ndcgs.extend(batch_ndcgs)
+
+            if bool_collect or f_qual is not None:
+                for i in range(_poolsize):
+                    sims_collection.append(scores[i][valid[i]])
+                    if f_qual is not None:
+                        self._print_qualitative(f_qual=f_qual, qvocab=dataset.qvocab, cvocab=dataset.cvocab,
+                                                query=qts[i].tolist(), pos=all_pos[i].tolist(),
+                                                neg=adv_neg[i].tolist(),
+                                                labels=list(range(all_pos_number[i])), preds=sims_collection[-1],
+                                                MRR=batch_mrrs[i], MAP=batch_maps[i], nDCG=batch_ndcgs[i])
 
         if bool_collect:
             save_path = os.path.join(self.conf['model_directory'], "collect_sims_staqc_%s.pkl" % dataset.data_name)
@@ -372,32 +417,23 @@ class CodeSearcher:
 
         sims_collection = []
         for batch in data_loader:
-
             qts, cands, all_pos = batch["query"], batch["pos"], batch["all_pos"]
-            qts, cands = gVar(qts), gVar(cands)
-            qts_repr = model.cand_encoding(qts)  # NOTE: queries in this special case is code
-            cands_repr = model.cand_encoding(cands)
-
-            all_pos_number = [x.size(0) for x in all_pos]
-            all_pos_stack = torch.cat(all_pos)
-            all_pos_stack = gVar(all_pos_stack)
-            all_pos_repr = model.cand_encoding(all_pos_stack)
-            all_pos_repr = torch.split(all_pos_repr, all_pos_number)
-
             _poolsize = len(qts) if bool_collect else min(poolsize, len(qts))  # true poolsize
-            for i in range(_poolsize):
-                cands_repr_w_all_pos = torch.cat([all_pos_repr[i], cands_repr[:i], cands_repr[i+1:]])
-                _qts_repr = qts_repr[i].expand(cands_repr_w_all_pos.size(0), -1)
-                scores = model.scoring(_qts_repr, cands_repr_w_all_pos).data.cpu().numpy()
-                neg_scores = np.negative(scores)
-                predict = np.argsort(neg_scores)
-                predict = [int(k) for k in predict]
-                real = list(range(all_pos_repr[i].size(0)))  # index of positive sample
-                accs.append(ACC(real, predict))
-                mrrs.append(MRR(real, predict))
-                maps.append(MAP(real, predict))
-                ndcgs.append(NDCG(real, predict))
-                sims_collection.append(scores)
+            all_pos_number = [x.size(0) for x in all_pos[:_poolsize]]
+
+            with torch.no_grad():
+                qts_repr = model.cand_encoding(gVar(qts[:_poolsize]))  # NOTE: queries in this special case is code
+                cands_repr = model.cand_encoding(gVar(cands))
+                all_pos_repr = model.cand_encoding(gVar(torch.cat(all_pos[:_poolsize])))
+                scores, valid, pos_mask = score_pool(model, qts_repr, cands_repr, all_pos_repr, all_pos_number)
+
+            batch_accs, batch_mrrs, batch_maps, batch_ndcgs = ranking_metrics(scores, pos_mask, valid)
+            accs.extend(batch_accs)
+            mrrs.extend(batch_mrrs)
+            maps.extend(batch_maps)
+            ndcgs.extend(batch_ndcgs)
+            if bool_collect:
+                sims_collection.extend([scores[i][valid[i]] for i in range(_poolsize)])
 
         if bool_collect:
             save_path = os.path.join(self.conf['model_directory'], "collect_sims_staqc_%s.pkl" % dataset.data_name)
@@ -408,6 +444,116 @@ class CodeSearcher:
             len(accs), np.mean(accs), np.mean(mrrs), np.mean(maps), np.mean(ndcgs)))
         return np.mean(accs), np.mean(mrrs), np.mean(maps), np.mean(ndcgs)
 
+    ###############################################
+    # Evaluation on StaQC: the whole code corpus #
+    ###############################################
+    def collect_code_corpus(self, datasets, batch_size=1024):
+        """
+        Collects the distinct code snippets of some datasets into one corpus. Snippets are told apart by their
+        token ids, and named after their first occurrence: "<data_name>_<item>_<k>" for the k-th positive of an item.
+        :param datasets: datasets whose positives make up the corpus
+        :param batch_size: number of items loaded at once
+        :return: corpus tokens [n_snippet x code_len], snippet ids, and for every dataset the corpus rows of the
+                 positives of each of its items
+        """
+        row_of, snippets, snippet_ids, positives = {}, [], [], []
+        for dataset in datasets:
+            data_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False,
+                                                      drop_last=False, num_workers=1, collate_fn=my_collate)
+            dataset_positives = []
+            for batch in data_loader:
+                for all_pos in batch["all_pos"]:
+                    rows = []
+                    for k, snippet in enumerate(all_pos):
+                        key = np.trim_zeros(snippet.numpy(), 'b').tobytes()
+                        if key not in row_of:
+                            row_of[key] = len(snippets)
+                            snippets.append(snippet)
+                            snippet_ids.append("%s_%d_%d" % (dataset.data_name, len(dataset_positives), k))
+                        rows.append(row_of[key])
+                    dataset_positives.append(rows)
+            positives.append(dataset_positives)
+        return torch.stack(snippets), snippet_ids, positives
+
+    def encode_corpus(self, model, snippets, batch_size=1024, out=None):
+        """
+        Encodes code snippets once with the candidate encoder.
+        :param snippets: corpus tokens, see collect_code_corpus
+        :param out: optional [n_snippet x dim] numpy array (e.g. a memmap) to write the encodings into
+        :return: contiguous [n_snippet x dim] matrix of L2-normalized encodings (out, if given)
+        """
+        model = model.eval()
+        with torch.no_grad():
+            for start in range(0, snippets.size(0), batch_size):
+                cands_repr = model.cand_encoding(gVar(snippets[start: start + batch_size]))
+                cands_repr = cands_repr / cands_repr.norm(dim=1)[:, None]
+                if out is None:
+                    out = cands_repr.new_empty((snippets.size(0), cands_repr.size(1)))
+                if isinstance(out, np.ndarray):
+                    out[start: start + cands_repr.size(0)] = cands_repr.cpu().numpy()
+                else:
+                    out[start: start + cands_repr.size(0)] = cands_repr
+        return out
+
+    def eval_full_corpus(self, model, dataset, corpus_repr, positives, topk=(1, 5, 10), batch_size=1024,
+                         corpus_block=16384, bool_collect=False):
+        """
+        Retrieval against the whole code corpus instead of a pool of candidates. The corpus is scanned block by
+        block, so memory stays bounded by batch_size x corpus_block scores.
+        :param dataset: dataset whose queries are evaluated
+        :param corpus_repr: normalized corpus encodings, see encode_corpus
+        :param positives: corpus rows of the positives of each item of the dataset, see collect_code_corpus
+        :param topk: cut-offs k of the reported Recall@k
+        :return: MRR, MAP, nDCG and the list of Recall@k
+        """
+        data_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False,
+                                                  drop_last=False, num_workers=1, collate_fn=my_collate)
+
+        model = model.eval()
+        mrrs, maps, ndcgs = [], [], []
+        recalls = [[] for _ in topk]
+
+        topk_collection = []
+        for batch in data_loader:
+            pos_rows = positives[len(mrrs): len(mrrs) + len(batch["query"])]
+            pos_number = [len(rows) for rows in pos_rows]
+            with torch.no_grad():
+                qts_repr = model.query_encoding(gVar(batch["query"]))
+                qts_repr = qts_repr / qts_repr.norm(dim=1)[:, None]
+
+                owner = np.repeat(np.arange(len(pos_rows)), pos_number)
+                pos_flat = gVar(torch.from_numpy(np.concatenate(pos_rows).astype(np.int64)))
+                pos_scores = (qts_repr[gVar(torch.from_numpy(owner))] * corpus_repr.index_select(0, pos_flat)).sum(1)
+                pos_block = qts_repr.new_full((len(pos_rows), max(pos_number)), -np.inf)
+                pos_block[owner, np.arange(len(owner)) - np.repeat(np.cumsum(pos_number) - pos_number, pos_number)] = \
+                    pos_scores
+
+                # positives are scored apart from the corpus scan: leave room for rounding so they don't beat themselves
+                topk_scores, topk_index, beaten = corpus_search(qts_repr, corpus_repr, max(topk),
+                                                                pos_scores=pos_block + 1e-6,
+                                                                query_block=batch_size, corpus_block=corpus_block)
+
+            ranks = beaten.cpu().numpy().astype(float)
+            ranks[np.isinf(pos_block.cpu().numpy())] = np.inf
+            ranks = np.sort(ranks, axis=1)
+            mrrs.extend(MRR_array(ranks))
+            maps.extend(MAP_array(ranks))
+            ndcgs.extend(NDCG_array(ranks))
+            for recall, k in zip(recalls, topk):
+                recall.extend(ACC_array(ranks, k))
+            if bool_collect:
+                topk_collection.append((topk_index.cpu().numpy(), topk_scores.cpu().numpy()))
+
+        if bool_collect:
+            save_path = os.path.join(self.conf['model_directory'], "collect_topk_corpus_%s.pkl" % dataset.data_name)
+            print("Save collection to %s" % save_path)
+            pickle.dump(topk_collection, open(save_path, "wb"))
+
+        print('Size={}, Corpus={}, MRR={}, MAP={}, nDCG={}, {}'.format(
+            len(mrrs), len(corpus_repr), np.mean(mrrs), np.mean(maps), np.mean(ndcgs),
+            ', '.join(['R@{}={}'.format(k, np.mean(recall)) for k, recall in zip(topk, recalls)])))
+        return np.mean(mrrs), np.mean(maps), np.mean(ndcgs), [np.mean(recall) for recall in recalls]
+
     ########################
     # Evaluation on CodeNN #
     ########################
@@ -440,20 +586,15 @@ class CodeSearcher:
             sims_per_qts = []
             for qts_i in qts:
                 qt_repr = model.query_encoding(qts_i)
-
                 sims = model.scoring(qt_repr, cands_repr).data.cpu().numpy()
-                negsims = np.negative(sims)
-                predict = np.argsort(negsims)
-                predict = [int(k) for k in predict]
-                real = [0]  # index of the positive sample
-
-                # save
                 sims_per_qts.append(sims)
 
-                mrrs.append(MRR(real, predict))
-                accs.append(ACC(real, predict))
-                maps.append(MAP(real, predict))
-                ndcgs.append(NDCG(real, predict))
+            # one row per query set; the positive sample is at index 0
+            acc, mrr, map, ndcg = ranking_metrics(np.stack(sims_per_qts), np.ones(len(sims_per_qts), dtype=int))
+            mrrs.extend(mrr)
+            accs.extend(acc)
+            maps.extend(map)
+            ndcgs.extend(ndcg)
 
             sims_collection.append(sims_per_qts)
 
@@ -482,13 +623,34 @@ def parse_args():
     parser.add_argument("--reload", type=int, default=-1, help="Should I reload saved model, yes if reload>0?",
                         required=True)
     parser.add_argument("--reload_path", type=str, default="", help="Enclosing folder of the to-be-reloaded model.")
+    parser.add_argument("--resume", type=int, default=0,
+                        help="Resume training from the latest full-state checkpoint, if resume>0.")
+    parser.add_argument("--ckpt_every", type=int, default=500,
+                        help="Iterations between full-state checkpoints (0: only at the end of every epoch).")
+    parser.add_argument("--keep_ckpt", type=int, default=3, help="Number of full-state checkpoints kept.")
     parser.add_argument("--save_qual", type=int, default=-1, help="When eval, whether save qual results.")
 
     # model setup
     parser.add_argument("--dropout", type=float, default=0.0, help="What is the dropout?", required=True)
     parser.add_argument("--emb_size", type=int, default=100, help="What is the embedding size?", required=True)
     parser.add_argument("--lstm_dims", type=int, default=200, help="What is the lstm dimension?", required=True)
+    parser.add_argument("--seqenc_packed", type=int, default=0,
+                        help="Run the sequence encoders on packed sequences, skipping padding, if seqenc_packed>0.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--sparse_emb", type=int, default=0,
+                        help="Sparse embedding gradients, trained with SparseAdam, if sparse_emb>0.")
+    parser.add_argument("--queue_size", type=int, default=0,
+                        help="Keep the encodings of the latest queue_size training candidates as extra negatives "
+                             "(models.py models only), e.g. 65536; 0 for none.")
+    parser.add_argument("--queue_temp", type=float, default=0.1,
+                        help="Temperature of the sampling of margin loss negatives from the queue.")
     parser.add_argument("--batch_size", type=int, default=32, help="What is the batch size?", required=True)
+    parser.add_argument("--async_valid", type=int, default=0,
+                        help="Run the dev evaluation in a worker process while training goes on, if async_valid>0.")
+    parser.add_argument("--bucket", type=int, default=0,
+                        help="Batch training items of similar lengths and trim their padding, if bucket>0.")
     parser.add_argument("--temp", type=str, default="", help="Name of a temporary test (not affect saved model etc).")
     parser.add_argument("--init_qq_w_qc", type=int, default=0, help="Init Q-encoder in CC model with that in QC model.")
 
@@ -503,6 +665,19 @@ def parse_args():
     # optimization
     parser.add_argument("--lr", type=float, default=0.001, help="What is the learning rate?")
     parser.add_argument("--margin", type=float, default=0.05, help="Margin for pairwise loss.")
+    parser.add_argument("--loss", type=str, choices=["margin", "infonce"], default="margin",
+                        help="Training loss: `margin` is a hinge on one loaded negative per query; `infonce` is a "
+                             "softmax over the whole batch of positives, without encoding the loaded negatives "
+                             "(models.py models only, not the attention model).")
+    parser.add_argument("--infonce_scale", type=float, default=20.0,
+                        help="Cosine -> logit scale (inverse temperature) of the infonce loss.")
+    parser.add_argument("--infonce_neg", type=int, default=0,
+                        help="With infonce, also score the loaded negatives of the batch, if infonce_neg>0.")
+    parser.add_argument("--infonce_collision", type=int, default=1,
+                        help="With infonce, leave in-batch copies of the positive of a query out of its negatives, "
+                             "if infonce_collision>0.")
+    parser.add_argument("--n_neg", type=int, default=1,
+                        help="Negatives sampled per query from the batch when training with adversarial samples.")
     parser.add_argument("--optimizer", type=str,
                         choices=["adam", "adagrad", "sgd", "rmsprop", "asgd", "adadelta"],
                         default="adam", help="Which optimizer to use?")
@@ -510,6 +685,13 @@ def parse_args():
     # evaluation setup
     parser.add_argument("--negadv", type=int, default=0, help="If use TF-IDF adversarial candidates.")
     parser.add_argument("--codenn", type=int, default=0, help="If use CodeNN dataset for evaluation.")
+    parser.add_argument("--full_corpus", type=int, default=0,
+                        help="If rank against the whole code corpus (train/dev/test snippets) instead of a pool.")
+    parser.add_argument("--corpus_block", type=int, default=16384,
+                        help="Number of corpus snippets scored at once in full-corpus evaluation.")
+    parser.add_argument("--token_cache", type=str, default="",
+                        help="Token state cache (tokencache.py) of the code corpus to read candidate states from "
+                             "in eval/collect mode, instead of encoding them.")
 
     return parser.parse_args()
 
@@ -534,15 +716,30 @@ if __name__ == '__main__':
     conf['model'] = args.model
     conf['bow_dropout'] = args.dropout
     conf['seqenc_dropout'] = args.dropout
+    conf['seqenc_packed'] = args.seqenc_packed > 0
+    conf['sparse_emb'] = args.sparse_emb > 0
+    conf['queue_size'] = args.queue_size
+    conf['queue_temp'] = args.queue_temp
     conf['emb_size'] = args.emb_size
     conf['lstm_dims'] = args.lstm_dims
     conf['batch_size'] = args.batch_size
+    conf['bucket'] = args.bucket
+    conf['async_valid'] = args.async_valid
     conf['lr'] = args.lr
+    conf['n_neg'] = args.n_neg
+    conf['loss'] = args.loss
+    conf['infonce_scale'] = args.infonce_scale
+    conf['infonce_neg'] = args.infonce_neg > 0
+    conf['infonce_collision'] = args.infonce_collision > 0
     conf['reload'] = args.reload
     conf['reload_path'] = args.reload_path
+    conf['resume'] = args.resume
+    conf['ckpt_every'] = args.ckpt_every
+    conf['keep_ckpt'] = args.keep_ckpt
     conf['optimizer'] = args.optimizer
     conf['negadv'] = args.negadv
     conf['codenn'] = args.codenn
+    conf['full_corpus'] = args.full_corpus
     conf['train_percentage'] = args.train_percentage
     conf['lang'] = args.lang
     # conf['nb_epoch'] = 500
@@ -561,6 +758,7 @@ if __name__ == '__main__':
         print(" Embedding size : ", conf['emb_size'])
         print(" LSTM hidden dimension : ", conf['lstm_dims'])
         print(" Margin: ", conf['margin'])
+        print(" Loss: ", conf['loss'])
         print(" Optimizer: ", conf['optimizer'])
 
         # Creating unique model string based on parameters defined. Helps differentiate between different runs of model
@@ -572,6 +770,7 @@ if __name__ == '__main__':
 
         conf['model_directory'] = os.path.join(conf['ckptdir'], '%s' % model_dir_str, model_string)
         conf['reload_model_directory'] = os.path.join(conf['reload_path'], model_string)
+        conf['checkpoint_directory'] = os.path.join(conf['model_directory'], 'checkpoints')
 
         if not os.path.exists(conf['model_directory']):
             os.makedirs(conf['model_directory'])
@@ -611,6 +810,12 @@ if __name__ == '__main__':
                 else:
                     searcher.load_model(model)
 
+        if args.token_cache and args.mode in {'eval', 'collect'}:
+            from tokencache import open_token_cache
+            model_path = conf['reload_model_directory'] if len(conf["reload_path"]) > 0 else conf['model_directory']
+            searcher.cand_cache = open_token_cache(args.token_cache, os.path.join(model_path, 'best_model.ckpt'))
+            print("Reading candidate states from %s" % args.token_cache)
+
         if torch.cuda.is_available():
             print('using GPU')
             model = model.cuda()
@@ -619,27 +824,29 @@ if __name__ == '__main__':
 
         print("\nParameter requires_grad state: ")
         for name, param in model.named_parameters():
-            print name, param.requires_grad
+            print(name, param.requires_grad)
         print("")
 
         if conf['optimizer'] == 'adagrad':
-            optimizer = optim.Adagrad(model.parameters(), lr=conf['lr'])
+            optimizer = optim.Adagrad(dense_parameters(model), lr=conf['lr'])
             print("Recommend lr 0.01 for AdaGrad while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'sgd':
-            optimizer = optim.SGD(model.parameters(), lr=conf['lr'], momentum=0.9)
+            optimizer = optim.SGD(dense_parameters(model), lr=conf['lr'], momentum=0.9)
             print("Recommend lr 0.1 for SGD (momentum 0.9) while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'rmsprop':
-            optimizer = optim.RMSprop(model.parameters(), lr=conf['lr'])
+            optimizer = optim.RMSprop(dense_parameters(model), lr=conf['lr'])
             print("Recommend lr 0.01 for RMSprop while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'asgd':
-            optimizer = optim.ASGD(model.parameters(), lr=conf['lr'])
+            optimizer = optim.ASGD(dense_parameters(model), lr=conf['lr'])
             print("Recommend lr 0.01 for ASGD while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'adadelta':
-            optimizer = optim.Adadelta(model.parameters(), lr=conf['lr'])
+            optimizer = optim.Adadelta(dense_parameters(model), lr=conf['lr'])
             print("Recommend lr 1.00 for Adadelta while using %.5f." % conf['lr'])
         else:
-            optimizer = optim.Adam(model.parameters(), lr=conf['lr'])
+            optimizer = optim.Adam(dense_parameters(model), lr=conf['lr'])
             print("Recommend lr 0.001 for Adam while using %.5f." % conf['lr'])
+        if conf['sparse_emb']:
+            optimizer = with_sparse_adam(optimizer, model)
 
         if args.mode == 'train':
             if not args.self_adversarial > 0:
@@ -666,6 +873,25 @@ if __name__ == '__main__':
                     if f_qual_dev is not None: f_qual_dev.close()
                     if f_qual_test is not None: f_qual_test.close()
 
+            elif conf["full_corpus"] > 0:
+                if ADD_ATTN:
+                    raise ValueError("Full-corpus evaluation needs precomputed code vectors; set ADD_ATTN = False.")
+                if conf["model"] == "qc":
+                    data = load_qc_data(test=True, lang=args.lang)
+                elif conf["model"] == "cc":
+                    data = load_cc_data(test=True, lang=args.lang)
+                elif conf["model"] == "qq":
+                    data = load_qq_data(test=True, lang=args.lang)
+                else:
+                    raise ValueError("Unknown model: %s" % conf["model"])
+
+                snippets, _, positives = searcher.collect_code_corpus([data["train"], data["dev"], data["test"]])
+                corpus_repr = searcher.encode_corpus(model, snippets)
+                searcher.eval_full_corpus(model, data["dev"], corpus_repr, positives[1],
+                                          corpus_block=args.corpus_block, bool_collect=args.save_qual > 0)
+                searcher.eval_full_corpus(model, data["test"], corpus_repr, positives[2],
+                                          corpus_block=args.corpus_block, bool_collect=args.save_qual > 0)
+
             else:
                 if conf['negadv'] > 0:
                     neg_adv_dict = {"train": "one", "dev": "all", "test": "all"}
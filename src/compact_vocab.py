@@ -0,0 +1,160 @@
+from __future__ import print_function
+
+import os
+import json
+import zlib
+import argparse
+import collections
+
+import numpy as np
+
+from configs import COMPACT_VOCAB_FILES
+
+
+class CompactVocab:
+    """
+    word -> id of a compacted vocabulary: 0 and 1 are padding and unknown words, 2..n_keep+1 the kept words, then
+    n_buckets hash buckets shared by all the other words, so that rare words still get a (shared) embedding.
+    """
+    def __init__(self, words, n_buckets):
+        self.words = list(words)
+        self.n_buckets = n_buckets
+        self.word2id = dict((word, i + 2) for i, word in enumerate(self.words))
+
+    @property
+    def n_words(self):
+        return 2 + len(self.words) + self.n_buckets
+
+    def bucket(self, word):
+        """bucket id of a word, from a hash that is stable across processes (unlike hash())"""
+        if self.n_buckets == 0:
+            return 1
+        return 2 + len(self.words) + zlib.crc32(word.encode("utf-8")) % self.n_buckets
+
+    def word_id(self, word):
+        i = self.word2id.get(word)
+        return i if i is not None else self.bucket(word)
+
+    def encode(self, tokens):
+        return [self.word_id(word) for word in tokens]
+
+    def id2word(self):
+        """words of every id, buckets named <bucket_i>"""
+        return ["<pad>", "<unk>"] + self.words + ["<bucket_%d>" % i for i in range(self.n_buckets)]
+
+    def remap_ids(self, old_words):
+        """
+        :param old_words: the vocabulary it was compacted from, word id = index + 2
+        :return: int64 array, new id of every old id
+        """
+        return np.array([0, 1] + [self.word_id(word) for word in old_words], dtype=np.int64)
+
+    def save(self, path, source="", source_n_words=0):
+        with open(path, "w") as f:
+            json.dump({"n_words": self.n_words, "n_buckets": self.n_buckets, "source": source,
+                       "source_n_words": source_n_words, "words": self.words}, f)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            vocab = json.load(f)
+        return CompactVocab(vocab["words"], vocab["n_buckets"])
+
+
+def count_tokens(paths):
+    """token frequencies of {id: [tokens]} json files"""
+    counts = collections.Counter()
+    for path in paths:
+        with open(path) as f:
+            for tokens in json.load(f).values():
+                counts.update(tokens)
+    return counts
+
+
+def compact(old_words, counts, top_n, n_buckets):
+    """keeps the top_n words of old_words by corpus frequency (ties in vocabulary order) and hashes the others"""
+    order = sorted(range(len(old_words)), key=lambda i: (-counts.get(old_words[i], 0), i))
+    return CompactVocab([old_words[i] for i in order[:top_n]], n_buckets)
+
+
+def remap_embedding(weight, old2new, n_words):
+    """
+    Rows of an embedding table for the compacted ids: kept words keep their row, a bucket starts as the mean of the
+    rows of the words hashed into it (the unknown word row if none is).
+    :param weight: [old n_words x emb_size] tensor
+    """
+    import torch  # only needed to remap checkpoints, not to encode with a vocabulary (datacache.py, serve.py)
+    old2new = torch.from_numpy(old2new).to(weight.device)
+    total = torch.zeros(n_words, weight.size(1), dtype=weight.dtype, device=weight.device)
+    total.index_add_(0, old2new, weight)
+    counts = torch.zeros(n_words, dtype=weight.dtype, device=weight.device)
+    counts.index_add_(0, old2new, torch.ones_like(old2new, dtype=weight.dtype))
+    total[1] = weight[1]
+    counts[1] = 1
+    empty = counts == 0
+    total[empty] = weight[1]
+    counts[empty] = 1
+    return total / counts[:, None]
+
+
+# vocabulary ("qt" or "code") of the embeddings of each model, by state dict prefix
+EMBEDDINGS = {"qc": {"query_encoder.embedding.weight": "qt", "cand_encoder.embedding.weight": "code"},
+              "cc": {"query_encoder.embedding.weight": "code", "cand_encoder.embedding.weight": "code"},
+              "qq": {"query_encoder.embedding.weight": "qt", "cand_encoder.embedding.weight": "qt"}}
+
+
+def remap_checkpoint(path, model_name, side, old2new, n_words):
+    """
+    Rewrites, in place, the embedding rows of the side ("qt" or "code") vocabulary of a best_model.ckpt. The
+    original is kept as <path>.full.
+    """
+    from checkpoint import load_state_dict_file, save_state_dict
+    state_dict = load_state_dict_file(path, mmap=False)
+    for key, key_side in EMBEDDINGS[model_name].items():
+        if key_side == side and key in state_dict:
+            if state_dict[key].size(0) != len(old2new):
+                raise ValueError("%s of %s has %d rows, the vocabulary %d words." %
+                                 (key, path, state_dict[key].size(0), len(old2new)))
+            state_dict[key] = remap_embedding(state_dict[key], old2new, n_words)
+            print("%s %s: %d -> %d rows" % (path, key, len(old2new), n_words))
+    os.rename(path, path + ".full")
+    save_state_dict(state_dict, path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Compact a vocabulary to its top-N words plus hash buckets, and remap the "
+                                     "embedding rows of checkpoints to it.")
+    parser.add_argument("--vocab", type=str, default="../data/Python/question_vocab.json",
+                        help="Json list of words, word id = index + 2.")
+    parser.add_argument("--corpus", type=str, nargs="+", default=["../data/Python/QQ_questions.json"],
+                        help="{id: [tokens]} json files to count word frequencies on.")
+    parser.add_argument("--top_n", type=int, default=10000, help="Number of words kept.")
+    parser.add_argument("--n_buckets", type=int, default=1000, help="Hash buckets of the other words.")
+    parser.add_argument("--side", choices=["qt", "code"], default="qt",
+                        help="Which vocabulary it is, to know which embeddings to remap.")
+    parser.add_argument("-M", "--model", choices=["qc", "cc", "qq"], default="qc",
+                        help="Model of the checkpoints to remap.")
+    parser.add_argument("--checkpoints", type=str, nargs="*", default=[],
+                        help="best_model.ckpt files to remap in place, the originals are kept as *.ckpt.full. "
+                             "Remapped models need compacted inputs (--compact_vocab 1), not data.py batches.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.vocab) as f:
+        old_words = json.load(f)
+    counts = count_tokens(args.corpus)
+    vocab = compact(old_words, counts, args.top_n, args.n_buckets)
+    out = os.path.join(os.path.dirname(args.vocab), COMPACT_VOCAB_FILES[args.side])
+    vocab.save(out, source=os.path.basename(args.vocab), source_n_words=len(old_words) + 2)
+
+    n_tokens = float(sum(counts.values()))
+    kept = sum(counts.get(word, 0) for word in vocab.words)
+    print("%d -> %d words (%d kept + %d buckets), kept words cover %.2f%% of the %d corpus tokens. Saved to %s" %
+          (len(old_words) + 2, vocab.n_words, len(vocab.words), vocab.n_buckets, 100 * kept / max(n_tokens, 1),
+           n_tokens, out))
+
+    old2new = vocab.remap_ids(old_words)
+    for path in args.checkpoints:
+        remap_checkpoint(path, args.model, args.side, old2new, vocab.n_words)
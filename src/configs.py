@@ -1,3 +1,11 @@
+import os
+import json
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+# vocabularies compacted by compact_vocab.py, in DATA_DIR/<lang>
+COMPACT_VOCAB_FILES = {"qt": "question_vocab.compact.json", "code": "code_vocab.compact.json"}
+
+
 def get_config(args):
     conf = {
         # data_params
@@ -27,6 +35,9 @@ def get_config(args):
         'save_every': 10,
         'patience': 50,
         'reload': 0,  # reload>0, model is reloaded.
+        'resume': 0,  # resume>0, training resumes from the latest full-state checkpoint.
+        'ckpt_every': 500,  # iterations between full-state checkpoints, besides the one at the end of every epoch
+        'keep_ckpt': 3,  # number of full-state checkpoints kept
 
         # model_params
         'emb_size': 200,
@@ -35,7 +46,33 @@ def get_config(args):
         'bow_dropout': 0.25,  # dropout for BOW encoder
         'seqenc_dropout': 0.25,  # dropout for sequence encoder encoder
         'margin': 0.05,
+        'n_neg': 1,  # negatives sampled per query in adversarial training
+        'loss': 'margin',  # margin: hinge on one negative; infonce: in-batch softmax (models.py models only)
+        'infonce_scale': 20.0,  # cosine -> logit scale of the in-batch softmax (inverse temperature)
+        'infonce_neg': False,  # also score the explicit negatives of the batch in the in-batch softmax
+        'infonce_collision': True,  # leave the in-batch copies of a query's positive out of its negatives
+        'queue_size': 0,  # candidates kept in the negative queue of the models.py models, 0 for none (e.g. 65536)
+        'queue_temp': 0.1,  # temperature of the sampling of negatives from the queue for the margin loss
         'code_encoder': 'bilstm',  # bow, bilstm
+        'seqenc_packed': False,  # run the sequence encoder on packed sequences, ignoring padding
+        'sparse_emb': False,  # sparse embedding gradients, trained with SparseAdam (see sparseopt.py)
+        'attn_budget_mb': 256,  # memory of a block of pairs scored at once by the attention model at inference
+
+        # distillation of the attention model into the dual encoder (distill.py)
+        'distill_alpha': 0.5,  # weight of the margin loss, the rest goes to matching the teacher scores
+        'distill_temp': 1.0,  # temperature of the teacher score distributions
+        'distill_scale': 20.0,  # student cosine -> logit scale
     }
 
+    # opt-in: the vocab sizes of the compacted vocabularies of the dataset replace the hardcoded ones. Only for
+    # batches encoded with compact_vocab.CompactVocab (datacache.py --compact_vocab); data.py emits full-vocab ids
+    conf['compact_vocab'] = getattr(args, "compact_vocab", 0) > 0
+    if conf['compact_vocab']:
+        lang = getattr(args, "lang", None) or "Python"
+        for side, file in COMPACT_VOCAB_FILES.items():
+            path = os.path.join(DATA_DIR, lang, file)
+            if os.path.exists(path):
+                with open(path) as f:
+                    conf['%s_n_words' % side] = json.load(f)["n_words"]
+
     return conf
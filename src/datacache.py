@@ -0,0 +1,208 @@
+from __future__ import print_function
+
+import os
+import json
+import glob
+import shutil
+import argparse
+
+import numpy as np
+
+from configs import get_config, COMPACT_VOCAB_FILES
+from compact_vocab import CompactVocab
+
+# {id: [question tokens]} files, cached as padded token tables
+TOKEN_TABLES = {"questions": "QQ_questions.json"}
+# {id: [matched ids]} files, cached as CSR lists: (file, source table, target table)
+MATCHINGS = {"qq_matching": ("QQ_question_matching.json", "questions", "questions"),
+             "cc_matching": ("CC_answer_matching_test.json", "cc_answers", "cc_answers")}
+VOCAB_FILE = "question_vocab.json"
+COMPACT_VOCAB_FILE = COMPACT_VOCAB_FILES["qt"]  # used instead of VOCAB_FILE with compact_vocab, see compact_vocab.py
+SPLIT_PATTERN = "*_id_*.json"
+META_FILE = "meta.json"
+
+
+def id_array(ids):
+    """ids as int64 if they are all integers, else as fixed-width bytes"""
+    ids = [str(i) for i in ids]
+    if all(i.isdigit() for i in ids):
+        return np.array(ids, dtype=np.int64)
+    return np.array(ids, dtype=np.bytes_)
+
+
+def source_files(data_dir):
+    files = list(TOKEN_TABLES.values()) + [file for file, _, _ in MATCHINGS.values()] + [VOCAB_FILE, COMPACT_VOCAB_FILE]
+    files += [os.path.basename(f) for f in glob.glob(os.path.join(data_dir, SPLIT_PATTERN))]
+    return sorted(set(f for f in files if os.path.exists(os.path.join(data_dir, f))))
+
+
+def source_stamps(data_dir):
+    return dict((f, [os.path.getsize(os.path.join(data_dir, f)), int(os.path.getmtime(os.path.join(data_dir, f)))])
+                for f in source_files(data_dir))
+
+
+def build_cache(data_dir, cache_dir, qt_len, compact_vocab=False):
+    """
+    Parses the json files of data_dir once into a directory of .npy arrays:
+    vocab.npy: question words, word id = index + 2 (0: padding, 1: unknown word), with compact_vocab the kept words
+    of the compacted vocabulary (compact_vocab.py) then its hash buckets;
+    <table>.ids.npy: sorted ids, <table>.tokens.npy: [n x qt_len] int32 padded token ids of the rows of the same order,
+    <table>.lengths.npy: number of tokens of every row;
+    <matching>.indptr.npy, <matching>.indices.npy: CSR lists, the matches of source row i are the target rows
+    indices[indptr[i]:indptr[i+1]];
+    split.<name>.npy: the ids of a split file, in file order.
+    The cache is written next to cache_dir and renamed into place, so that concurrent readers never see a partial one.
+    """
+    def load(name):
+        with open(os.path.join(data_dir, name)) as f:
+            return json.load(f)
+
+    tmp_dir = "%s.tmp%d" % (cache_dir.rstrip("/"), os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    save = lambda name, array: np.save(os.path.join(tmp_dir, name + ".npy"), array)
+
+    if compact_vocab:
+        compact = CompactVocab.load(os.path.join(data_dir, COMPACT_VOCAB_FILE))
+        vocab, word_id = compact.id2word()[2:], compact.word_id
+    else:
+        vocab = load(VOCAB_FILE)
+        word2id = dict((word, i + 2) for i, word in enumerate(vocab))
+        word_id = lambda word: word2id.get(word, 1)
+    save("vocab", np.array(vocab, dtype=np.str_))
+
+    tables = {}
+    for table, file in TOKEN_TABLES.items():
+        id2tokens = load(file)
+        ids = id_array(id2tokens.keys())
+        order = np.argsort(ids, kind="stable")
+        sentences = list(id2tokens.values())
+        tokens = np.zeros((len(ids), qt_len), dtype=np.int32)
+        lengths = np.zeros(len(ids), dtype=np.int32)
+        for row, i in enumerate(order):
+            sentence = [word_id(word) for word in sentences[i][:qt_len]]
+            tokens[row, :len(sentence)] = sentence
+            lengths[row] = len(sentence)
+        save(table + ".ids", ids[order])
+        save(table + ".tokens", tokens)
+        save(table + ".lengths", lengths)
+        tables[table] = ids[order]
+
+    for matching, (file, source, target) in MATCHINGS.items():
+        matches = load(file)
+        for table in [source, target]:
+            if table not in tables:  # id-only table, made of every id of the matching file
+                all_ids = list(matches.keys()) + [i for values in matches.values() for i in values]
+                tables[table] = np.unique(id_array(all_ids))
+                save(table + ".ids", tables[table])
+        source_rows = table_rows(tables[source], list(matches.keys()))
+        target_rows = [table_rows(tables[target], values) if values else np.zeros(0, dtype=np.int64)
+                       for values in matches.values()]
+        counts = np.zeros(len(tables[source]), dtype=np.int64)
+        counts[source_rows] = [len(rows) for rows in target_rows]
+        indices = np.zeros(counts.sum(), dtype=np.int32)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        for row, rows in zip(source_rows, target_rows):
+            indices[indptr[row]: indptr[row + 1]] = rows
+        save(matching + ".indptr", indptr)
+        save(matching + ".indices", indices)
+
+    splits = []
+    for path in sorted(glob.glob(os.path.join(data_dir, SPLIT_PATTERN))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        save("split." + name, id_array(load(os.path.basename(path))))
+        splits.append(name)
+
+    meta = {"qt_len": qt_len, "compact_vocab": compact_vocab, "vocab_size": len(vocab) + 2, "tables": sorted(tables),
+            "matchings": sorted(MATCHINGS), "splits": splits, "sources": source_stamps(data_dir)}
+    with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+    return meta
+
+
+def table_rows(table_ids, ids):
+    """rows of ids in a sorted id array, -1 for unknown ids"""
+    ids = [str(i) for i in ids]
+    if table_ids.dtype.kind == "i":
+        ids = [i if i.isdigit() else "-1" for i in ids]  # can't be in an integer table
+    ids = np.array(ids).astype(table_ids.dtype) if len(ids) else np.zeros(0, table_ids.dtype)
+    if len(table_ids) == 0:
+        return -np.ones(len(ids), dtype=np.int64)
+    rows = np.searchsorted(table_ids, ids)
+    rows[rows == len(table_ids)] = 0
+    return np.where(table_ids[rows] == ids, rows, -1)
+
+
+class DataCache:
+    """Read-only view of a cache written by build_cache; every array is memory-mapped, so processes share it."""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._arrays = {}
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.cache_dir, name + ".npy"), mmap_mode="r")
+        return self._arrays[name]
+
+    @property
+    def vocab(self):
+        return self._array("vocab")
+
+    def ids(self, table):
+        return self._array(table + ".ids")
+
+    def rows(self, table, ids):
+        return table_rows(self.ids(table), ids)
+
+    def tokens(self, table, rows=None):
+        tokens = self._array(table + ".tokens")
+        return tokens if rows is None else tokens[rows]
+
+    def lengths(self, table, rows=None):
+        lengths = self._array(table + ".lengths")
+        return lengths if rows is None else lengths[rows]
+
+    def matches(self, matching, row):
+        """target rows matched with a source row"""
+        indptr = self._array(matching + ".indptr")
+        return self._array(matching + ".indices")[indptr[row]: indptr[row + 1]]
+
+    def split(self, name):
+        return self._array("split." + name)
+
+    def is_stale(self, data_dir):
+        return self.meta["sources"] != source_stamps(data_dir)
+
+
+def load_cache(data_dir, cache_dir=None, qt_len=20, compact_vocab=False):
+    """opens the cache of data_dir, (re)building it first if it is missing, older than the json files or made
+       for another qt_len or vocabulary"""
+    cache_dir = cache_dir or os.path.join(data_dir, "cache")
+    if not os.path.exists(os.path.join(cache_dir, META_FILE)) or DataCache(cache_dir).is_stale(data_dir) or \
+            DataCache(cache_dir).meta["qt_len"] != qt_len or \
+            DataCache(cache_dir).meta.get("compact_vocab", False) != compact_vocab:
+        print("Building data cache %s..." % cache_dir)
+        build_cache(data_dir, cache_dir, qt_len, compact_vocab=compact_vocab)
+    return DataCache(cache_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Precompile the json dataset files into a memory-mapped binary cache.")
+    parser.add_argument("--lang", type=str, default="Python", help="Which language dataset to use.")
+    parser.add_argument("--data_dir", type=str, default="", help="Default: ../data/<lang>.")
+    parser.add_argument("--cache_dir", type=str, default="", help="Default: <data_dir>/cache.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Encode questions with the compacted vocabulary of compact_vocab.py, if compact_vocab>0.")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or os.path.join("..", "data", args.lang)
+    meta = build_cache(data_dir, args.cache_dir or os.path.join(data_dir, "cache"), get_config(args)['qt_len'],
+                       compact_vocab=args.compact_vocab > 0)
+    print("Cached tables %s, matchings %s and %d splits." % (meta["tables"], meta["matchings"], len(meta["splits"])))
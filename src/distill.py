@@ -0,0 +1,316 @@
+from __future__ import print_function
+
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+from torch import optim
+import torch.nn.functional as F
+from tensorboardX import SummaryWriter
+
+from utils import gVar
+from configs import get_config
+from batching import make_train_loader, TokenMeter
+from asyncval import make_validator, EvalCall
+from checkpoint import Checkpointer, load_weights
+from sparseopt import dense_parameters, with_sparse_adam
+from data import load_qc_data, my_collate
+from codesearcher import CodeSearcher, create_model_name_string
+import models
+import models_w_attn
+
+
+def distill_loss(student_scores, teacher_scores, scale, temperature=1.0):
+    """
+    KL divergence from the teacher to the student distribution over the candidates of every query.
+    :param student_scores: [n_qt x n_cand] cosine similarities of the dual encoder
+    :param teacher_scores: [n_qt x n_cand] sigmoid scores of the attention model, turned back into logits
+    :param scale: student cosine -> logit scale
+    """
+    teacher_probs = F.softmax(torch.logit(teacher_scores, eps=1e-6) / temperature, 1)
+    return F.kl_div(F.log_softmax(student_scores * scale, 1), teacher_probs, reduction='batchmean')
+
+
+class DistillSearcher(CodeSearcher):
+    """
+    Trains a dual encoder QC model (models.py), whose code encodings can be precomputed, to reproduce the in-batch
+    score matrices of a trained attention QC model (models_w_attn.py).
+    """
+    def distill_step(self, student, teacher, qts, good_cands, bad_cands):
+        """
+        Scores every query against all the positives and negatives of the batch with both models.
+        :return: loss, and the student scores of the positive and of the negative of every query
+        """
+        # right-padded to a common width: with bucketing, pos and neg are trimmed to their own widths
+        width = max(good_cands.size(1), bad_cands.size(1))
+        cands = torch.cat([F.pad(good_cands, (0, width - good_cands.size(1))),
+                           F.pad(bad_cands, (0, width - bad_cands.size(1)))])
+        with torch.no_grad():
+            teacher_scores = teacher.pairwise_scoring(teacher.query_encoding(qts), teacher.cand_encoding(cands))
+        student_scores = student.pairwise_scoring(student.query_encoding(qts), student.cand_encoding(cands))
+
+        diagonal = torch.arange(qts.size(0), device=student_scores.device)
+        good_sim = student_scores[diagonal, diagonal]
+        bad_sim = student_scores[diagonal, diagonal + qts.size(0)]
+        hard_loss = models.margin_loss(student.margin, good_sim, bad_sim)
+        soft_loss = distill_loss(student_scores, teacher_scores, self.conf['distill_scale'], self.conf['distill_temp'])
+        loss = self.conf['distill_alpha'] * hard_loss + (1.0 - self.conf['distill_alpha']) * soft_loss
+        return loss, good_sim, bad_sim
+
+    def distill(self, student, teacher, optimizer, writer):
+        """
+        Trains the student like CodeSearcher.train, on the distillation loss, keeping the best student by dev MRR.
+        """
+        log_every = self.conf['log_every']
+        valid_every = self.conf['valid_every']
+        nb_epoch = self.conf['nb_epoch']
+        max_patience = self.conf['patience']
+        ckpt_every = self.conf['ckpt_every']
+
+        data = load_qc_data(test=False, lang=self.conf["lang"], load_adv_neg={"train": "", "dev": "", "test": ""},
+                            train_percentage=self.conf["train_percentage"])
+        train_loader = make_train_loader(data["train"], self.conf['batch_size'], my_collate,
+                                         bucket=self.conf['bucket'] > 0, drop_last=False)
+
+        teacher = teacher.eval()  # batched pairwise scoring, and no dropout in the targets
+        checkpointer = Checkpointer(self.conf['checkpoint_directory'], keep=self.conf['keep_ckpt'])
+        start_epoch, start_itr, patience = 1, 0, 0
+        if self.conf['resume'] > 0 and checkpointer.latest() is not None:
+            start_epoch, start_itr, extra = checkpointer.restore(student, optimizer)
+            max_mrr, patience = extra["max_mrr"], extra["patience"]
+        else:
+            max_mrr = -1
+
+        evaluate = EvalCall(self.eval, 50, data["dev"])
+        validator = make_validator(student, evaluate, self.conf['async_valid'] > 0)
+
+        for epoch in range(start_epoch, nb_epoch):
+            itr, start_itr = start_itr + 1, 0
+            meter = TokenMeter()
+            losses, all_losses = [], []
+
+            student = student.train()
+
+            train_loader.batch_sampler.set_epoch(epoch, skip=itr - 1)
+            for batch in train_loader:
+                meter.update(batch)
+                qts, good_cands, bad_cands = gVar(batch["query"]), gVar(batch["pos"]), gVar(batch["neg"])
+
+                loss, good_scores, bad_scores = self.distill_step(student, teacher, qts, good_cands, bad_cands)
+
+                losses.append(loss.item())
+                all_losses.append(loss.item())
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                if itr % log_every == 0:
+                    print('epo:[%d/%d]  itr:%d  Loss=%.5f  %s' % (
+                        epoch, nb_epoch, itr, np.mean(losses), meter.report()))
+                    losses = []
+                if ckpt_every > 0 and itr % ckpt_every == 0:
+                    checkpointer.save(epoch, itr, student, optimizer, max_mrr=max_mrr, patience=patience)
+                itr = itr + 1
+
+            if writer is not None:
+                writer.add_scalar("Train/QC_distill_loss", np.mean(all_losses), epoch)
+
+            if epoch % valid_every == 0:
+                print("validating..")
+                validator.submit(epoch, student)
+            for valid_epoch, valid_model, (acc1, mrr, map, ndcg) in validator.results(wait=epoch == nb_epoch - 1):
+                if mrr > max_mrr:
+                    self.save_model(valid_model)
+                    patience = 0
+                    print("Model improved. Saved model at %d epoch" % valid_epoch)
+                    max_mrr = mrr
+                else:
+                    print("Model didn't improve for ", patience + 1, " epochs")
+                    patience += 1
+                if writer is not None:
+                    writer.add_scalar('Valid/QC_distill_MRR', mrr, valid_epoch)
+                    writer.add_scalar('Valid/QC_distill_MAP', map, valid_epoch)
+                    writer.add_scalar('Valid/QC_distill_nDCG', ndcg, valid_epoch)
+            checkpointer.save(epoch + 1, 0, student, optimizer, max_mrr=max_mrr, patience=patience)
+
+            if patience >= max_patience:
+                print("Patience Limit Reached. Stopping Training")
+                break
+        validator.close()
+        checkpointer.close()
+
+    def search_latency(self, model, qts, snippets, batch_size=256):
+        """
+        Mean time (s) to rank snippets for one query, their encodings computed beforehand: a vector per snippet
+        for the dual encoders, the token states for the attention model, which still scores every pair.
+        """
+        model = model.eval()
+        with torch.no_grad():
+            cands_repr = torch.cat([model.cand_encoding(gVar(snippets[start: start + batch_size]))
+                                    for start in range(0, snippets.size(0), batch_size)])
+            model.pairwise_scoring(model.query_encoding(gVar(qts[:1])), cands_repr)  # warm up
+            start = time.time()
+            for i in range(qts.size(0)):
+                model.pairwise_scoring(model.query_encoding(gVar(qts[i: i + 1])), cands_repr)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        return (time.time() - start) / qts.size(0)
+
+    def report(self, named_models, dataset, n_latency_query=20, n_latency_cand=256):
+        """
+        Compares models on the MRR of a dataset and on the latency of ranking n_latency_cand of its snippets.
+        :param named_models: [(name, model)], e.g. teacher, student and baseline
+        """
+        snippets, _, _ = self.collect_code_corpus([dataset])
+        snippets = snippets[:n_latency_cand]
+        qts = torch.stack([torch.as_tensor(dataset[i]["query"]) for i in range(min(n_latency_query, len(dataset)))])
+        rows = []
+        for name, model in named_models:
+            print("Evaluating %s..." % name)
+            acc, mrr, map, ndcg = self.eval(model, 50, dataset)
+            rows.append((name, acc, mrr, ndcg, self.search_latency(model, qts, snippets)))
+        print("Data %s, latency of ranking %d snippets for one query:" % (dataset.data_name, snippets.size(0)))
+        for name, acc, mrr, ndcg, latency in rows:
+            print("  %-8s ACC=%.4f  MRR=%.4f  nDCG=%.4f  %.2fms/query" % (name, acc, mrr, ndcg, latency * 1000.0))
+        return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Distill a trained attention QC model (models_w_attn.py) into a dual encoder QC "
+                                     "model (models.py).")
+    parser.add_argument("-m", "--mode", choices=["train", "report"], default="train",
+                        help="The `train` mode distills a student, then reports; the `report` mode compares the "
+                             "saved student with the teacher (and baseline) on the test set.")
+    parser.add_argument("--teacher_dir", type=str, required=True,
+                        help="Model directory of the attention QC model, holding its best_model.ckpt.")
+    parser.add_argument("--teacher_seqenc_packed", type=int, default=0,
+                        help="Whether the attention model runs on packed sequences (seqenc_packed>0).")
+    parser.add_argument("--baseline_dir", type=str, default="",
+                        help="Model directory of a dual encoder QC model of the same setup trained without the "
+                             "teacher, to report next to it.")
+    parser.add_argument("--init_student", type=int, default=0,
+                        help="Start the student from the baseline weights instead of from scratch, if init_student>0.")
+    parser.add_argument("--resume", type=int, default=0,
+                        help="Resume distillation from the latest full-state checkpoint, if resume>0.")
+    parser.add_argument("--ckpt_every", type=int, default=500,
+                        help="Iterations between full-state checkpoints, 0 for end of epoch only.")
+    parser.add_argument("--keep_ckpt", type=int, default=3, help="Number of full-state checkpoints kept.")
+    parser.add_argument("--temp", type=str, default="", help="Name of a temporary test (not affect saved model etc).")
+
+    # distillation
+    parser.add_argument("--alpha", type=float, default=0.5,
+                        help="Weight of the margin loss, 1 - alpha goes to matching the teacher scores.")
+    parser.add_argument("--distill_temp", type=float, default=1.0, help="Temperature of the teacher scores.")
+    parser.add_argument("--distill_scale", type=float, default=20.0, help="Student cosine -> logit scale.")
+
+    # model setup, shared by the teacher, the student and the baseline
+    parser.add_argument("--dropout", type=float, default=0.0, help="What is the dropout?", required=True)
+    parser.add_argument("--emb_size", type=int, default=100, help="What is the embedding size?", required=True)
+    parser.add_argument("--lstm_dims", type=int, default=200, help="What is the lstm dimension?", required=True)
+    parser.add_argument("--seqenc_packed", type=int, default=0,
+                        help="Run the student sequence encoders on packed sequences, if seqenc_packed>0.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--sparse_emb", type=int, default=0,
+                        help="Train the student embeddings with sparse gradients and SparseAdam, if sparse_emb>0.")
+    parser.add_argument("--batch_size", type=int, default=32, help="What is the batch size?", required=True)
+    parser.add_argument("--async_valid", type=int, default=0,
+                        help="Validate in a background process while training goes on, if async_valid>0.")
+    parser.add_argument("--bucket", type=int, default=0,
+                        help="Group training items of similar lengths into batches, if bucket>0.")
+    parser.add_argument("--lang", type=str, default="SQL", help="Which language dataset to use.")
+    parser.add_argument("--train_percentage", type=float, default=1.0,
+                        help="Percentage of training data to use.")
+    parser.add_argument("--lr", type=float, default=0.001, help="What is the learning rate?")
+    parser.add_argument("--margin", type=float, default=0.05, help="Margin for pairwise loss.")
+    parser.add_argument("--optimizer", type=str,
+                        choices=["adam", "adagrad", "sgd", "rmsprop", "asgd", "adadelta"],
+                        default="adam", help="Which optimizer to use?")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    conf = get_config(args)
+
+    conf['model'] = "qc"
+    conf['bow_dropout'] = args.dropout
+    conf['seqenc_dropout'] = args.dropout
+    conf['seqenc_packed'] = args.seqenc_packed > 0
+    conf['sparse_emb'] = args.sparse_emb > 0
+    conf['emb_size'] = args.emb_size
+    conf['lstm_dims'] = args.lstm_dims
+    conf['batch_size'] = args.batch_size
+    conf['bucket'] = args.bucket
+    conf['async_valid'] = args.async_valid
+    conf['lr'] = args.lr
+    conf['margin'] = args.margin
+    conf['resume'] = args.resume
+    conf['ckpt_every'] = args.ckpt_every
+    conf['keep_ckpt'] = args.keep_ckpt
+    conf['optimizer'] = args.optimizer
+    conf['train_percentage'] = args.train_percentage
+    conf['lang'] = args.lang
+    conf['distill_alpha'] = args.alpha
+    conf['distill_temp'] = args.distill_temp
+    conf['distill_scale'] = args.distill_scale
+
+    model_string = create_model_name_string(conf)
+    model_dir_str = "QC_distill" + ("_%s" % args.temp if args.temp else "")
+    conf['model_directory'] = os.path.join(conf['ckptdir'], model_dir_str, model_string)
+    conf['checkpoint_directory'] = os.path.join(conf['model_directory'], 'checkpoints')
+    if not os.path.exists(conf['model_directory']):
+        os.makedirs(conf['model_directory'])
+    print(" Model Directory : ")
+    print(conf['model_directory'])
+
+    searcher = DistillSearcher(conf)
+
+    teacher_conf = dict(conf, seqenc_packed=args.teacher_seqenc_packed > 0, sparse_emb=False)
+    teacher = models_w_attn.QCModel(teacher_conf)
+    searcher.load_other_model(teacher, args.teacher_dir)
+    student = models.QCModel(conf)
+    baseline = None
+    if args.baseline_dir:
+        baseline = models.QCModel(dict(conf, sparse_emb=False))
+        searcher.load_other_model(baseline, args.baseline_dir)
+        if args.init_student > 0:
+            searcher.load_other_model(student, args.baseline_dir)
+    if args.mode == "report":
+        searcher.load_model(student)
+
+    if torch.cuda.is_available():
+        print('using GPU')
+        teacher, student = teacher.cuda(), student.cuda()
+        baseline = baseline.cuda() if baseline is not None else None
+    else:
+        print('using CPU')
+
+    if args.mode == "train":
+        if conf['optimizer'] == 'adagrad':
+            optimizer = optim.Adagrad(dense_parameters(student), lr=conf['lr'])
+        elif conf['optimizer'] == 'sgd':
+            optimizer = optim.SGD(dense_parameters(student), lr=conf['lr'], momentum=0.9)
+        elif conf['optimizer'] == 'rmsprop':
+            optimizer = optim.RMSprop(dense_parameters(student), lr=conf['lr'])
+        elif conf['optimizer'] == 'asgd':
+            optimizer = optim.ASGD(dense_parameters(student), lr=conf['lr'])
+        elif conf['optimizer'] == 'adadelta':
+            optimizer = optim.Adadelta(dense_parameters(student), lr=conf['lr'])
+        else:
+            optimizer = optim.Adam(dense_parameters(student), lr=conf['lr'])
+        if conf['sparse_emb']:
+            optimizer = with_sparse_adam(optimizer, student)
+
+        conf['summary_directory'] = os.path.join(conf['sumdir'], model_dir_str, model_string)
+        print(" Summary Directory : " + conf['summary_directory'])
+        searcher.distill(student, teacher, optimizer, SummaryWriter(conf['summary_directory']))
+        searcher.load_model(student)  # the best student by dev MRR
+
+    data = load_qc_data(test=True, lang=args.lang)
+    named_models = [("teacher", teacher), ("student", student)]
+    if baseline is not None:
+        named_models.append(("baseline", baseline))
+    searcher.report(named_models, data["test"])
@@ -16,12 +16,12 @@ def get_rank(sims):
 
 def weighting_scores_codenn(data_name, pure_size, weight, sims_collection1, sims_collection2,
                      preprocess_collection1=None, preprocess_collection2=None, bool_by_run=False):
-    mrrs, accs, maps, ndcgs = [], [], [], []
     mrrs_per_run = defaultdict(list)
 
     run_idx = 1
     count = 0
 
+    rows, row_runs = [], []
     for collect_idx, (sims_list1, sims_list2) in enumerate(zip(sims_collection1, sims_collection2)):
         for idx in range(len(sims_list1)):
             item1 = np.array(sims_list1[idx])
@@ -40,22 +40,20 @@ def weighting_scores_codenn(data_name, pure_size, weight, sims_collection1, sims
                 denominator = sum(np.exp(item2))
                 item2 = np.exp(item2) / denominator
 
-            sims = weight * item1 + (1 - weight) * item2
-            predict = get_rank(sims)
-            real = [0]  # index of the positive sample
-
-            mrrs.append(MRR(real, predict))
-            accs.append(ACC(real, predict))
-            maps.append(MAP(real, predict))
-            ndcgs.append(NDCG(real, predict))
-
-            mrrs_per_run[run_idx].append(mrrs[-1])
+            rows.append(weight * item1 + (1 - weight) * item2)
+            row_runs.append(run_idx)
 
         count += 1
         if count == pure_size:
             count = 0
             run_idx += 1
 
+    # the positive sample is at index 0 of every row
+    sims, valid = stack_rows(rows)
+    accs, mrrs, maps, ndcgs = [list(x) for x in ranking_metrics(sims, np.ones(len(rows), dtype=int), valid)]
+    for run, mrr in zip(row_runs, mrrs):
+        mrrs_per_run[run].append(mrr)
+
     print("Data %s, weight %.3f:" % (data_name, weight))
     print('Size={}, ACC={}, MRR={}, MAP={}, nDCG={}'.format(
         len(mrrs), np.mean(accs), np.mean(mrrs), np.mean(maps), np.mean(ndcgs)))
@@ -74,9 +72,8 @@ def weighting_scores_codenn(data_name, pure_size, weight, sims_collection1, sims
 
 def weighting_scores_staqc(data_name, weight, sims_collection1, sims_collection2,
                            preprocess_collection1=None, preprocess_collection2=None):
-    mrrs, accs, maps, ndcgs = [], [], [], []
-
     counter = 0
+    rows, reals = [], []
     for collect_idx, (item1, item2) in enumerate(zip(sims_collection1, sims_collection2)):
         if counter == 50:
             counter = 0 #reset
@@ -97,17 +94,22 @@ def weighting_scores_staqc(data_name, weight, sims_collection1, sims_collection2
             denominator = sum(np.exp(item2))
             item2 = np.exp(item2) / denominator
 
-        sims = weight * item1 + (1 - weight) * item2
-        predict = get_rank(sims)
-        real = [counter]  # index of the positive sample
-
-        mrrs.append(MRR(real, predict))
-        accs.append(ACC(real, predict))
-        maps.append(MAP(real, predict))
-        ndcgs.append(NDCG(real, predict))
+        rows.append(weight * item1 + (1 - weight) * item2)
+        reals.append(counter)  # index of the positive sample
 
         counter += 1
 
+    # a positive index past the end of its row is never retrieved: all metrics stay 0
+    sims, valid = stack_rows(rows)
+    reals = np.array(reals)
+    hit = reals < valid.sum(1)
+    accs, mrrs, maps, ndcgs = [np.zeros(len(rows)) for _ in range(4)]
+    if hit.any():
+        pos_mask = np.zeros((hit.sum(), sims.shape[1]), dtype=bool)
+        pos_mask[np.arange(hit.sum()), reals[hit]] = True
+        accs[hit], mrrs[hit], maps[hit], ndcgs[hit] = ranking_metrics(sims[hit], pos_mask, valid[hit])
+    accs, mrrs, maps, ndcgs = list(accs), list(mrrs), list(maps), list(ndcgs)
+
     print("Data %s, weight %.3f:" % (data_name, weight))
     print('Size={}, ACC={}, MRR={}, MAP={}, nDCG={}'.format(
         len(mrrs), np.mean(accs), np.mean(mrrs), np.mean(maps), np.mean(ndcgs)))
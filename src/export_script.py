@@ -0,0 +1,174 @@
+from __future__ import print_function
+
+import os
+import json
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from configs import get_config
+from models import SeqEncoder, BOWEncoder, QCModel, CCModel, QQModel
+from scripted import META_FILE
+from checkpoint import load_weights
+
+MODELS = {"qc": QCModel, "cc": CCModel, "qq": QQModel}
+
+
+class ScriptSeqEncoder(nn.Module):
+    """
+    Inference-only, TorchScript-able copy of a SeqEncoder, sharing its weights. Token ids outside the vocabulary are
+    read as unknown words (id 1).
+    """
+    def __init__(self, encoder):
+        super(ScriptSeqEncoder, self).__init__()
+        self.embedding = encoder.embedding
+        self.lstm = encoder.lstm
+        self.vocab_size = encoder.embedding.num_embeddings
+        self.packed = bool(encoder.config['seqenc_packed'])
+
+    def forward(self, input):
+        # type: (Tensor) -> Tensor
+        input = input.masked_fill((input < 0) | (input >= self.vocab_size), 1)
+        if self.packed:
+            lengths = input.ne(0).sum(1).clamp(min=1)
+            max_len = int(lengths.max())
+            embedded = self.embedding(input[:, :max_len])
+            packed = pack_padded_sequence(embedded, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            packed_output, _ = self.lstm(packed)
+            rnn_output, _ = pad_packed_sequence(packed_output, batch_first=True, total_length=max_len)
+            padding = torch.arange(max_len, device=input.device)[None, :] >= lengths[:, None]
+            rnn_output = rnn_output.masked_fill(padding.unsqueeze(2), -float('inf'))
+        else:
+            rnn_output, _ = self.lstm(self.embedding(input))
+        return torch.tanh(rnn_output.max(1)[0])
+
+
+class ScriptBOWEncoder(nn.Module):
+    """Inference-only, TorchScript-able copy of a BOWEncoder, sharing its weights."""
+    def __init__(self, encoder):
+        super(ScriptBOWEncoder, self).__init__()
+        self.embedding = encoder.embedding
+        self.vocab_size = encoder.embedding.num_embeddings
+
+    def forward(self, input):
+        # type: (Tensor) -> Tensor
+        input = input.masked_fill((input < 0) | (input >= self.vocab_size), 1)
+        return torch.tanh(self.embedding(input).max(1)[0])
+
+
+def script_encoder(encoder):
+    if isinstance(encoder, SeqEncoder):
+        return ScriptSeqEncoder(encoder)
+    if isinstance(encoder, BOWEncoder):
+        return ScriptBOWEncoder(encoder)
+    raise ValueError("No scripted version of %s" % type(encoder).__name__)
+
+
+class ScriptModel(nn.Module):
+    """
+    The inference interface of a QC/CC/QQ model of models.py: query_encoding, cand_encoding, and cosine scoring of
+    encoded pairs (scoring) or of every query against every candidate (pairwise_scoring).
+    """
+    def __init__(self, model):
+        super(ScriptModel, self).__init__()
+        self.query_encoder = script_encoder(model.query_encoder)
+        self.cand_encoder = script_encoder(model.cand_encoder)
+
+    @torch.jit.export
+    def query_encoding(self, qt):
+        # type: (Tensor) -> Tensor
+        return self.query_encoder(qt)
+
+    @torch.jit.export
+    def cand_encoding(self, cand):
+        # type: (Tensor) -> Tensor
+        return self.cand_encoder(cand)
+
+    @torch.jit.export
+    def scoring(self, qt_repr, cand_repr):
+        # type: (Tensor, Tensor) -> Tensor
+        return torch.cosine_similarity(qt_repr, cand_repr, 1, 1e-8)
+
+    @torch.jit.export
+    def pairwise_scoring(self, qt_repr, cand_repr):
+        # type: (Tensor, Tensor) -> Tensor
+        qt_repr_norm = qt_repr / qt_repr.norm(2, 1)[:, None]
+        cand_repr_norm = cand_repr / cand_repr.norm(2, 1)[:, None]
+        return torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
+
+    def forward(self, qt, cand):
+        # type: (Tensor, Tensor) -> Tensor
+        return self.scoring(self.query_encoding(qt), self.cand_encoding(cand))
+
+
+def export_scripted(model, conf, model_name, path, checkpoint_sha1=""):
+    """
+    Compiles a model with TorchScript and saves it with its meta data, to be loaded by scripted.load_scripted.
+    :return: the scripted model, meta
+    """
+    model = model.cpu().eval()
+    # CC encodes code on both sides; QQ encodes questions on both sides
+    query_side = "code" if model_name == "cc" else "qt"
+    cand_side = "qt" if model_name == "qq" else "code"
+    meta = {"model_name": model_name, "checkpoint_sha1": checkpoint_sha1,
+            "query_n_words": model.query_encoder.embedding.num_embeddings, "query_len": conf["%s_len" % query_side],
+            "cand_n_words": model.cand_encoder.embedding.num_embeddings, "cand_len": conf["%s_len" % cand_side],
+            "dim": 2 * conf['lstm_dims'], "config": dict((key, conf[key]) for key in
+                                                     ["emb_size", "lstm_dims", "code_encoder", "seqenc_packed"])}
+    scripted = torch.jit.script(ScriptModel(model))
+    torch.jit.save(scripted, path, _extra_files={META_FILE: json.dumps(meta, sort_keys=True)})
+    return scripted, meta
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Export a trained QC/CC/QQ model as a self-contained TorchScript file.")
+    parser.add_argument("-M", "--model", choices=["qc", "cc", "qq"], default="qc", help="Which model to export.")
+    parser.add_argument("--reload_path", type=str, required=True,
+                        help="Enclosing folder of the model, e.g. ../checkpoint_qcwqq/QC.")
+    parser.add_argument("--out", type=str, default="", help="Default: <model directory>/scripted_model.pt.")
+
+    # model setup, to find the model directory as codesearcher.py names it
+    parser.add_argument("--dropout", type=float, default=0.0, help="What is the dropout?", required=True)
+    parser.add_argument("--emb_size", type=int, default=100, help="What is the embedding size?", required=True)
+    parser.add_argument("--lstm_dims", type=int, default=200, help="What is the lstm dimension?", required=True)
+    parser.add_argument("--seqenc_packed", type=int, default=0,
+                        help="Run the sequence encoders on packed sequences, skipping padding, if seqenc_packed>0.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--batch_size", type=int, default=32, help="What is the batch size?", required=True)
+    parser.add_argument("--lr", type=float, default=0.001, help="What is the learning rate?")
+    parser.add_argument("--optimizer", type=str,
+                        choices=["adam", "adagrad", "sgd", "rmsprop", "asgd", "adadelta"],
+                        default="adam", help="Which optimizer to use?")
+    parser.add_argument("--lang", type=str, default="SQL", help="Which language dataset to use.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from codesearcher import create_model_name_string
+    from build_index import file_sha1
+
+    args = parse_args()
+    conf = get_config(args)
+
+    conf['model'] = args.model
+    conf['bow_dropout'] = conf['seqenc_dropout'] = 0.0
+    conf['seqenc_packed'] = args.seqenc_packed > 0
+    conf['emb_size'] = args.emb_size
+    conf['lstm_dims'] = args.lstm_dims
+    conf['batch_size'] = args.batch_size
+    conf['lr'] = args.lr
+    conf['optimizer'] = args.optimizer
+    conf['lang'] = args.lang
+
+    conf['model_directory'] = os.path.join(args.reload_path, create_model_name_string(conf))
+    ckpt_path = os.path.join(conf['model_directory'], 'best_model.ckpt')
+    out = args.out or os.path.join(conf['model_directory'], "scripted_model.pt")
+
+    model = MODELS[args.model](conf)
+    load_weights(model, ckpt_path)
+    _, meta = export_scripted(model, conf, args.model, out, checkpoint_sha1=file_sha1(ckpt_path))
+    print("Scripted %s model saved to %s: %s" % (args.model.upper(), out, json.dumps(meta, sort_keys=True)))
@@ -17,6 +17,11 @@ from tensorboardX import SummaryWriter
 
 from utils import *
 from configs import get_config
+from batching import make_train_loader, TokenMeter
+from asyncval import make_validator, EvalCall
+from checkpoint import Checkpointer, save_state_dict, load_weights
+from sparseopt import dense_parameters, with_sparse_adam
+from scorecache import ScoreCache
 from data import load_qc_data, load_cc_data, load_qq_data, my_collate
 from models import *
 
@@ -45,15 +50,15 @@ class JointSearcher:
         if qc_model is not None:
             if not os.path.exists(self.conf['model_directory']['qc']):
                 os.makedirs(self.conf['model_directory']['qc'])
-            torch.save(qc_model.state_dict(), os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt'))
+            save_state_dict(qc_model.state_dict(), os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt'))
         if cc_model is not None:
             if not os.path.exists(self.conf['model_directory']['cc']):
                 os.makedirs(self.conf['model_directory']['cc'])
-            torch.save(cc_model.state_dict(), os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt'))
+            save_state_dict(cc_model.state_dict(), os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt'))
         if qq_model is not None:
             if not os.path.exists(self.conf['model_directory']['qq']):
                 os.makedirs(self.conf['model_directory']['qq'])
-            torch.save(qq_model.state_dict(), os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt'))
+            save_state_dict(qq_model.state_dict(), os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt'))
 
     def load_model(self, model):
         qc_model, cc_model, qq_model = None, None, None
@@ -63,15 +68,15 @@ class JointSearcher:
         if qc_model is not None:
             assert os.path.exists(os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt')), \
                 'Weights for saved qc model not found'
-            qc_model.load_state_dict(torch.load(os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt')))
+            load_weights(qc_model, os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt'))
         if cc_model is not None:
             assert os.path.exists(os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt')), \
                 'Weights for saved cc model not found'
-            cc_model.load_state_dict(torch.load(os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt')))
+            load_weights(cc_model, os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt'))
         if qq_model is not None:
             assert os.path.exists(os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt')), \
                 'Weights for saved qq model not found'
-            qq_model.load_state_dict(torch.load(os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt')))
+            load_weights(qq_model, os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt'))
 
     def load_other_model(self, model, model_path):
         qc_model, cc_model, qq_model = None, None, None
@@ -82,17 +87,17 @@ class JointSearcher:
             if not os.path.exists(os.path.join(model_path['qc'], 'best_model.ckpt')):
                 print('Weights for saved qc model not found')
             else:
-                qc_model.load_state_dict(torch.load(os.path.join(model_path['qc'], 'best_model.ckpt')))
+                load_weights(qc_model, os.path.join(model_path['qc'], 'best_model.ckpt'))
         if cc_model is not None:
             if not os.path.exists(os.path.join(model_path['cc'], 'best_model.ckpt')):
                 print('Weights for saved cc model not found')
             else:
-                cc_model.load_state_dict(torch.load(os.path.join(model_path['cc'], 'best_model.ckpt')))
+                load_weights(cc_model, os.path.join(model_path['cc'], 'best_model.ckpt'))
         if qq_model is not None:
             if not os.path.exists(os.path.join(model_path['qq'], 'best_model.ckpt')):
                 print('Weights for saved qq model not found')
             else:
-                qq_model.load_state_dict(torch.load(os.path.join(model_path['qq'], 'best_model.ckpt')))
+                load_weights(qq_model, os.path.join(model_path['qq'], 'best_model.ckpt'))
 
     ############
     # Training #
@@ -109,6 +114,7 @@ class JointSearcher:
         batch_size = self.conf['batch_size']
         nb_epoch = self.conf['nb_epoch']
         max_patience = self.conf['patience']
+        ckpt_every = self.conf['ckpt_every']
 
         # Load data
         assert (self.conf["model"] == "joint"), "For individual QC/CC/QQ model train/test, use codesearcher.py"
@@ -116,14 +122,20 @@ class JointSearcher:
                 "qq": load_qq_data(test=True, lang=self.conf["lang"], train_percentage=self.conf["train_percentage"])}
 
         train_loader = {
-            "qc": torch.utils.data.DataLoader(dataset=data["qc"]["train"], batch_size=batch_size, shuffle=True,
-                                              drop_last=True, num_workers=1, collate_fn=my_collate),
-            "qq": torch.utils.data.DataLoader(dataset=data["qq"]["train"], batch_size=batch_size, shuffle=True,
-                                              drop_last=True, num_workers=1, collate_fn=my_collate)
+            "qc": make_train_loader(data["qc"]["train"], batch_size, my_collate, bucket=self.conf['bucket'] > 0,
+                                    drop_last=True),
+            "qq": make_train_loader(data["qq"]["train"], batch_size, my_collate, bucket=self.conf['bucket'] > 0,
+                                    drop_last=True)
         }
 
+        # Full-state checkpoints; with resume > 0, training goes on from the latest one
+        checkpointer = Checkpointer(self.conf['checkpoint_directory'], keep=self.conf['keep_ckpt'])
+        start_epoch, start_itr, patience = self.conf['reload'] + 1, 0, 0
+        if self.conf['resume'] > 0 and checkpointer.latest() is not None:
+            start_epoch, start_itr, extra = checkpointer.restore(model, optimizer)
+            max_mrr, patience = extra["max_mrr"], extra["patience"]
         # MRR for the Best Saved model, if reload > 0, else -1
-        if self.conf['reload'] > 0:
+        elif self.conf['reload'] > 0:
             _, max_mrr, max_map, max_ndcg = searcher.eval(model, args.pool_size, {k: v["dev"] for k, v in data.items()})
             if writer is not None:
                 for k in max_mrr.keys():
@@ -133,20 +145,31 @@ class JointSearcher:
         else:
             max_mrr = {"qc": -1, "cc": -1, "qq": -1}
 
-        patience = 0
-        for epoch in range(self.conf['reload'] + 1, nb_epoch):
-            itr = 1
+        # Dev and test evaluation, in a worker process with async_valid, which gets only the dev and test splits
+        evaluate = EvalCall(self.eval_dev_test, args.pool_size,
+                            {k: {"dev": v["dev"], "test": v["test"]} for k, v in data.items()})
+        validator = make_validator(model, evaluate, self.conf['async_valid'] > 0)
+
+        for epoch in range(start_epoch, nb_epoch):
+            itr, start_itr = start_itr + 1, 0
+            meter = TokenMeter()
             losses = {"qc1": [], "qc2": [], "cc1": [], "cc2": [], "qq1": [], "qq2": []}
             all_losses = {"qc1": [], "qc2": [], "cc1": [], "cc2": [], "qq1": [], "qq2": []}
             all_losses_new = {"qc_on_qq_data1": [], "qq_on_qq_data1": [], "qc_on_qq_data2": [], "qq_on_qq_data2": [],
                               "qq_on_qc_data1": [], "qc_on_qc_data1": [], "qq_on_qc_data2": [], "qc_on_qc_data2": []}
             all_qq_on_qc_weight1, all_qq_on_qc_weight2, all_qc_on_qq_weight1, all_qc_on_qq_weight2 = [], [], [], []
 
-            # Update QC model
-            if self.conf["update_qc"] > 0:
+            # Update QC model; after a resume, only the batches of the epoch not trained yet
+            if self.conf["update_qc"] > 0 and itr - 1 < len(train_loader["qc"]):
                 model["qc"].train()
                 model["qq"].eval()
+                if self.conf["score_cache"] > 0:
+                    qq_cache = ScoreCache.build(data["qc"]["train"], {"query": ("query", model["qq"].query_encoding),
+                                                                      "cand": ("query", model["qq"].cand_encoding)},
+                                                my_collate)
+                train_loader["qc"].batch_sampler.set_epoch(epoch, skip=itr - 1)
                 for qc_batch in train_loader["qc"]:
+                    meter.update(qc_batch)
 
                     # Get data from the batch
                     # (qc_pos_q, qc_pos_c) are paired; (qc_neg_q, qc_neg_c) are paired;
@@ -156,25 +179,44 @@ class JointSearcher:
                         gVar(qc_pos_q), gVar(qc_neg_q), gVar(qc_pos_c), gVar(qc_neg_c)
                     collision = None
 
+                    # Encode each batch tensor once; adversarial pairs are selected from the encodings
+                    qc_pos_q_repr = model["qc"].query_encoding(qc_pos_q)
+                    qc_neg_q_repr = model["qc"].query_encoding(qc_neg_q)
+                    qc_pos_c_repr = model["qc"].cand_encoding(qc_pos_c)
+                    qc_neg_c_repr = model["qc"].cand_encoding(qc_neg_c)
+
                     # Score and sample negative q with c using QC model
-                    sampled, sim = model["qc"].sample_query(qc_neg_q, qc_pos_c, collision=collision, if_norm=True)
-                    adv_q_with_c_by_qc = torch.index_select(qc_neg_q, 0, sampled.squeeze())
-                    adv_c_with_c_by_qc = torch.index_select(qc_neg_c, 0, sampled.squeeze())
+                    sampled_with_c, sim = model["qc"].sample_from_repr(qc_pos_c_repr, qc_neg_q_repr,
+                                                                       collision=collision, if_norm=True)
+                    sampled_with_c = sampled_with_c.squeeze(1)
 
                     # Score and sample negative c with q using the QC model
-                    sampled, sim = model["qc"].sample_cand(qc_pos_q, qc_neg_c, collision=collision, if_norm=True)
-                    adv_q_with_q_by_qc = torch.index_select(qc_neg_q, 0, sampled.squeeze())
-                    adv_c_with_q_by_qc = torch.index_select(qc_neg_c, 0, sampled.squeeze())
-
-                    # Score the adversarial pairs using QQ model
-                    qq_loss_on_qc_data1, pos_scores1, neg_scores1 = model["qq"](qc_pos_q, qc_pos_q, adv_q_with_c_by_qc)
-                    qq_loss_on_qc_data2, pos_scores2, neg_scores2 = model["qq"](qc_pos_q, qc_pos_q, adv_q_with_q_by_qc)
+                    sampled_with_q, sim = model["qc"].sample_from_repr(qc_pos_q_repr, qc_neg_c_repr,
+                                                                       collision=collision, if_norm=True)
+                    sampled_with_q = sampled_with_q.squeeze(1)
+
+                    # Score the adversarial pairs using QQ model, which only weighs the QC loss
+                    with torch.no_grad():
+                        if self.conf["score_cache"] > 0:
+                            qq_query_repr = qq_cache.lookup("query", qc_batch["query_offset"])
+                            qq_pos_repr = qq_cache.lookup("cand", qc_batch["query_offset"])
+                            qq_neg_repr = qq_cache.lookup("cand", qc_batch["rand_offset"])
+                        else:
+                            qq_query_repr = model["qq"].query_encoding(qc_pos_q)
+                            qq_pos_repr = model["qq"].cand_encoding(qc_pos_q)
+                            qq_neg_repr = model["qq"].cand_encoding(qc_neg_q)
+                        qq_loss_on_qc_data1, pos_scores1, neg_scores1 = model["qq"].forward_repr(
+                            qq_query_repr, qq_pos_repr, qq_neg_repr.index_select(0, sampled_with_c))
+                        qq_loss_on_qc_data2, pos_scores2, neg_scores2 = model["qq"].forward_repr(
+                            qq_query_repr, qq_pos_repr, qq_neg_repr.index_select(0, sampled_with_q))
                     all_losses_new["qq_on_qc_data1"].append(qq_loss_on_qc_data1.mean().item())
                     all_losses_new["qq_on_qc_data2"].append(qq_loss_on_qc_data2.mean().item())
 
                     # Score the adversarial pairs using QC model
-                    qc_loss_on_qc_data1, _, _ = model["qc"](qc_pos_q, qc_pos_c, adv_c_with_c_by_qc)
-                    qc_loss_on_qc_data2, _, _ = model["qc"](qc_pos_q, qc_pos_c, adv_c_with_q_by_qc)
+                    qc_loss_on_qc_data1, _, _ = model["qc"].forward_repr(qc_pos_q_repr, qc_pos_c_repr,
+                                                                         qc_neg_c_repr.index_select(0, sampled_with_c))
+                    qc_loss_on_qc_data2, _, _ = model["qc"].forward_repr(qc_pos_q_repr, qc_pos_c_repr,
+                                                                         qc_neg_c_repr.index_select(0, sampled_with_q))
                     all_losses_new["qc_on_qc_data1"].append(qc_loss_on_qc_data1.mean().item())
                     all_losses_new["qc_on_qc_data2"].append(qc_loss_on_qc_data2.mean().item())
 
@@ -208,20 +250,29 @@ class JointSearcher:
                     optimizer["qc"].step()
 
                     if itr % log_every == 0:
-                        print('epo:[%d/%d]  itr:%d  QC Loss=%.2E+%.2E CC Loss=%.2E+%.2E' % (
+                        print('epo:[%d/%d]  itr:%d  QC Loss=%.2E+%.2E CC Loss=%.2E+%.2E  %s' % (
                             epoch, nb_epoch, itr,
                             np.mean(losses["qc1"]) if losses["qc1"] else -1,
                             np.mean(losses["qc2"]) if losses["qc2"] else -1,
                             np.mean(losses["qq1"]) if losses["qq1"] else -1,
-                            np.mean(losses["qq2"]) if losses["qq2"] else -1))
+                            np.mean(losses["qq2"]) if losses["qq2"] else -1, meter.report()))
                         losses = {"qc1": [], "qc2": [], "cc1": [], "cc2": [], "qq1": [], "qq2": []}
+                    if ckpt_every > 0 and itr % ckpt_every == 0:
+                        checkpointer.save(epoch, itr, model, optimizer, max_mrr=max_mrr, patience=patience)
                     itr = itr + 1
 
             # Update QQ model
             if self.conf["update_qq"] > 0:
                 model["qc"].eval()
                 model["qq"].train()
+                if self.conf["score_cache"] > 0:
+                    qc_cache = ScoreCache.build(data["qq"]["train"], {"query": ("query", model["qc"].query_encoding),
+                                                                      "pos": ("pos", model["qc"].query_encoding)},
+                                                my_collate)
+                qc_batches = len(train_loader["qc"]) if self.conf["update_qc"] > 0 else 0
+                train_loader["qq"].batch_sampler.set_epoch(epoch, skip=itr - 1 - qc_batches)
                 for qq_batch in train_loader["qq"]:
+                    meter.update(qq_batch)
 
                     # Get data from the batch
                     # (qq_pos_q, qq_pos_c) are paired; (qq_neg_q, qq_neg_c) are paired;
@@ -232,33 +283,56 @@ class JointSearcher:
 
                     collision = None
 
+                    # Encode each batch tensor once; adversarial pairs are selected from the encodings
+                    qq_pos_q_repr = model["qq"].query_encoding(qq_pos_q)
+                    qq_neg_q_repr = model["qq"].query_encoding(qq_neg_q)
+                    qq_pos_c_repr = model["qq"].cand_encoding(qq_pos_c)
+                    qq_neg_c_repr = model["qq"].cand_encoding(qq_neg_c)
+
                     # Score and sample negative q with c using QQ model
-                    sampled, sim = model["qq"].sample_query(qq_neg_q, qq_pos_c, collision=collision, if_norm=True)
-                    adv_q_with_c_by_qq = torch.index_select(qq_neg_q, 0, sampled.squeeze())
-                    adv_c_with_c_by_qq = torch.index_select(qq_neg_c, 0, sampled.squeeze())
+                    sampled_with_c, sim = model["qq"].sample_from_repr(qq_pos_c_repr, qq_neg_q_repr,
+                                                                       collision=collision, if_norm=True)
+                    sampled_with_c = sampled_with_c.squeeze(1)
 
                     # Score and sample negative c with q using the QQ model
-                    sampled, sim = model["qq"].sample_cand(qq_pos_q, qq_neg_c, collision=collision, if_norm=True)
-                    adv_q_with_q_by_qq = torch.index_select(qq_neg_q, 0, sampled.squeeze())
-                    adv_c_with_q_by_qq = torch.index_select(qq_neg_c, 0, sampled.squeeze())
-
-                    # Score the adversarial pairs using QC model
-                    if True:
-                      qc_loss_on_qq_data1, pos_scores1, neg_scores1 = model["qc"].qq_with_qc(qq_pos_q, qq_pos_c,
-                                                                                             adv_c_with_q_by_qq)
-                      qc_loss_on_qq_data2, pos_scores2, neg_scores2 = model["qc"].qq_with_qc(qq_pos_q, qq_pos_c,
-                                                                                             adv_c_with_c_by_qq)
-                    else:
-                      qc_loss_on_qq_data1, pos_scores1, neg_scores1 = model["qc"].qq_with_qc(qq_pos_q, qq_pos_c,
-                                                                                             adv_q_with_c_by_qq)
-                      qc_loss_on_qq_data2, pos_scores2, neg_scores2 = model["qc"].qq_with_qc(qq_pos_q, qq_pos_c,
-                                                                                             adv_q_with_q_by_qq)
+                    sampled_with_q, sim = model["qq"].sample_from_repr(qq_pos_q_repr, qq_neg_c_repr,
+                                                                       collision=collision, if_norm=True)
+                    sampled_with_q = sampled_with_q.squeeze(1)
+
+                    # Score the adversarial pairs using QC model, which only weighs the QQ loss
+                    with torch.no_grad():
+                      if self.conf["score_cache"] > 0:
+                        qc_query_repr = qc_cache.lookup("query", qq_batch["query_offset"])
+                        qc_pos_repr = qc_cache.lookup("pos", qq_batch["query_offset"])
+                      else:
+                        qc_query_repr = model["qc"].query_encoding(qq_pos_q)
+                        qc_pos_repr = model["qc"].query_encoding(qq_pos_c)
+                      if True:
+                        if self.conf["score_cache"] > 0:
+                          qc_neg_repr = qc_cache.lookup("pos", qq_batch["rand_offset"])
+                        else:
+                          qc_neg_repr = model["qc"].query_encoding(qq_neg_c)
+                        qc_loss_on_qq_data1, pos_scores1, neg_scores1 = model["qc"].forward_repr(
+                          qc_query_repr, qc_pos_repr, qc_neg_repr.index_select(0, sampled_with_q))
+                        qc_loss_on_qq_data2, pos_scores2, neg_scores2 = model["qc"].forward_repr(
+                          qc_query_repr, qc_pos_repr, qc_neg_repr.index_select(0, sampled_with_c))
+                      else:
+                        if self.conf["score_cache"] > 0:
+                          qc_neg_repr = qc_cache.lookup("query", qq_batch["rand_offset"])
+                        else:
+                          qc_neg_repr = model["qc"].query_encoding(qq_neg_q)
+                        qc_loss_on_qq_data1, pos_scores1, neg_scores1 = model["qc"].forward_repr(
+                          qc_query_repr, qc_pos_repr, qc_neg_repr.index_select(0, sampled_with_c))
+                        qc_loss_on_qq_data2, pos_scores2, neg_scores2 = model["qc"].forward_repr(
+                          qc_query_repr, qc_pos_repr, qc_neg_repr.index_select(0, sampled_with_q))
                     all_losses_new["qc_on_qq_data1"].append(qc_loss_on_qq_data1.mean().item())
                     all_losses_new["qc_on_qq_data2"].append(qc_loss_on_qq_data2.mean().item())
 
                     # Score the adversarial pairs using QQ model
-                    qq_loss_on_qq_data1, _, _ = model["qq"](qq_pos_q, qq_pos_c, adv_c_with_c_by_qq)
-                    qq_loss_on_qq_data2, _, _ = model["qq"](qq_pos_q, qq_pos_c, adv_c_with_q_by_qq)
+                    qq_loss_on_qq_data1, _, _ = model["qq"].forward_repr(qq_pos_q_repr, qq_pos_c_repr,
+                                                                         qq_neg_c_repr.index_select(0, sampled_with_c))
+                    qq_loss_on_qq_data2, _, _ = model["qq"].forward_repr(qq_pos_q_repr, qq_pos_c_repr,
+                                                                         qq_neg_c_repr.index_select(0, sampled_with_q))
                     all_losses_new["qq_on_qq_data1"].append(qq_loss_on_qq_data1.mean().item())
                     all_losses_new["qq_on_qq_data2"].append(qq_loss_on_qq_data2.mean().item())
 
@@ -295,13 +369,15 @@ class JointSearcher:
                     optimizer["qq"].step()
 
                     if itr % log_every == 0:
-                        print('epo:[%d/%d]  itr:%d  QC Loss=%.2E+%.2E CC Loss=%.2E+%.2E' % (
+                        print('epo:[%d/%d]  itr:%d  QC Loss=%.2E+%.2E CC Loss=%.2E+%.2E  %s' % (
                             epoch, nb_epoch, itr,
                             np.mean(losses["qc1"]) if losses["qc1"] else -1,
                             np.mean(losses["qc2"]) if losses["qc2"] else -1,
                             np.mean(losses["qq1"]) if losses["qq1"] else -1,
-                            np.mean(losses["qq2"]) if losses["qq2"] else -1))
+                            np.mean(losses["qq2"]) if losses["qq2"] else -1, meter.report()))
                         losses = {"qc1": [], "qc2": [], "cc1": [], "cc2": [], "qq1": [], "qq2": []}
+                    if ckpt_every > 0 and itr % ckpt_every == 0:
+                        checkpointer.save(epoch, itr, model, optimizer, max_mrr=max_mrr, patience=patience)
                     itr = itr + 1
 
             print('epo:[%d/%d] QC Loss=%.2E+%.2E CC Loss=%.2E+%.2E' % (
@@ -336,34 +412,45 @@ class JointSearcher:
             model_monitored = ["qc", "qq"]
             if epoch % valid_every == 0:
                 print("validating..")
-                acc1, mrr, map, ndcg = self.eval(model, args.pool_size, {k: v["dev"] for k, v in data.items()})
+                validator.submit(epoch, model)
+            for valid_epoch, valid_model, (acc1, mrr, map, ndcg) in validator.results(wait=epoch == nb_epoch - 1):
                 model_to_save = {}
                 for k in mrr.keys():
                     if writer is not None:
-                        writer.add_scalar('Valid/%s_MRR' % k.upper(), mrr[k], epoch)
-                        writer.add_scalar('Valid/%s_MAP' % k.upper(), map[k], epoch)
-                        writer.add_scalar('Valid/%s_nDCG' % k.upper(), ndcg[k], epoch)
+                        writer.add_scalar('Valid/%s_MRR' % k.upper(), mrr[k], valid_epoch)
+                        writer.add_scalar('Valid/%s_MAP' % k.upper(), map[k], valid_epoch)
+                        writer.add_scalar('Valid/%s_nDCG' % k.upper(), ndcg[k], valid_epoch)
                     model_to_save[k] = None
                     if k in model_monitored and mrr[k] > max_mrr[k]:
                         max_mrr[k] = mrr[k]
-                        model_to_save[k] = model[k]
-                        print("%s model improved. Saving at %d epoch." % (k.upper(), epoch))
+                        model_to_save[k] = valid_model[k]
+                        print("%s model improved. Saving at %d epoch." % (k.upper(), valid_epoch))
                         patience = 0
                 if all([x is None for x in model_to_save.values()]):
                     print("Model didn't improve for ", patience + 1, " epochs")
                     patience += 1
                 else:
                     self.save_model(model_to_save)
-
-            self.eval(model, args.pool_size, {k: v["test"] for k, v in data.items()}, msg="test")
+            checkpointer.save(epoch + 1, 0, model, optimizer, max_mrr=max_mrr, patience=patience)
 
             if patience >= max_patience:
                 print("Patience Limit Reached. Stopping Training")
                 break
+        validator.close()
+        checkpointer.close()
 
     #######################
     # Evaluation on StaQC #
     #######################
+    def eval_dev_test(self, model, poolsize, data):
+        """
+        Evaluates on the dev and test sets.
+        :return: the dev Accuracy, MRR, MAP, nDCG; test results are only printed
+        """
+        results = self.eval(model, poolsize, {k: v["dev"] for k, v in data.items()})
+        self.eval(model, poolsize, {k: v["test"] for k, v in data.items()}, msg="test")
+        return results
+
     def eval(self, model, poolsize, dataset, bool_collect=False, write_qual=False, msg=""):
         assert (set(model.keys()) == set(dataset.keys())), "model and dataset have mismatched keys."
         acc, mrr, map, ndcg = {}, {}, {}, {}
@@ -397,37 +484,30 @@ class JointSearcher:
         for batch in data_loader:
 
             qts, cands, all_pos = batch["query"], batch["pos"], batch["all_pos"]
-            qts, cands = gVar(qts), gVar(cands)
-            qts_repr = model.query_encoding(qts)
-            cands_repr = model.cand_encoding(cands)
-
-            all_pos_number = [x.size(0) for x in all_pos]
-            all_pos_stack = torch.cat(all_pos)
-            all_pos_stack = gVar(all_pos_stack)
-            all_pos_repr = model.cand_encoding(all_pos_stack)
-            all_pos_repr = torch.split(all_pos_repr, all_pos_number)
-
             _poolsize = len(qts) if bool_collect else min(poolsize, len(qts))  # true poolsize
-            for i in range(_poolsize):
-                cands_repr_w_all_pos = torch.cat([all_pos_repr[i], cands_repr[:i], cands_repr[i+1:]])
-                _qts_repr = qts_repr[i].expand(cands_repr_w_all_pos.size(0), -1)
-                scores = model.scoring(_qts_repr, cands_repr_w_all_pos).data.cpu().numpy()
-                neg_scores = np.negative(scores)
-                predict = np.argsort(neg_scores)
-                predict = [int(k) for k in predict]
-                real = list(range(all_pos_repr[i].size(0)))  # index of positive sample
-                accs.append(ACC(real, predict))
-                mrrs.append(MRR(real, predict))
-                maps.append(MAP(real, predict))
-                ndcgs.append(NDCG(real, predict))
-                sims_collection.append(scores)
-
-                if f_qual is not None:
-                    self._print_qualitative(f_qual=f_qual, qvocab=dataset.qvocab, cvocab=dataset.cvocab,
-                                            query=qts[i].tolist(), pos=all_pos[i].tolist(),
-                                            neg=(cands[:i].tolist() + cands[i+1:].tolist()),
-                                            labels=real, preds=scores,
-                                            MRR=mrrs[-1], MAP=maps[-1], nDCG=ndcgs[-1])
+            all_pos_number = [x.size(0) for x in all_pos[:_poolsize]]
+
+            with torch.no_grad():
+                qts_repr = model.query_encoding(gVar(qts[:_poolsize]))
+                cands_repr = model.cand_encoding(gVar(cands))
+                all_pos_repr = model.cand_encoding(gVar(torch.cat(all_pos[:_poolsize])))
+                scores, valid, pos_mask = score_pool(model, qts_repr, cands_repr, all_pos_repr, all_pos_number)
+
+            batch_accs, batch_mrrs, batch_maps, batch_ndcgs = ranking_metrics(scores, pos_mask, valid)
+            accs.extend(batch_accs)
+            mrrs.extend(batch_mrrs)
+            maps.extend(batch_maps)
+            ndcgs.extend(batch_ndcgs)
+
+            if bool_collect or f_qual is not None:
+                for i in range(_poolsize):
+                    sims_collection.append(scores[i][valid[i]])
+                    if f_qual is not None:
+                        self._print_qualitative(f_qual=f_qual, qvocab=dataset.qvocab, cvocab=dataset.cvocab,
+                                                query=qts[i].tolist(), pos=all_pos[i].tolist(),
+                                                neg=(cands[:i].tolist() + cands[i+1:].tolist()),
+                                                labels=list(range(all_pos_number[i])), preds=sims_collection[-1],
+                                                MRR=batch_mrrs[i], MAP=batch_maps[i], nDCG=batch_ndcgs[i])
 
         if bool_collect:
             save_path = os.path.join(self.conf['model_directory'], "collect_sims_staqc_%s.pkl" % dataset.data_name)
@@ -463,6 +543,11 @@ def parse_args():
                         required=True)
     parser.add_argument("--qc_reload_path", type=str, default="", help="Enclosing folder of the to-be-reloaded model.")
     parser.add_argument("--qq_reload_path", type=str, default="", help="Enclosing folder of the to-be-reloaded model.")
+    parser.add_argument("--resume", type=int, default=0,
+                        help="Resume training from the latest full-state checkpoint, if resume>0.")
+    parser.add_argument("--ckpt_every", type=int, default=500,
+                        help="Iterations between full-state checkpoints (0: only at the end of every epoch).")
+    parser.add_argument("--keep_ckpt", type=int, default=3, help="Number of full-state checkpoints kept.")
 
     # model setup
     parser.add_argument("--update_qc", type=int, default=1, help="If update QC model?", required=True)
@@ -470,7 +555,21 @@ def parse_args():
     parser.add_argument("--dropout", type=float, default=0.0, help="What is the dropout?", required=True)
     parser.add_argument("--emb_size", type=int, default=100, help="What is the embedding size?", required=True)
     parser.add_argument("--lstm_dims", type=int, default=200, help="What is the lstm dimension?", required=True)
+    parser.add_argument("--seqenc_packed", type=int, default=0,
+                        help="Run the sequence encoders on packed sequences, skipping padding, if seqenc_packed>0.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--sparse_emb", type=int, default=0,
+                        help="Sparse embedding gradients, trained with SparseAdam, if sparse_emb>0.")
     parser.add_argument("--batch_size", type=int, default=32, help="What is the batch size?", required=True)
+    parser.add_argument("--score_cache", type=int, default=0,
+                        help="Score with encodings of the frozen model cached once per phase, if score_cache>0.")
+    parser.add_argument("--async_valid", type=int, default=0,
+                        help="Run the dev and test evaluation in a worker process while training goes on, "
+                             "if async_valid>0.")
+    parser.add_argument("--bucket", type=int, default=0,
+                        help="Batch training items of similar lengths and trim their padding, if bucket>0.")
     parser.add_argument("--temp", type=str, default="", help="Name of a temporary test (not affect saved model etc).")
 
     # dataset setup
@@ -514,9 +613,14 @@ if __name__ == '__main__':
     conf['model'] = args.model
     conf['bow_dropout'] = args.dropout
     conf['seqenc_dropout'] = args.dropout
+    conf['seqenc_packed'] = args.seqenc_packed > 0
+    conf['sparse_emb'] = args.sparse_emb > 0
     conf['emb_size'] = args.emb_size
     conf['lstm_dims'] = args.lstm_dims
     conf['batch_size'] = args.batch_size
+    conf['bucket'] = args.bucket
+    conf['async_valid'] = args.async_valid
+    conf['score_cache'] = args.score_cache
     conf['lr'] = args.lr
     conf['qc_lr'] = args.qc_lr
     conf['qq_lr'] = args.qq_lr
@@ -526,6 +630,9 @@ if __name__ == '__main__':
     conf['qc_reload_path'] = args.qc_reload_path
     conf['cc_reload_path'] = args.cc_reload_path
     conf['qq_reload_path'] = args.qq_reload_path
+    conf['resume'] = args.resume
+    conf['ckpt_every'] = args.ckpt_every
+    conf['keep_ckpt'] = args.keep_ckpt
     conf['optimizer'] = args.optimizer
     conf['update_qc'] = args.update_qc
     conf['update_cc'] = args.update_cc
@@ -562,6 +669,7 @@ if __name__ == '__main__':
             "qc": os.path.join(conf['ckptdir'], 'QC_%s' % model_dir_str, model_string),
             "cc": os.path.join(conf['ckptdir'], 'CC_%s' % model_dir_str, model_string),
             "qq": os.path.join(conf['ckptdir'], 'QQ_%s' % model_dir_str, model_string)}
+        conf['checkpoint_directory'] = os.path.join(conf['ckptdir'], model_dir_str, model_string, 'checkpoints')
 
         if conf['qc_reload_path'] and conf['cc_reload_path'] and conf['qq_reload_path']:
             conf['reload_model_directory'] = {
@@ -621,31 +729,33 @@ if __name__ == '__main__':
         print("")
 
         if conf['optimizer'] == 'adagrad':
-            optimizer = {"qc": optim.Adagrad(model["qc"].parameters(), lr=conf['lr']),
-                         "qq": optim.Adagrad(model["qq"].parameters(), lr=conf['lr'])}
+            optimizer = {"qc": optim.Adagrad(dense_parameters(model["qc"]), lr=conf['lr']),
+                         "qq": optim.Adagrad(dense_parameters(model["qq"]), lr=conf['lr'])}
             print("Recommend lr 0.01 for AdaGrad while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'sgd':
-            optimizer = {"qc": optim.SGD(model["qc"].parameters(), lr=conf['lr'], momentum=0.9),
-                         "qq": optim.SGD(model["qq"].parameters(), lr=conf['lr'], momentum=0.9)}
+            optimizer = {"qc": optim.SGD(dense_parameters(model["qc"]), lr=conf['lr'], momentum=0.9),
+                         "qq": optim.SGD(dense_parameters(model["qq"]), lr=conf['lr'], momentum=0.9)}
             print("Recommend lr 0.1 for SGD (momentum 0.9) while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'rmsprop':
-            optimizer = {"qc": optim.RMSprop(model["qc"].parameters(), lr=conf['lr']),
-                         "qq": optim.RMSprop(model["qq"].parameters(), lr=conf['lr'])}
+            optimizer = {"qc": optim.RMSprop(dense_parameters(model["qc"]), lr=conf['lr']),
+                         "qq": optim.RMSprop(dense_parameters(model["qq"]), lr=conf['lr'])}
             print("Recommend lr 0.01 for RMSprop while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'asgd':
-            optimizer = {"qc": optim.ASGD(model["qc"].parameters(), lr=conf['lr']),
-                         "qq": optim.ASGD(model["qq"].parameters(), lr=conf['lr'])}
+            optimizer = {"qc": optim.ASGD(dense_parameters(model["qc"]), lr=conf['lr']),
+                         "qq": optim.ASGD(dense_parameters(model["qq"]), lr=conf['lr'])}
             print("Recommend lr 0.01 for ASGD while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'adadelta':
-            optimizer = {"qc": optim.Adadelta(model["qc"].parameters(), lr=conf['lr']),
-                         "qq": optim.Adadelta(model["qq"].parameters(), lr=conf['lr'])}
+            optimizer = {"qc": optim.Adadelta(dense_parameters(model["qc"]), lr=conf['lr']),
+                         "qq": optim.Adadelta(dense_parameters(model["qq"]), lr=conf['lr'])}
             print("Recommend lr 1.00 for Adadelta while using %.5f." % conf['lr'])
         else:
-            optimizer = {"qc": optim.Adam(model["qc"].parameters(), lr=(
+            optimizer = {"qc": optim.Adam(dense_parameters(model["qc"]), lr=(
                                 conf['qc_lr'] if conf['qc_lr'] > 0 else conf['lr'])),
-                         "qq": optim.Adam(model["qq"].parameters(), lr=(
+                         "qq": optim.Adam(dense_parameters(model["qq"]), lr=(
                                 conf['qq_lr'] if conf['qq_lr'] > 0 else conf['lr']))}
             print("Recommend lr 0.001 for Adam while using %.5f." % conf['lr'])
+        if conf['sparse_emb']:
+            optimizer = with_sparse_adam(optimizer, model)
 
         if args.mode == 'train':
             print('Training Model')
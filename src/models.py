@@ -5,14 +5,245 @@ import torch
 import torch.nn as nn
 import torch.nn.init as weight_init
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import pdb
 
 
+def length_aware_lstm(lstm, embedded, lengths):
+    """
+    Runs a single-layer, bidirectional, batch-first LSTM over the first lengths[i] steps of each sequence only.
+    Without gradients the sequences are packed. With gradients, where the packed backward pass is slow on CPU,
+    each direction runs on the padded batch, the reverse one on every sequence flipped within its length.
+    :return: outputs [batch_size x seq_len x 2*hidden_size], zero past the length of each sequence, and the
+             padding mask [batch_size x seq_len]
+    """
+    batch_size, seq_len, _ = embedded.size()
+    steps = torch.arange(seq_len, device=embedded.device)[None, :]
+    padding = steps >= lengths[:, None]
+    if not torch.is_grad_enabled():
+        packed = pack_padded_sequence(embedded, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        rnn_output, _ = lstm(packed)
+        rnn_output, _ = pad_packed_sequence(rnn_output, batch_first=True, total_length=seq_len)
+        return rnn_output, padding
+
+    hx = (embedded.new_zeros(1, batch_size, lstm.hidden_size),) * 2
+    flip = torch.where(padding, steps, lengths[:, None] - 1 - steps).unsqueeze(2)  # [batch_size x seq_len x 1]
+    forward = torch.lstm(embedded, hx, [lstm.weight_ih_l0, lstm.weight_hh_l0, lstm.bias_ih_l0, lstm.bias_hh_l0],
+                         True, 1, 0.0, lstm.training, False, True)[0]
+    backward = torch.lstm(embedded.gather(1, flip.expand_as(embedded)), hx,
+                          [lstm.weight_ih_l0_reverse, lstm.weight_hh_l0_reverse,
+                           lstm.bias_ih_l0_reverse, lstm.bias_hh_l0_reverse],
+                          True, 1, 0.0, lstm.training, False, True)[0]
+    backward = backward.gather(1, flip.expand_as(backward))
+    rnn_output = torch.cat([forward, backward], 2).masked_fill(padding.unsqueeze(2), 0)
+    return rnn_output, padding
+
+
+def sample_negatives(pw_sim, n_sample=1, temperature=1.0, collision=None):
+    """
+    Draws n_sample distinct columns of every row of a pairwise similarity matrix in one batched call, each with
+    probability proportional to exp(pw_sim / temperature), by Gumbel top-k; columns set in collision are never drawn.
+    :return: sampled column indices [n_row x n_sample]
+    """
+    logits = pw_sim.detach() / temperature
+    if collision is not None:
+        logits = logits.masked_fill(collision, -float('inf'))
+    gumbel = -torch.empty_like(logits).exponential_().log()
+    return (logits + gumbel).topk(n_sample, dim=1)[1]
+
+
+def sample_scores(pw_sim, n_sample=1, temperature=1.0, collision=None, if_norm=False):
+    """
+    Samples negatives from a pairwise similarity matrix and scores them.
+    :return: sampled [n_row x n_sample], and their similarities, or sampling probabilities if if_norm,
+             [n_row] for a single sample else [n_row x n_sample]
+    """
+    sampled = sample_negatives(pw_sim, n_sample, temperature, collision)
+    if if_norm:
+        logits = pw_sim / temperature
+        if collision is not None:
+            logits = logits.masked_fill(collision, -float('inf'))
+        pw_sim = F.softmax(logits, 1)
+    sim = torch.gather(pw_sim, 1, sampled)
+    return sampled, sim.squeeze(1) if n_sample == 1 else sim
+
+
+def margin_loss(margin, good_sim, bad_sim):
+    """pairwise hinge loss; bad_sim is [batch_size], or [batch_size x n_neg] for several negatives per query"""
+    if bad_sim.dim() > good_sim.dim():
+        good_sim = good_sim.unsqueeze(1)
+    return (margin - good_sim + bad_sim).clamp(min=1e-6).mean()
+
+
+def token_keys(tokens):
+    """int64 hash of every row of token ids (padding does not change it), to recognize copies of a snippet"""
+    powers = torch.full((tokens.size(1),), 1000003, dtype=torch.long, device=tokens.device).cumprod(0)
+    return (tokens.long() * powers).sum(1)
+
+
+def in_batch_collision(good_keys, cand_keys):
+    """
+    [n_qt x n_cand] mask of the candidates that are a copy of the positive of a query, other than its own (column
+    i for query i): false negatives of the in-batch softmax. Rows are compared by their token keys (token_keys),
+    so that candidates trimmed to different widths compare too.
+    """
+    collision = good_keys[:, None] == cand_keys[None, :]
+    diagonal = torch.arange(good_keys.size(0), device=collision.device)
+    collision[diagonal, diagonal] = False
+    return collision
+
+
+def infonce_loss(logits, collision=None):
+    """
+    In-batch softmax (InfoNCE) loss of a [n_qt x n_cand] score matrix whose column i is the positive of query i,
+    every other column a negative; columns set in collision are left out.
+    :return: loss, positive scores [n_qt], and the score of the hardest negative of every query [n_qt]
+    """
+    diagonal = torch.arange(logits.size(0), device=logits.device)
+    if collision is not None:
+        logits = logits.masked_fill(collision, -float('inf'))
+    loss = F.cross_entropy(logits, diagonal)
+    negatives = logits.detach().clone()
+    negatives[diagonal, diagonal] = -float('inf')
+    return loss, logits[diagonal, diagonal], negatives.max(1)[0]
+
+
+def in_batch_forward(model, qt, good_cand, bad_cand, to_logits):
+    """
+    loss='infonce' forward of a model: every query is scored against the positives of the whole batch, and also
+    against their explicit negatives only with infonce_neg, saving the encoder pass on them otherwise. With a
+    negative queue, the queued candidates are negatives too.
+    :param to_logits: scores of model.pairwise_scoring -> logits
+    """
+    qt_repr, cand_repr = model.query_encoding(qt), model.cand_encoding(good_cand)
+    good_keys = cand_keys = token_keys(good_cand)
+    if model.conf['infonce_neg']:  # encoded apart: pos and neg may be trimmed to different widths (bucketing)
+        cand_repr = torch.cat([cand_repr, model.cand_encoding(bad_cand)])
+        cand_keys = torch.cat([cand_keys, token_keys(bad_cand)])
+    pw_sim = model.pairwise_scoring(qt_repr, cand_repr)
+    collision = in_batch_collision(good_keys, cand_keys) if model.conf['infonce_collision'] else None
+    pw_sim, collision = queue_scores(model, qt_repr, good_cand, pw_sim, collision)
+    loss, good_sim, bad_sim = infonce_loss(to_logits(pw_sim), collision)
+    enqueue(model, cand_repr, cand_keys)
+    return loss, good_sim, bad_sim
+
+
+class NegativeQueue:
+    """
+    FIFO memory bank of the detached, L2-normalized encodings of the latest `size` training candidates, with the
+    token keys of each. The queued candidates serve as extra negatives without being encoded again, so the pool
+    negatives are drawn from grows with the queue instead of the batch (config queue_size).
+
+    The candidates of a step are written into the bank at the next use of the queue, i.e. after the backward pass
+    of that step, which still reads the bank as it was in the forward pass.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.reprs, self.keys = None, None  # allocated on the device of the first candidates
+        self.n, self.ptr = 0, 0
+        self.pending = None  # (encodings, keys) of the last step, not written yet
+
+    def __getstate__(self):  # copies of a model (e.g. for async validation) get an empty queue
+        state = dict(self.__dict__)
+        state["reprs"], state["keys"], state["n"], state["ptr"], state["pending"] = None, None, 0, 0, None
+        return state
+
+    def __len__(self):
+        return min(self.n + (self.pending[1].size(0) if self.pending is not None else 0), self.size)
+
+    def state_dict(self):
+        self.flush()
+        return {"reprs": self.reprs, "keys": self.keys, "n": self.n, "ptr": self.ptr}
+
+    def load_state_dict(self, state, device=None):
+        """:param device: where to put the buffers, those of the state by default"""
+        self.reprs, self.keys = state["reprs"], state["keys"]
+        if self.reprs is not None and device is not None:
+            self.reprs, self.keys = self.reprs.to(device), self.keys.to(device)
+        self.n, self.ptr = state["n"], state["ptr"]
+        self.pending = None
+
+    def enqueue(self, cand_repr, keys):
+        """
+        :param cand_repr: [n x dim] encodings of candidates
+        :param keys: [n] token keys of the candidates, see token_keys
+        """
+        self.flush()
+        self.pending = (cand_repr.detach()[-self.size:], keys[-self.size:])
+
+    def flush(self):
+        """writes the pending candidates into the bank"""
+        if self.pending is None:
+            return
+        cand_repr, keys = self.pending
+        self.pending = None
+        if self.reprs is None:
+            self.reprs = cand_repr.new_zeros((self.size, cand_repr.size(1)))
+            self.keys = keys.new_zeros(self.size)
+        rows = (self.ptr + torch.arange(keys.size(0), device=keys.device)) % self.size
+        self.reprs[rows] = cand_repr / cand_repr.norm(dim=1)[:, None]
+        self.keys[rows] = keys
+        self.ptr = (self.ptr + keys.size(0)) % self.size
+        self.n = min(self.n + keys.size(0), self.size)
+
+    def scores(self, qt_repr, good_cand):
+        """
+        :return: cosine similarities [n_qt x len(self)] of the queries with the queued candidates, and the mask of
+                 the queued copies of the positive of each query
+        """
+        self.flush()
+        qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
+        sim = torch.mm(qt_repr_norm, self.reprs[:self.n].t())
+        return sim, token_keys(good_cand)[:, None] == self.keys[None, :self.n]
+
+
+def use_queue(model):
+    return model.training and getattr(model, 'neg_queue', None) is not None and len(model.neg_queue) > 0
+
+
+def queue_scores(model, qt_repr, good_cand, pw_sim=None, collision=None):
+    """
+    Appends the similarities of the queries with the negative queue of a model in training, if any, to pw_sim.
+    :param pw_sim: [n_qt x n_cand] in-batch similarities, or None
+    :param collision: [n_qt x n_cand] mask of pw_sim entries that are not negatives, or None
+    :return: similarities [n_qt x (n_cand + len(queue))] and their collision mask
+    """
+    if not use_queue(model):
+        return pw_sim, collision
+    queue_sim, queue_collision = model.neg_queue.scores(qt_repr, good_cand)
+    if pw_sim is None:
+        return queue_sim, queue_collision
+    if collision is None:
+        collision = torch.zeros_like(pw_sim, dtype=torch.bool)
+    return torch.cat([pw_sim, queue_sim], 1), torch.cat([collision, queue_collision], 1)
+
+
+def enqueue(model, cand_repr, keys):
+    """adds the candidates encoded in a training step, with their token keys, to the negative queue of the model"""
+    if model.training and getattr(model, 'neg_queue', None) is not None:
+        model.neg_queue.enqueue(cand_repr, keys)
+
+
+def queue_forward(model, qt_repr, good_cand, good_cand_repr, bad_cand, bad_cand_repr, good_sim, bad_sim):
+    """
+    Margin loss terms of a forward, with n_neg negatives per query sampled from the negative queue (at temperature
+    queue_temp) next to the given bad_sim, and the encoded candidates queued.
+    """
+    if use_queue(model):
+        pw_sim, collision = queue_scores(model, qt_repr, good_cand)
+        _, queued_sim = sample_scores(pw_sim, model.conf['n_neg'], model.conf['queue_temp'], collision)
+        bad_sim = torch.cat([bad_sim.view(good_sim.size(0), -1), queued_sim.view(good_sim.size(0), -1)], 1)
+    # pos and neg may be trimmed to different widths (bucketing): their keys are computed apart
+    enqueue(model, torch.cat([good_cand_repr, bad_cand_repr]), torch.cat([token_keys(good_cand), token_keys(bad_cand)]))
+    loss = margin_loss(model.margin, good_sim, bad_sim)
+    return loss, good_sim, bad_sim
+
+
 class BOWEncoder(nn.Module):
     def __init__(self, vocab_size, emb_size, config):
         super(BOWEncoder, self).__init__()
         self.emb_size = emb_size
-        self.embedding = nn.Embedding(vocab_size, emb_size)
+        self.embedding = nn.Embedding(vocab_size, emb_size, sparse=config['sparse_emb'])
         self.config = config
 
     def forward(self, input):
@@ -31,13 +262,15 @@ class SeqEncoder(nn.Module):
         self.hidden_size = hidden_size
         self.config = config
 
-        self.embedding = nn.Embedding(vocab_size, emb_size, padding_idx=0)
+        self.embedding = nn.Embedding(vocab_size, emb_size, padding_idx=0, sparse=config['sparse_emb'])
         self.lstm = nn.LSTM(emb_size, hidden_size, batch_first=True, bidirectional=True)
         for w in self.lstm.parameters():  # initialize the gate weights with orthogonal
             if w.dim() > 1:
                 weight_init.xavier_normal_(w)
 
     def forward(self, input):
+        if self.config['seqenc_packed']:
+            return self.forward_packed(input)
         batch_size, seq_len = input.size()
         embedded = self.embedding(input)  # input: [batch_sz x seq_len]  embedded: [batch_sz x seq_len x emb_sz]
         embedded = F.dropout(embedded, self.config['seqenc_dropout'], self.training)
@@ -48,6 +281,19 @@ class SeqEncoder(nn.Module):
 
         return encoding
 
+    def forward_packed(self, input):
+        """Length-aware forward: the LSTM stops at the last non-padding token and padding is left out of the pooling."""
+        lengths = input.ne(0).sum(1).clamp(min=1)  # an all-padding input still gets one step
+        max_len = int(lengths.max())
+        embedded = self.embedding(input[:, :max_len])
+        embedded = F.dropout(embedded, self.config['seqenc_dropout'], self.training)
+        rnn_output, padding = length_aware_lstm(self.lstm, embedded, lengths)
+        rnn_output = F.dropout(rnn_output, self.config['seqenc_dropout'], self.training)
+        output_pool = rnn_output.masked_fill(padding.unsqueeze(2), -float('inf')).max(1)[0]
+        encoding = torch.tanh(output_pool)
+
+        return encoding
+
 
 class QCModel(nn.Module):
     def __init__(self, config):
@@ -56,6 +302,7 @@ class QCModel(nn.Module):
 
         self.conf = config
         self.margin = config['margin']
+        self.neg_queue = NegativeQueue(config['queue_size']) if config['queue_size'] > 0 else None
         self.query_encoder = SeqEncoder(config['qt_n_words'], config['emb_size'], config['lstm_dims'], self.conf)
 
         if self.conf['code_encoder'] == "bilstm":
@@ -75,24 +322,17 @@ class QCModel(nn.Module):
     def scoring(self, qt_repr, cand_repr):
         sim = F.cosine_similarity(qt_repr, cand_repr)
         return sim
-    
-    def cross_scoring(self, qt_repr, cand_repr):
 
-        # Get pairwise cosine similarity
+    def pairwise_scoring(self, qt_repr, cand_repr):
+        # Score every query against every candidate: [n_qt x n_cand]
         qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
         cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-        pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
-
-        # Sample probability (not sum to one)
-        temperature = 1
-        exp_pw_sim = torch.exp(pw_sim.data/temperature)
-        sampled = []
-        for x in range(exp_pw_sim.size(0)):
-          y = torch.multinomial(exp_pw_sim[x], 1)
-          sampled.append(y)
+        return torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
 
-        # Choose sampled as negative instance
-        sim = torch.gather(pw_sim, 1, torch.stack(sampled)).squeeze(1)
+    def cross_scoring(self, qt_repr, cand_repr, n_neg=1):
+        # Choose n_neg negative instances per query, sampled by pairwise cosine similarity
+        pw_sim = self.pairwise_scoring(qt_repr, cand_repr)
+        _, sim = sample_scores(pw_sim, n_neg, temperature=1.0)
         return sim
 
     def get_scores(self, qt, cand):
@@ -105,88 +345,30 @@ class QCModel(nn.Module):
         pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
         return pw_sim
 
-    def sample_cand(self, qt, cand, collision=None, if_norm=False):
-        qt_repr = self.query_encoding(qt)
-        cand_repr = self.cand_encoding(cand)
-
-        # Get pairwise cosine similarity
-        qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
-        cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-        pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
-
-        # Sample probability (not sum to one)
-        temperature = 0.2
-        exp_pw_sim = torch.exp(pw_sim / temperature)
-
-        # sample
-        if collision is not None:
-            # pw_sim = pw_sim.masked_fill(collision, 0)
-            exp_pw_sim = exp_pw_sim.masked_fill(collision, 0)
-
-        sampled = torch.multinomial(exp_pw_sim.data, 1)
-        if if_norm:
-            norm_exp_pw_sim = exp_pw_sim / exp_pw_sim.sum(1, keepdim=True)
-            sim = torch.gather(norm_exp_pw_sim, 1, sampled).squeeze(1)
-        else:
-            sim = torch.gather(pw_sim, 1, sampled).squeeze(1)
-
-        return sampled, sim
+    def sample_from_repr(self, qt_repr, cand_repr, collision=None, if_norm=False, n_sample=1):
+        # Sample candidates for every query from already encoded batches: [n_qt x n_sample]
+        pw_sim = self.pairwise_scoring(qt_repr, cand_repr)
+        return sample_scores(pw_sim, n_sample, 0.2, collision, if_norm)
 
-    def sample_query(self, qt, cand, collision=None, if_norm=False):
-        qt_repr = self.query_encoding(qt)
-        cand_repr = self.cand_encoding(cand)
+    def sample_cand(self, qt, cand, collision=None, if_norm=False, n_sample=1):
+        return self.sample_from_repr(self.query_encoding(qt), self.cand_encoding(cand), collision, if_norm, n_sample)
 
-        # Get pairwise cosine similarity
-        qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
-        cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-        pw_sim = torch.mm(cand_repr_norm, qt_repr_norm.transpose(0, 1))
+    def sample_query(self, qt, cand, collision=None, if_norm=False, n_sample=1):
+        return self.sample_from_repr(self.cand_encoding(cand), self.query_encoding(qt), collision, if_norm, n_sample)
 
-        # Sample probability (not sum to one)
-        temperature = 0.2
-        exp_pw_sim = torch.exp(pw_sim / temperature)
+    def sample_cand_cc_with_qc(self, qt, cand, collision=None, if_norm=False, n_sample=1):
+        return self.sample_from_repr(self.cand_encoding(qt), self.cand_encoding(cand), collision, if_norm, n_sample)
 
-        # sample
-        if collision is not None:
-            # pw_sim = pw_sim.masked_fill(collision, 0)
-            exp_pw_sim = exp_pw_sim.masked_fill(collision, 0)
-
-        sampled = torch.multinomial(exp_pw_sim.data, 1)
-        if if_norm:
-            norm_exp_pw_sim = exp_pw_sim / exp_pw_sim.sum(1, keepdim=True)
-            sim = torch.gather(norm_exp_pw_sim, 1, sampled).squeeze(1)
-        else:
-            sim = torch.gather(pw_sim, 1, sampled).squeeze(1)
-
-        return sampled, sim
-
-    def sample_cand_cc_with_qc(self, qt, cand, collision=None, if_norm=False):
-        qt_repr = self.cand_encoding(qt)
-        cand_repr = self.cand_encoding(cand)
-
-        # Get pairwise cosine similarity
-        qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
-        cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-        pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
-
-        # Sample probability (not sum to one)
-        temperature = 0.2
-        exp_pw_sim = torch.exp(pw_sim / temperature)
-
-        # sample
-        if collision is not None:
-            # pw_sim = pw_sim.masked_fill(collision, 0)
-            exp_pw_sim = exp_pw_sim.masked_fill(collision, 0)
-
-        sampled = torch.multinomial(exp_pw_sim.data, 1)
-        if if_norm:
-            norm_exp_pw_sim = exp_pw_sim / exp_pw_sim.sum(1, keepdim=True)
-            sim = torch.gather(norm_exp_pw_sim, 1, sampled).squeeze(1)
-        else:
-            sim = torch.gather(pw_sim, 1, sampled).squeeze(1)
-
-        return sampled, sim
+    def forward_repr(self, qt_repr, good_cand_repr, bad_cand_repr):
+        # Pairwise loss of already encoded batches, e.g. to score several negative sets with one encoding
+        good_sim = self.scoring(qt_repr, good_cand_repr)
+        bad_sim = self.scoring(qt_repr, bad_cand_repr)
+        loss = margin_loss(self.margin, good_sim, bad_sim)
+        return loss, good_sim, bad_sim
 
     def forward(self, qt, good_cand, bad_cand, adversarial_sample=False):
+        if self.conf['loss'] == 'infonce' and not adversarial_sample:
+            return in_batch_forward(self, qt, good_cand, bad_cand, lambda sim: sim * self.conf['infonce_scale'])
         good_cand_repr = self.cand_encoding(good_cand)
         bad_cand_repr = self.cand_encoding(bad_cand)
 
@@ -196,10 +378,9 @@ class QCModel(nn.Module):
         if not adversarial_sample:
           bad_sim = self.scoring(qt_repr, bad_cand_repr)
         else:
-          bad_sim = self.cross_scoring(qt_repr, bad_cand_repr)
+          bad_sim = self.cross_scoring(qt_repr, bad_cand_repr, n_neg=self.conf['n_neg'])
 
-        loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
-        return loss, good_sim, bad_sim
+        return queue_forward(self, qt_repr, good_cand, good_cand_repr, bad_cand, bad_cand_repr, good_sim, bad_sim)
 
     def fwd_w_negq(self, qt, good_cand, bad_qt, adversarial_sample=False):
         qt_repr = self.query_encoding(qt)
@@ -210,9 +391,9 @@ class QCModel(nn.Module):
         if not adversarial_sample:
           bad_sim = self.scoring(bad_qt_repr, good_cand_repr)
         else:
-          bad_sim = self.cross_scoring(bad_qt_repr, good_cand_repr)
+          bad_sim = self.cross_scoring(bad_qt_repr, good_cand_repr, n_neg=self.conf['n_neg'])
 
-        loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
+        loss = margin_loss(self.margin, good_sim, bad_sim)
         return loss, good_sim, bad_sim
 
     def cc_with_qc(self, qt, good_cand, bad_cand, adversarial_sample=False):
@@ -225,9 +406,9 @@ class QCModel(nn.Module):
         if not adversarial_sample:
           bad_sim = self.scoring(qt_repr, bad_cand_repr)
         else:
-          bad_sim = self.cross_scoring(qt_repr, bad_cand_repr)
+          bad_sim = self.cross_scoring(qt_repr, bad_cand_repr, n_neg=self.conf['n_neg'])
 
-        loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
+        loss = margin_loss(self.margin, good_sim, bad_sim)
         return loss, good_sim, bad_sim
 
     def qq_with_qc(self, qt, good_cand, bad_cand, adversarial_sample=False):
@@ -240,9 +421,9 @@ class QCModel(nn.Module):
         if not adversarial_sample:
           bad_sim = self.scoring(qt_repr, bad_cand_repr)
         else:
-          bad_sim = self.cross_scoring(qt_repr, bad_cand_repr)
+          bad_sim = self.cross_scoring(qt_repr, bad_cand_repr, n_neg=self.conf['n_neg'])
 
-        loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
+        loss = margin_loss(self.margin, good_sim, bad_sim)
         return loss, good_sim, bad_sim
 
 
@@ -254,6 +435,7 @@ class CCModel(nn.Module):
 
         self.conf = config
         self.margin = config['margin']
+        self.neg_queue = NegativeQueue(config['queue_size']) if config['queue_size'] > 0 else None
 
         if self.conf['code_encoder'] == "bilstm":
             self.query_encoder = SeqEncoder(config['code_n_words'], config['emb_size'], config['lstm_dims'], self.conf)
@@ -274,53 +456,36 @@ class CCModel(nn.Module):
         sim = F.cosine_similarity(code_repr, cand_repr)
         return sim
 
-    def _cross_scoring(self, code_repr, cand_repr):
-
-        # Get pairwise cosine similarity
+    def pairwise_scoring(self, code_repr, cand_repr):
+        # Score every code query against every candidate: [n_code x n_cand]
         code_repr_norm = code_repr / code_repr.norm(dim=1)[:, None]
         cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-        pw_sim = torch.mm(code_repr_norm, cand_repr_norm.transpose(0, 1))
-
-        # Sample probability (not sum to one)
-        temperature = 1
-        exp_pw_sim = torch.exp(pw_sim.data / temperature)
-        sampled = []
-        for x in range(exp_pw_sim.size(0)):
-            y = torch.multinomial(exp_pw_sim[x], 1)
-            sampled.append(y)
-
-        # Choose sampled as negative instance
-        sim = torch.gather(pw_sim, 1, torch.stack(sampled)).squeeze(1)
-        return sim
+        return torch.mm(code_repr_norm, cand_repr_norm.transpose(0, 1))
 
-    def sample_cand(self, code, cand, collision=None, if_norm=False):
-        code_repr = self.query_encoding(code)
-        cand_repr = self.cand_encoding(cand)
-
-        # Get pairwise cosine similarity
-        code_repr_norm = code_repr / code_repr.norm(dim=1)[:, None]
-        cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-        pw_sim = torch.mm(code_repr_norm, cand_repr_norm.transpose(0, 1))
+    def _cross_scoring(self, code_repr, cand_repr, n_neg=1):
+        # Choose n_neg negative instances per query, sampled by pairwise cosine similarity
+        pw_sim = self.pairwise_scoring(code_repr, cand_repr)
+        _, sim = sample_scores(pw_sim, n_neg, temperature=1.0)
+        return sim
 
-        # Sample probability (not sum to one)
-        temperature = 1
-        exp_pw_sim = torch.exp(pw_sim / temperature)
+    def sample_from_repr(self, code_repr, cand_repr, collision=None, if_norm=False, n_sample=1):
+        # Sample candidates for every code query from already encoded batches: [n_code x n_sample]
+        pw_sim = self.pairwise_scoring(code_repr, cand_repr)
+        return sample_scores(pw_sim, n_sample, 1.0, collision, if_norm)
 
-        # sample
-        if collision is not None:
-            # pw_sim = pw_sim.masked_fill(collision, 0)
-            exp_pw_sim = exp_pw_sim.masked_fill(collision, 0)
+    def sample_cand(self, code, cand, collision=None, if_norm=False, n_sample=1):
+        return self.sample_from_repr(self.query_encoding(code), self.cand_encoding(cand), collision, if_norm, n_sample)
 
-        sampled = torch.multinomial(exp_pw_sim.data, 1)
-        if if_norm:
-            norm_exp_pw_sim = exp_pw_sim / exp_pw_sim.sum(1, keepdim=True)
-            sim = torch.gather(norm_exp_pw_sim, 1, sampled).squeeze(1)
-        else:
-            sim = torch.gather(pw_sim, 1, sampled).squeeze(1)
-
-        return sampled, sim
+    def forward_repr(self, code_repr, good_cand_repr, bad_cand_repr):
+        # Pairwise loss of already encoded batches
+        good_sim = self.scoring(code_repr, good_cand_repr)
+        bad_sim = self.scoring(code_repr, bad_cand_repr)
+        loss = margin_loss(self.margin, good_sim, bad_sim)
+        return loss, good_sim, bad_sim
 
     def forward(self, code, good_cand, bad_cand, adversarial_sample=False):
+        if self.conf['loss'] == 'infonce' and not adversarial_sample:
+            return in_batch_forward(self, code, good_cand, bad_cand, lambda sim: sim * self.conf['infonce_scale'])
         good_cand_repr = self.cand_encoding(good_cand)
         bad_cand_repr = self.cand_encoding(bad_cand)
 
@@ -330,10 +495,9 @@ class CCModel(nn.Module):
         if not adversarial_sample:
             bad_sim = self.scoring(code_repr, bad_cand_repr)
         else:
-            bad_sim = self._cross_scoring(code_repr, bad_cand_repr)
+            bad_sim = self._cross_scoring(code_repr, bad_cand_repr, n_neg=self.conf['n_neg'])
 
-        loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
-        return loss, good_sim, bad_sim
+        return queue_forward(self, code_repr, good_cand, good_cand_repr, bad_cand, bad_cand_repr, good_sim, bad_sim)
 
 
 class QQModel(nn.Module):
@@ -343,6 +507,7 @@ class QQModel(nn.Module):
 
         self.conf = config
         self.margin = config['margin']
+        self.neg_queue = NegativeQueue(config['queue_size']) if config['queue_size'] > 0 else None
         self.query_encoder = SeqEncoder(config['qt_n_words'], config['emb_size'], config['lstm_dims'], self.conf)
         self.cand_encoder = SeqEncoder(config['qt_n_words'], config['emb_size'], config['lstm_dims'], self.conf)
 
@@ -358,26 +523,28 @@ class QQModel(nn.Module):
         sim = F.cosine_similarity(qt_repr, cand_repr)
         return sim
 
-    def cross_scoring(self, qt_repr, cand_repr):
-
-        # Get pairwise cosine similarity
+    def pairwise_scoring(self, qt_repr, cand_repr):
+        # Score every query against every candidate: [n_qt x n_cand]
         qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
         cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-        pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
-
-        # Sample probability (not sum to one)
-        temperature = 1
-        exp_pw_sim = torch.exp(pw_sim.data / temperature)
-        sampled = []
-        for x in range(exp_pw_sim.size(0)):
-            y = torch.multinomial(exp_pw_sim[x], 1)
-            sampled.append(y)
+        return torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
 
-        # Choose sampled as negative instance
-        sim = torch.gather(pw_sim, 1, torch.stack(sampled)).squeeze(1)
+    def cross_scoring(self, qt_repr, cand_repr, n_neg=1):
+        # Choose n_neg negative instances per query, sampled by pairwise cosine similarity
+        pw_sim = self.pairwise_scoring(qt_repr, cand_repr)
+        _, sim = sample_scores(pw_sim, n_neg, temperature=1.0)
         return sim
 
+    def forward_repr(self, qt_repr, good_cand_repr, bad_cand_repr):
+        # Pairwise loss of already encoded batches
+        good_sim = self.scoring(qt_repr, good_cand_repr)
+        bad_sim = self.scoring(qt_repr, bad_cand_repr)
+        loss = margin_loss(self.margin, good_sim, bad_sim)
+        return loss, good_sim, bad_sim
+
     def forward(self, qt, good_cand, bad_cand, adversarial_sample=False):
+        if self.conf['loss'] == 'infonce' and not adversarial_sample:
+            return in_batch_forward(self, qt, good_cand, bad_cand, lambda sim: sim * self.conf['infonce_scale'])
         good_cand_repr = self.cand_encoding(good_cand)
         bad_cand_repr = self.cand_encoding(bad_cand)
 
@@ -387,61 +554,17 @@ class QQModel(nn.Module):
         if not adversarial_sample:
             bad_sim = self.scoring(qt_repr, bad_cand_repr)
         else:
-            bad_sim = self.cross_scoring(qt_repr, bad_cand_repr)
+            bad_sim = self.cross_scoring(qt_repr, bad_cand_repr, n_neg=self.conf['n_neg'])
 
-        loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
-        return loss, good_sim, bad_sim
-
-    def sample_cand(self, qt, cand, collision=None, if_norm=False):
-        qt_repr = self.query_encoding(qt)
-        cand_repr = self.cand_encoding(cand)
+        return queue_forward(self, qt_repr, good_cand, good_cand_repr, bad_cand, bad_cand_repr, good_sim, bad_sim)
 
-        # Get pairwise cosine similarity
-        qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
-        cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-        pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
-
-        # Sample probability (not sum to one)
-        temperature = 0.2
-        exp_pw_sim = torch.exp(pw_sim / temperature)
-
-        # sample
-        if collision is not None:
-            # pw_sim = pw_sim.masked_fill(collision, 0)
-            exp_pw_sim = exp_pw_sim.masked_fill(collision, 0)
-
-        sampled = torch.multinomial(exp_pw_sim.data, 1)
-        if if_norm:
-            norm_exp_pw_sim = exp_pw_sim / exp_pw_sim.sum(1, keepdim=True)
-            sim = torch.gather(norm_exp_pw_sim, 1, sampled).squeeze(1)
-        else:
-            sim = torch.gather(pw_sim, 1, sampled).squeeze(1)
+    def sample_from_repr(self, qt_repr, cand_repr, collision=None, if_norm=False, n_sample=1):
+        # Sample candidates for every query from already encoded batches: [n_qt x n_sample]
+        pw_sim = self.pairwise_scoring(qt_repr, cand_repr)
+        return sample_scores(pw_sim, n_sample, 0.2, collision, if_norm)
 
-        return sampled, sim
-
-    def sample_query(self, qt, cand, collision=None, if_norm=False):
-        qt_repr = self.query_encoding(qt)
-        cand_repr = self.cand_encoding(cand)
-
-        # Get pairwise cosine similarity
-        qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
-        cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-        pw_sim = torch.mm(cand_repr_norm, qt_repr_norm.transpose(0, 1))
-
-        # Sample probability (not sum to one)
-        temperature = 0.2
-        exp_pw_sim = torch.exp(pw_sim / temperature)
-
-        # sample
-        if collision is not None:
-            # pw_sim = pw_sim.masked_fill(collision, 0)
-            exp_pw_sim = exp_pw_sim.masked_fill(collision, 0)
-
-        sampled = torch.multinomial(exp_pw_sim.data, 1)
-        if if_norm:
-            norm_exp_pw_sim = exp_pw_sim / exp_pw_sim.sum(1, keepdim=True)
-            sim = torch.gather(norm_exp_pw_sim, 1, sampled).squeeze(1)
-        else:
-            sim = torch.gather(pw_sim, 1, sampled).squeeze(1)
+    def sample_cand(self, qt, cand, collision=None, if_norm=False, n_sample=1):
+        return self.sample_from_repr(self.query_encoding(qt), self.cand_encoding(cand), collision, if_norm, n_sample)
 
-        return sampled, sim
\ No newline at end of file
+    def sample_query(self, qt, cand, collision=None, if_norm=False, n_sample=1):
+        return self.sample_from_repr(self.cand_encoding(cand), self.query_encoding(qt), collision, if_norm, n_sample)
@@ -5,14 +5,17 @@ import torch
 import torch.nn as nn
 import torch.nn.init as weight_init
 import torch.nn.functional as F
+from models import length_aware_lstm, sample_negatives, sample_scores, margin_loss
 import pdb
 
+MASKED_CAND_BLOCK = 16  # candidates per block of pairwise_attention_scores when padding is trimmed
+
 
 class BOWEncoder(nn.Module):
   def __init__(self, vocab_size, emb_size, config):
     super(BOWEncoder, self).__init__()
     self.emb_size = emb_size
-    self.embedding = nn.Embedding(vocab_size, emb_size)
+    self.embedding = nn.Embedding(vocab_size, emb_size, sparse=config['sparse_emb'])
     self.config = config
 
   def forward(self, input):
@@ -31,7 +34,7 @@ class SeqEncoder(nn.Module):
     self.hidden_size = hidden_size
     self.config = config
 
-    self.embedding = nn.Embedding(vocab_size, emb_size, padding_idx=0)
+    self.embedding = nn.Embedding(vocab_size, emb_size, padding_idx=0, sparse=config['sparse_emb'])
     self.lstm = nn.LSTM(emb_size, hidden_size, batch_first=True, bidirectional=True)
     for w in self.lstm.parameters():  # initialize the gate weights with orthogonal
       if w.dim() > 1:
@@ -41,7 +44,12 @@ class SeqEncoder(nn.Module):
     batch_size, seq_len = input.size()
     embedded = self.embedding(input)  # input: [batch_sz x seq_len]  embedded: [batch_sz x seq_len x emb_sz]
     embedded = F.dropout(embedded, self.config['seqenc_dropout'], self.training)
-    rnn_output, hidden = self.lstm(embedded)  # out:[b x seq x hid_sz*2](biRNN)
+    if self.config['seqenc_packed']:
+      # the LSTM stops at the last non-padding token; padding positions come out as zero rows
+      lengths = input.ne(0).sum(1).clamp(min=1)  # an all-padding input still gets one step
+      rnn_output, _ = length_aware_lstm(self.lstm, embedded, lengths)
+    else:
+      rnn_output, hidden = self.lstm(embedded)  # out:[b x seq x hid_sz*2](biRNN)
     rnn_output = F.dropout(rnn_output, self.config['seqenc_dropout'], self.training)
     encoding = torch.tanh(rnn_output)
 
@@ -49,8 +57,9 @@ class SeqEncoder(nn.Module):
 
 
 class Attention(nn.Module):
-  def __init__(self, input_size, emb_size):
+  def __init__(self, input_size, emb_size, masked=False):
     super(Attention, self).__init__()
+    self.masked = masked
     self.linear_compare = nn.Sequential(nn.Dropout(p=0.2), nn.Linear(input_size*2, emb_size), nn.ReLU(),
                                         nn.Dropout(p=0.2), nn.Linear(emb_size, emb_size), nn.ReLU())
 
@@ -61,15 +70,93 @@ class Attention(nn.Module):
     :return:
     """
     pairwise_inner_prod = torch.matmul(left, right.transpose(1, 2))  # [batch_size, length_left, length_right]
-    attn_l_to_r = pairwise_inner_prod.softmax(1)
-    attn_r_to_l = pairwise_inner_prod.softmax(2)
+    if self.masked:
+      # padding positions are the all-zero rows of a packed SeqEncoder output
+      left_mask, right_mask = left.ne(0).any(2), right.ne(0).any(2)
+      attn_l_to_r = pairwise_inner_prod.masked_fill(~left_mask.unsqueeze(2), -float('inf')).softmax(1)
+      attn_r_to_l = pairwise_inner_prod.masked_fill(~right_mask.unsqueeze(1), -float('inf')).softmax(2)
+    else:
+      attn_l_to_r = pairwise_inner_prod.softmax(1)
+      attn_r_to_l = pairwise_inner_prod.softmax(2)
     left_to_right = torch.matmul(attn_l_to_r.transpose(1, 2), left)
     right_to_left = torch.matmul(attn_r_to_l, right)
     left_more = torch.cat([left, right_to_left], 2)
     right_more = torch.cat([right, left_to_right], 2)
-    left_compared = self.linear_compare(left_more).sum(1)
-    right_compared = self.linear_compare(right_more).sum(1)
-    return left_compared, right_compared
+    left_compared = self.linear_compare(left_more)
+    right_compared = self.linear_compare(right_more)
+    if self.masked:
+      left_compared = left_compared * left_mask.unsqueeze(2).to(left_compared.dtype)
+      right_compared = right_compared * right_mask.unsqueeze(2).to(right_compared.dtype)
+    return left_compared.sum(1), right_compared.sum(1)
+
+  def pairwise(self, left, right):
+    """
+    Inference forward of every left sequence against every right one, with no copy of either: the attention of
+    all pairs is computed by batched matmuls over [n_left x n_right x length_left x length_right] scores. The first
+    compare layer is split into its token and attended-summary halves, so that summaries are built from tokens
+    already projected to emb_size instead of being concatenated to them.
+    :param left: [n_left * length_left * dim]
+    :param right: [n_right * length_right * dim]
+    :return: [n_left * n_right * emb_size] left and right compared representations
+    """
+    linear1, linear2 = self.linear_compare[1], self.linear_compare[4]
+    w_self, w_attn = linear1.weight[:, :left.size(2)], linear1.weight[:, left.size(2):]
+    left_self, left_attn = F.linear(left, w_self, linear1.bias), F.linear(left, w_attn)  # [n_left, length_left, emb]
+    right_self, right_attn = F.linear(right, w_self, linear1.bias), F.linear(right, w_attn)
+    pairwise_inner_prod = torch.einsum('ikd,jmd->ijkm', left, right)  # [n_left, n_right, length_left, length_right]
+    if self.masked:
+      left_mask, right_mask = left.ne(0).any(2)[:, None, :, None], right.ne(0).any(2)[None, :, None, :]
+      attn_l_to_r = pairwise_inner_prod.masked_fill(~left_mask, -float('inf')).softmax(2)
+      attn_r_to_l = pairwise_inner_prod.masked_fill(~right_mask, -float('inf')).softmax(3)
+    else:
+      attn_l_to_r = pairwise_inner_prod.softmax(2)
+      attn_r_to_l = pairwise_inner_prod.softmax(3)
+    del pairwise_inner_prod
+    # linear1 of [token, attended summary] = w_self token + w_attn summary, and the summaries are weighted sums
+    left_compared = F.relu(left_self[:, None] + torch.einsum('ijkm,jme->ijke', attn_r_to_l, right_attn))
+    left_compared = F.relu(linear2(left_compared))
+    right_compared = F.relu(right_self[None] + torch.einsum('ijkm,ike->ijme', attn_l_to_r, left_attn))
+    right_compared = F.relu(linear2(right_compared))
+    if self.masked:
+      left_compared = left_compared * left_mask.to(left_compared.dtype)
+      right_compared = right_compared * right_mask.transpose(2, 3).to(right_compared.dtype)
+    return left_compared.sum(2), right_compared.sum(2)
+
+
+def attention_pair_bytes(attention, qt_len, cand_len, element_size=4):
+  """memory of the intermediate tensors of attention then output on one (query, candidate) pair"""
+  emb_size = attention.linear_compare[1].out_features
+  return (3 * qt_len * cand_len + 4 * (qt_len + cand_len) * emb_size) * element_size
+
+
+def pairwise_attention_scores(attention, output, qt_repr, cand_repr, budget_mb=256):
+  """
+  output(attention(...)) scores of every query against every candidate, [n_qt x n_cand], by blocks of pairs sized
+  so that the intermediate tensors of a block stay within about budget_mb. With a masked attention, padding does
+  not change the scores, so candidates are taken by increasing length and each block is trimmed to its longest.
+  """
+  n_qt, n_cand = qt_repr.size(0), cand_repr.size(0)
+  block_pairs = max(1, int(budget_mb * (1 << 20) // attention_pair_bytes(attention, qt_repr.size(1), cand_repr.size(1),
+                                                                           qt_repr.element_size())))
+  qt_block = min(n_qt, block_pairs)
+  cand_block = max(1, block_pairs // qt_block)
+
+  order = torch.arange(n_cand, device=cand_repr.device)
+  if attention.masked:  # the non-padding positions of a packed SeqEncoder output are a prefix
+    cand_lengths = cand_repr.ne(0).any(2).sum(1)
+    order = cand_lengths.argsort()
+    cand_block = min(cand_block, MASKED_CAND_BLOCK)  # small blocks of similar lengths pad less
+    qt_repr = qt_repr[:, :max(1, int(qt_repr.ne(0).any(2).sum(1).max()))]
+  scores = qt_repr.new_empty((n_qt, n_cand))
+  for j in range(0, n_cand, cand_block):
+    rows = order[j:j + cand_block]
+    cands = cand_repr[rows]
+    if attention.masked:
+      cands = cands[:, :max(1, int(cand_lengths[rows].max()))]
+    for i in range(0, n_qt, qt_block):
+      qt_w_attn, cand_w_attn = attention.pairwise(qt_repr[i:i + qt_block], cands)
+      scores[i:i + qt_block, rows] = output(torch.cat([qt_w_attn, cand_w_attn], 2)).squeeze(2)
+  return scores
 
 
 class QCModel(nn.Module):
@@ -79,6 +166,9 @@ class QCModel(nn.Module):
 
     self.conf = config
     self.margin = config['margin']
+    if config['loss'] == 'infonce':
+      # the in-batch softmax needs the BxB attention pairs with gradients: memory and time grow with B^2
+      raise ValueError("loss='infonce' is only supported by the models of models.py.")
     self.query_encoder = SeqEncoder(config['qt_n_words'], config['emb_size'], config['lstm_dims'], self.conf)
 
     if self.conf['code_encoder'] == "bilstm":
@@ -87,7 +177,7 @@ class QCModel(nn.Module):
     else:
       self.cand_encoder = BOWEncoder(config['code_n_words'], 2 * config['lstm_dims'], self.conf)  # MLP
 
-    self.attention = Attention(config['lstm_dims'] * 2, config["lstm_dims"])
+    self.attention = Attention(config['lstm_dims'] * 2, config["lstm_dims"], masked=config['seqenc_packed'])
     self.output = nn.Sequential(nn.Dropout(p=0.2),
                                 nn.Linear(config["lstm_dims"]*2, config['lstm_dims']),
                                 nn.ReLU(),
@@ -114,26 +204,26 @@ class QCModel(nn.Module):
     # sim = F.cosine_similarity(qt_repr_w_attn, cand_repr_w_attn)
     return sim
 
-  def cross_scoring(self, qt_repr, cand_repr):
-    # raise NotImplementedError()
-    pdb.set_trace()
-    
-    # Get pairwise cosine similarity
-    qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
-    cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-    pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
-
-    # Sample probability (not sum to one)
-    temperature = 1
-    exp_pw_sim = torch.exp(pw_sim.data / temperature)
-    sampled = []
-    for x in range(exp_pw_sim.size(0)):
-      y = torch.multinomial(exp_pw_sim[x], 1)
-      sampled.append(y)
-
-    # Choose sampled as negative instance
-    sim = torch.gather(pw_sim, 1, torch.stack(sampled)).squeeze(1)
-    return sim
+  def pairwise_scoring(self, qt_repr, cand_repr):
+    # Score every query against every candidate: [n_qt x n_cand]
+    if self.training:  # dropout draws its own mask for every pair
+      return torch.stack([self.scoring(qt_repr[i].expand(cand_repr.size(0), -1, -1), cand_repr)
+                          for i in range(qt_repr.size(0))])
+    return pairwise_attention_scores(self.attention, self.output, qt_repr, cand_repr, self.conf['attn_budget_mb'])
+
+  def cross_scoring(self, qt_repr, cand_repr, n_neg=1):
+    # Choose n_neg negative instances per query, sampled by pairwise attention score. The pairs are scored without
+    # gradients and dropout, in batched blocks; only the sampled [n_qt x n_neg] pairs are scored again with them
+    training = self.training
+    with torch.no_grad():
+      self.attention.eval(), self.output.eval()
+      pw_sim = pairwise_attention_scores(self.attention, self.output, qt_repr, cand_repr, self.conf['attn_budget_mb'])
+      self.attention.train(training), self.output.train(training)
+    sampled = sample_negatives(pw_sim, n_neg, temperature=1.0)
+    n_qt = qt_repr.size(0)
+    qt_rows = torch.arange(n_qt, device=sampled.device).unsqueeze(1).expand(-1, n_neg).reshape(-1)
+    sim = self.scoring(qt_repr[qt_rows], cand_repr[sampled.reshape(-1)]).view(n_qt, n_neg)
+    return sim.squeeze(1) if n_neg == 1 else sim
 
   def get_scores(self, qt, cand):
     raise NotImplementedError()
@@ -147,64 +237,21 @@ class QCModel(nn.Module):
     pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
     return pw_sim
 
-  def sample_cand(self, qt, cand, collision=None, if_norm=False):
+  def sample_cand(self, qt, cand, collision=None, if_norm=False, n_sample=1):
     raise NotImplementedError()
 
     qt_repr = self.query_encoding(qt)
     cand_repr = self.cand_encoding(cand)
+    pw_sim = self.pairwise_scoring(qt_repr, cand_repr)
+    return sample_scores(pw_sim, n_sample, 0.2, collision, if_norm)
 
-    # Get pairwise similarity
-    # pdb.set_trace()
-    qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
-    cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-    pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
-
-    # Sample probability (not sum to one)
-    temperature = 0.2
-    exp_pw_sim = torch.exp(pw_sim / temperature)
-
-    # sample
-    if collision is not None:
-      # pw_sim = pw_sim.masked_fill(collision, 0)
-      exp_pw_sim = exp_pw_sim.masked_fill(collision, 0)
-
-    sampled = torch.multinomial(exp_pw_sim.data, 1)
-    if if_norm:
-      norm_exp_pw_sim = exp_pw_sim / exp_pw_sim.sum(1, keepdim=True)
-      sim = torch.gather(norm_exp_pw_sim, 1, sampled).squeeze(1)
-    else:
-      sim = torch.gather(pw_sim, 1, sampled).squeeze(1)
-
-    return sampled, sim
-
-  def sample_cand_cc_with_qc(self, qt, cand, collision=None, if_norm=False):
+  def sample_cand_cc_with_qc(self, qt, cand, collision=None, if_norm=False, n_sample=1):
     raise NotImplementedError()
 
     qt_repr = self.cand_encoding(qt)
     cand_repr = self.cand_encoding(cand)
-
-    # Get pairwise cosine similarity
-    qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
-    cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-    pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
-
-    # Sample probability (not sum to one)
-    temperature = 0.2
-    exp_pw_sim = torch.exp(pw_sim / temperature)
-
-    # sample
-    if collision is not None:
-      # pw_sim = pw_sim.masked_fill(collision, 0)
-      exp_pw_sim = exp_pw_sim.masked_fill(collision, 0)
-
-    sampled = torch.multinomial(exp_pw_sim.data, 1)
-    if if_norm:
-      norm_exp_pw_sim = exp_pw_sim / exp_pw_sim.sum(1, keepdim=True)
-      sim = torch.gather(norm_exp_pw_sim, 1, sampled).squeeze(1)
-    else:
-      sim = torch.gather(pw_sim, 1, sampled).squeeze(1)
-
-    return sampled, sim
+    pw_sim = self.pairwise_scoring(qt_repr, cand_repr)
+    return sample_scores(pw_sim, n_sample, 0.2, collision, if_norm)
 
   def forward(self, qt, good_cand, bad_cand, adversarial_sample=False):
     good_cand_repr = self.cand_encoding(good_cand)
@@ -216,9 +263,10 @@ class QCModel(nn.Module):
     if not adversarial_sample:
       bad_sim = self.scoring(qt_repr, bad_cand_repr)
     else:
-      bad_sim = self.cross_scoring(qt_repr, bad_cand_repr)
+      bad_sim = self.cross_scoring(qt_repr, bad_cand_repr, n_neg=self.conf['n_neg'])
 
     # loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
+    bad_sim = bad_sim.reshape(-1)  # n_neg negatives per query
     loss = self.loss(torch.cat([good_sim, bad_sim]),
                      torch.cat([torch.ones_like(good_sim), torch.zeros_like(bad_sim)]))
 
@@ -234,9 +282,9 @@ class QCModel(nn.Module):
     if not adversarial_sample:
       bad_sim = self.scoring(qt_repr, bad_cand_repr)
     else:
-      bad_sim = self.cross_scoring(qt_repr, bad_cand_repr)
+      bad_sim = self.cross_scoring(qt_repr, bad_cand_repr, n_neg=self.conf['n_neg'])
 
-    loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
+    loss = margin_loss(self.margin, good_sim, bad_sim)
     return loss, good_sim, bad_sim
 
 
@@ -267,51 +315,23 @@ class CCModel(nn.Module):
     sim = F.cosine_similarity(code_repr, cand_repr)
     return sim
 
-  def _cross_scoring(self, code_repr, cand_repr):
-
-    # Get pairwise cosine similarity
+  def pairwise_scoring(self, code_repr, cand_repr):
+    # Score every code query against every candidate: [n_code x n_cand]
     code_repr_norm = code_repr / code_repr.norm(dim=1)[:, None]
     cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-    pw_sim = torch.mm(code_repr_norm, cand_repr_norm.transpose(0, 1))
-
-    # Sample probability (not sum to one)
-    temperature = 1
-    exp_pw_sim = torch.exp(pw_sim.data / temperature)
-    sampled = []
-    for x in range(exp_pw_sim.size(0)):
-      y = torch.multinomial(exp_pw_sim[x], 1)
-      sampled.append(y)
-
-    # Choose sampled as negative instance
-    sim = torch.gather(pw_sim, 1, torch.stack(sampled)).squeeze(1)
+    return torch.mm(code_repr_norm, cand_repr_norm.transpose(0, 1))
+
+  def _cross_scoring(self, code_repr, cand_repr, n_neg=1):
+    # Choose n_neg negative instances per query, sampled by pairwise cosine similarity
+    pw_sim = self.pairwise_scoring(code_repr, cand_repr)
+    _, sim = sample_scores(pw_sim, n_neg, temperature=1.0)
     return sim
 
-  def sample_cand(self, code, cand, collision=None, if_norm=False):
+  def sample_cand(self, code, cand, collision=None, if_norm=False, n_sample=1):
     code_repr = self.query_encoding(code)
     cand_repr = self.cand_encoding(cand)
-
-    # Get pairwise cosine similarity
-    code_repr_norm = code_repr / code_repr.norm(dim=1)[:, None]
-    cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-    pw_sim = torch.mm(code_repr_norm, cand_repr_norm.transpose(0, 1))
-
-    # Sample probability (not sum to one)
-    temperature = 1
-    exp_pw_sim = torch.exp(pw_sim / temperature)
-
-    # sample
-    if collision is not None:
-      # pw_sim = pw_sim.masked_fill(collision, 0)
-      exp_pw_sim = exp_pw_sim.masked_fill(collision, 0)
-
-    sampled = torch.multinomial(exp_pw_sim.data, 1)
-    if if_norm:
-      norm_exp_pw_sim = exp_pw_sim / exp_pw_sim.sum(1, keepdim=True)
-      sim = torch.gather(norm_exp_pw_sim, 1, sampled).squeeze(1)
-    else:
-      sim = torch.gather(pw_sim, 1, sampled).squeeze(1)
-
-    return sampled, sim
+    pw_sim = self.pairwise_scoring(code_repr, cand_repr)
+    return sample_scores(pw_sim, n_sample, 1.0, collision, if_norm)
 
   def forward(self, code, good_cand, bad_cand, adversarial_sample=False):
     good_cand_repr = self.cand_encoding(good_cand)
@@ -323,9 +343,9 @@ class CCModel(nn.Module):
     if not adversarial_sample:
       bad_sim = self.scoring(code_repr, bad_cand_repr)
     else:
-      bad_sim = self._cross_scoring(code_repr, bad_cand_repr)
+      bad_sim = self._cross_scoring(code_repr, bad_cand_repr, n_neg=self.conf['n_neg'])
 
-    loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
+    loss = margin_loss(self.margin, good_sim, bad_sim)
     return loss, good_sim, bad_sim
 
 
@@ -351,23 +371,16 @@ class QQModel(nn.Module):
     sim = F.cosine_similarity(qt_repr, cand_repr)
     return sim
 
-  def cross_scoring(self, qt_repr, cand_repr):
-
-    # Get pairwise cosine similarity
+  def pairwise_scoring(self, qt_repr, cand_repr):
+    # Score every query against every candidate: [n_qt x n_cand]
     qt_repr_norm = qt_repr / qt_repr.norm(dim=1)[:, None]
     cand_repr_norm = cand_repr / cand_repr.norm(dim=1)[:, None]
-    pw_sim = torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
-
-    # Sample probability (not sum to one)
-    temperature = 1
-    exp_pw_sim = torch.exp(pw_sim.data / temperature)
-    sampled = []
-    for x in range(exp_pw_sim.size(0)):
-      y = torch.multinomial(exp_pw_sim[x], 1)
-      sampled.append(y)
+    return torch.mm(qt_repr_norm, cand_repr_norm.transpose(0, 1))
 
-    # Choose sampled as negative instance
-    sim = torch.gather(pw_sim, 1, torch.stack(sampled)).squeeze(1)
+  def cross_scoring(self, qt_repr, cand_repr, n_neg=1):
+    # Choose n_neg negative instances per query, sampled by pairwise cosine similarity
+    pw_sim = self.pairwise_scoring(qt_repr, cand_repr)
+    _, sim = sample_scores(pw_sim, n_neg, temperature=1.0)
     return sim
 
   def forward(self, qt, good_cand, bad_cand, adversarial_sample=False):
@@ -380,7 +393,7 @@ class QQModel(nn.Module):
     if not adversarial_sample:
       bad_sim = self.scoring(qt_repr, bad_cand_repr)
     else:
-      bad_sim = self.cross_scoring(qt_repr, bad_cand_repr)
+      bad_sim = self.cross_scoring(qt_repr, bad_cand_repr, n_neg=self.conf['n_neg'])
 
-    loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
+    loss = margin_loss(self.margin, good_sim, bad_sim)
     return loss, good_sim, bad_sim
\ No newline at end of file
@@ -17,6 +17,10 @@ from tensorboardX import SummaryWriter
 
 from utils import *
 from configs import get_config
+from batching import make_train_loader, TokenMeter
+from asyncval import make_validator, EvalCall
+from checkpoint import Checkpointer, save_state_dict, load_weights
+from sparseopt import dense_parameters, with_sparse_adam
 from data import load_qc_data, load_cc_data, load_qq_data, my_collate
 from models import *
 
@@ -42,45 +46,45 @@ class JointSearcher:
         if qc_model is not None:
             if not os.path.exists(self.conf['model_directory']['qc']):
                 os.makedirs(self.conf['model_directory']['qc'])
-            torch.save(qc_model.state_dict(), os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt'))
+            save_state_dict(qc_model.state_dict(), os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt'))
         if cc_model is not None:
             if not os.path.exists(self.conf['model_directory']['cc']):
                 os.makedirs(self.conf['model_directory']['cc'])
-            torch.save(cc_model.state_dict(), os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt'))
+            save_state_dict(cc_model.state_dict(), os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt'))
         if qq_model is not None:
             if not os.path.exists(self.conf['model_directory']['qq']):
                 os.makedirs(self.conf['model_directory']['qq'])
-            torch.save(qq_model.state_dict(), os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt'))
+            save_state_dict(qq_model.state_dict(), os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt'))
 
     def load_model(self, model):
         qc_model, cc_model, qq_model = model["qc"], model["cc"], model["qq"]
         if qc_model is not None:
             assert os.path.exists(os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt')), \
                 'Weights for saved qc model not found'
-            qc_model.load_state_dict(torch.load(os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt')))
+            load_weights(qc_model, os.path.join(self.conf['model_directory']['qc'], 'best_model.ckpt'))
         if cc_model is not None:
             assert os.path.exists(os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt')), \
                 'Weights for saved cc model not found'
-            cc_model.load_state_dict(torch.load(os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt')))
+            load_weights(cc_model, os.path.join(self.conf['model_directory']['cc'], 'best_model.ckpt'))
         # if qq_model is not None:
         #     assert os.path.exists(os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt')), \
         #         'Weights for saved qq model not found'
-        #     qq_model.load_state_dict(torch.load(os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt')))
+        #     load_weights(qq_model, os.path.join(self.conf['model_directory']['qq'], 'best_model.ckpt'))
 
     def load_other_model(self, model, model_path):
         qc_model, cc_model, qq_model = model["qc"], model["cc"], model["qq"]
         if qc_model is not None:
             assert os.path.exists(os.path.join(model_path['qc'], 'best_model.ckpt')), \
                 'Weights for saved qc model not found'
-            qc_model.load_state_dict(torch.load(os.path.join(model_path['qc'], 'best_model.ckpt')))
+            load_weights(qc_model, os.path.join(model_path['qc'], 'best_model.ckpt'))
         if cc_model is not None:
             assert os.path.exists(os.path.join(model_path['cc'], 'best_model.ckpt')), \
                 'Weights for saved cc model not found'
-            cc_model.load_state_dict(torch.load(os.path.join(model_path['cc'], 'best_model.ckpt')))
+            load_weights(cc_model, os.path.join(model_path['cc'], 'best_model.ckpt'))
         # if qq_model is not None:
         #     assert os.path.exists(os.path.join(model_path['qq'], 'best_model.ckpt')), \
         #         'Weights for saved qq model not found'
-        #     qq_model.load_state_dict(torch.load(os.path.join(model_path['qq'], 'best_model.ckpt')))
+        #     load_weights(qq_model, os.path.join(model_path['qq'], 'best_model.ckpt'))
 
     ############
     # Training #
@@ -97,6 +101,7 @@ class JointSearcher:
         batch_size = self.conf['batch_size']
         nb_epoch = self.conf['nb_epoch']
         max_patience = self.conf['patience']
+        ckpt_every = self.conf['ckpt_every']
 
         # Load data
         assert (self.conf["model"] == "joint"), "For individual QC/CC/QQ model train/test, use codesearcher.py"
@@ -105,16 +110,22 @@ class JointSearcher:
                 "qq": load_qq_data(test=False)}
 
         train_loader = {
-            "qc": torch.utils.data.DataLoader(dataset=data["qc"]["train"], batch_size=batch_size, shuffle=True,
-                                              drop_last=True, num_workers=1, collate_fn=my_collate),
-            "cc": torch.utils.data.DataLoader(dataset=data["cc"]["train"], batch_size=batch_size, shuffle=True,
-                                              drop_last=True, num_workers=1, collate_fn=my_collate),
+            "qc": make_train_loader(data["qc"]["train"], batch_size, my_collate, bucket=self.conf['bucket'] > 0,
+                                    drop_last=True),
+            "cc": make_train_loader(data["cc"]["train"], batch_size, my_collate, bucket=self.conf['bucket'] > 0,
+                                    drop_last=True),
             # "qq": torch.utils.data.DataLoader(dataset=data["qq"]["train"], batch_size=batch_size, shuffle=True,
             #                                   drop_last=True, num_workers=1, collate_fn=my_collate)
         }
 
+        # Full-state checkpoints; with resume > 0, training goes on from the latest one
+        checkpointer = Checkpointer(self.conf['checkpoint_directory'], keep=self.conf['keep_ckpt'])
+        start_epoch, start_itr, patience = self.conf['reload'] + 1, 0, 0
+        if self.conf['resume'] > 0 and checkpointer.latest() is not None:
+            start_epoch, start_itr, extra = checkpointer.restore(model, optimizer)
+            max_mrr, patience = extra["max_mrr"], extra["patience"]
         # MRR for the Best Saved model, if reload > 0, else -1
-        if self.conf['reload'] > 0:
+        elif self.conf['reload'] > 0:
             _, max_mrr, max_map, max_ndcg = searcher.eval(model, args.pool_size, {k: v["dev"] for k, v in data.items()})
             if writer is not None:
                 for k in max_mrr.keys():
@@ -124,9 +135,13 @@ class JointSearcher:
         else:
             max_mrr = {"qc": -1, "cc": -1}
 
-        patience = 0
-        for epoch in range(self.conf['reload'] + 1, nb_epoch):
-            itr = 1
+        # Dev evaluation, in a worker process with async_valid
+        evaluate = EvalCall(self.eval, args.pool_size, {k: v["dev"] for k, v in data.items()})
+        validator = make_validator(model, evaluate, self.conf['async_valid'] > 0)
+
+        for epoch in range(start_epoch, nb_epoch):
+            itr, start_itr = start_itr + 1, 0
+            meter = TokenMeter()
             losses = {"qc": [], "cc": [], "qq": []}
             all_losses = {"qc": [], "cc": [], "qq": []}
             rewards = []
@@ -135,10 +150,12 @@ class JointSearcher:
             # model["qc"], model["cc"], model["qq"] = model["qc"].train(), model["cc"].train(), model["qq"].train()
             # model = {k: v.train() for k, v in model.items()}
 
-            # Update QC model
-            if self.conf["update_qc"] > 0:
+            # Update QC model; after a resume, only the batches of the epoch not trained yet
+            if self.conf["update_qc"] > 0 and itr - 1 < len(train_loader["qc"]):
                 model["qc"].train()
+                train_loader["qc"].batch_sampler.set_epoch(epoch, skip=itr - 1)
                 for qc_batch in train_loader["qc"]:
+                    meter.update(qc_batch)
                     qc_query, qc_good_cands, qc_bad_cands = qc_batch["query"], qc_batch["pos"], qc_batch["neg"]
                     qc_query, qc_good_cands, qc_bad_cands = gVar(qc_query), gVar(qc_good_cands), gVar(qc_bad_cands)
 
@@ -150,18 +167,23 @@ class JointSearcher:
                     optimizer["qc"].step()
 
                     if itr % log_every == 0:
-                        print('epo:[%d/%d]  itr:%d  QC Loss=%.2E  CC Loss=%.2E  CC Reward=%.2E' % (
+                        print('epo:[%d/%d]  itr:%d  QC Loss=%.2E  CC Loss=%.2E  CC Reward=%.2E  %s' % (
                             epoch, nb_epoch, itr,
                             np.mean(losses["qc"]) if losses["qc"] else -1,
                             np.mean(losses["cc"]) if losses["cc"] else -1,
-                            np.mean(rewards) if rewards else -1))
+                            np.mean(rewards) if rewards else -1, meter.report()))
                         losses = {"qc": [], "cc": [], "qq": []}
                         rewards = []
+                    if ckpt_every > 0 and itr % ckpt_every == 0:
+                        checkpointer.save(epoch, itr, model, optimizer, max_mrr=max_mrr, patience=patience)
                     itr = itr + 1
 
             # Update QC model, with CC data.
             if self.conf["update_cc"] > 0:
+                qc_batches = len(train_loader["qc"]) if self.conf["update_qc"] > 0 else 0
+                train_loader["cc"].batch_sampler.set_epoch(epoch, skip=itr - 1 - qc_batches)
                 for cc_batch in train_loader["cc"]:
+                    meter.update(cc_batch)
 
                     cc_query, cc_good_cands, cc_bad_cands = cc_batch["query"], cc_batch["pos"], cc_batch["neg"]
                     cc_query, cc_good_cands, cc_bad_cands = gVar(cc_query), gVar(cc_good_cands), gVar(cc_bad_cands)
@@ -177,13 +199,15 @@ class JointSearcher:
                     optimizer["qc"].step()
 
                     if itr % log_every == 0:
-                        print('epo:[%d/%d]  itr:%d  QC Loss=%.2E  CC Loss=%.2E  CC Reward=%.2E' % (
+                        print('epo:[%d/%d]  itr:%d  QC Loss=%.2E  CC Loss=%.2E  CC Reward=%.2E  %s' % (
                             epoch, nb_epoch, itr,
                             np.mean(losses["qc"]) if losses["qc"] else -1,
                             np.mean(losses["cc"]) if losses["cc"] else -1,
-                            np.mean(rewards) if rewards else -1))
+                            np.mean(rewards) if rewards else -1, meter.report()))
                         losses = {"qc": [], "cc": [], "qq": []}
                         rewards = []
+                    if ckpt_every > 0 and itr % ckpt_every == 0:
+                        checkpointer.save(epoch, itr, model, optimizer, max_mrr=max_mrr, patience=patience)
                     itr = itr + 1
 
             # Write to tensorboard
@@ -200,29 +224,33 @@ class JointSearcher:
             model_monitored = ["qc", "cc"]
             if epoch % valid_every == 0:
                 print("validating..")
-                acc1, mrr, map, ndcg = self.eval(model, args.pool_size, {k: v["dev"] for k, v in data.items()})
+                validator.submit(epoch, model)
+            for valid_epoch, valid_model, (acc1, mrr, map, ndcg) in validator.results(wait=epoch == nb_epoch - 1):
                 model_to_save = {"qc": None, "cc": None, "qq": None}
                 for k in mrr.keys():
                     if k is "qq":
                         continue
                     if writer is not None:
-                        writer.add_scalar('Valid/%s_MRR' % k.upper(), mrr[k], epoch)
-                        writer.add_scalar('Valid/%s_MAP' % k.upper(), map[k], epoch)
-                        writer.add_scalar('Valid/%s_nDCG' % k.upper(), ndcg[k], epoch)
+                        writer.add_scalar('Valid/%s_MRR' % k.upper(), mrr[k], valid_epoch)
+                        writer.add_scalar('Valid/%s_MAP' % k.upper(), map[k], valid_epoch)
+                        writer.add_scalar('Valid/%s_nDCG' % k.upper(), ndcg[k], valid_epoch)
                     if k in model_monitored and mrr[k] > max_mrr[k]:
                         max_mrr[k] = mrr[k]
-                        model_to_save[k] = model['qc']
-                        print("%s model improved. Saving at %d epoch." % (k.upper(), epoch))
+                        model_to_save[k] = valid_model['qc']
+                        print("%s model improved. Saving at %d epoch." % (k.upper(), valid_epoch))
                         patience = 0
                 if all([x is None for x in model_to_save.values()]):
                     print("Model didn't improve for ", patience + 1, " epochs")
                     patience += 1
                 else:
                     self.save_model(model_to_save)
+            checkpointer.save(epoch + 1, 0, model, optimizer, max_mrr=max_mrr, patience=patience)
 
             if patience >= max_patience:
                 print("Patience Limit Reached. Stopping Training")
                 break
+        validator.close()
+        checkpointer.close()
 
     #######################
     # Evaluation on StaQC #
@@ -267,40 +295,33 @@ class JointSearcher:
         for batch in data_loader:
 
             qts, cands, all_pos = batch["query"], batch["pos"], batch["all_pos"]
-            qts, cands = gVar(qts), gVar(cands)
-            if cc_with_qc:
-                qts_repr = model.cand_encoding(qts)
-            else:
-                qts_repr = model.query_encoding(qts)
-            cands_repr = model.cand_encoding(cands)
-
-            all_pos_number = [x.size(0) for x in all_pos]
-            all_pos_stack = torch.cat(all_pos)
-            all_pos_stack = gVar(all_pos_stack)
-            all_pos_repr = model.cand_encoding(all_pos_stack)
-            all_pos_repr = torch.split(all_pos_repr, all_pos_number)
-
             _poolsize = len(qts) if bool_collect else min(poolsize, len(qts))  # true poolsize
-            for i in range(_poolsize):
-                cands_repr_w_all_pos = torch.cat([all_pos_repr[i], cands_repr[:i], cands_repr[i+1:]])
-                _qts_repr = qts_repr[i].expand(cands_repr_w_all_pos.size(0), -1)
-                scores = model.scoring(_qts_repr, cands_repr_w_all_pos).data.cpu().numpy()
-                neg_scores = np.negative(scores)
-                predict = np.argsort(neg_scores)
-                predict = [int(k) for k in predict]
-                real = list(range(all_pos_repr[i].size(0)))  # index of positive sample
-                accs.append(ACC(real, predict))
-                mrrs.append(MRR(real, predict))
-                maps.append(MAP(real, predict))
-                ndcgs.append(NDCG(real, predict))
-                sims_collection.append(scores)
-
-                if f_qual is not None:
-                    self._print_qualitative(f_qual=f_qual, qvocab=dataset.qvocab, cvocab=dataset.cvocab,
-                                            query=qts[i].tolist(), pos=all_pos[i].tolist(),
-                                            neg=(cands[:i].tolist() + cands[i+1:].tolist()),
-                                            labels=real, preds=scores,
-                                            MRR=mrrs[-1], MAP=maps[-1], nDCG=ndcgs[-1])
+            all_pos_number = [x.size(0) for x in all_pos[:_poolsize]]
+
+            with torch.no_grad():
+                if cc_with_qc:
+                    qts_repr = model.cand_encoding(gVar(qts[:_poolsize]))
+                else:
+                    qts_repr = model.query_encoding(gVar(qts[:_poolsize]))
+                cands_repr = model.cand_encoding(gVar(cands))
+                all_pos_repr = model.cand_encoding(gVar(torch.cat(all_pos[:_poolsize])))
+                scores, valid, pos_mask = score_pool(model, qts_repr, cands_repr, all_pos_repr, all_pos_number)
+
+            batch_accs, batch_mrrs, batch_maps, batch_ndcgs = ranking_metrics(scores, pos_mask, valid)
+            accs.extend(batch_accs)
+            mrrs.extend(batch_mrrs)
+            maps.extend(batch_maps)
+            ndcgs.extend(batch_ndcgs)
+
+            if bool_collect or f_qual is not None:
+                for i in range(_poolsize):
+                    sims_collection.append(scores[i][valid[i]])
+                    if f_qual is not None:
+                        self._print_qualitative(f_qual=f_qual, qvocab=dataset.qvocab, cvocab=dataset.cvocab,
+                                                query=qts[i].tolist(), pos=all_pos[i].tolist(),
+                                                neg=(cands[:i].tolist() + cands[i+1:].tolist()),
+                                                labels=list(range(all_pos_number[i])), preds=sims_collection[-1],
+                                                MRR=batch_mrrs[i], MAP=batch_maps[i], nDCG=batch_ndcgs[i])
 
         if bool_collect:
             save_path = os.path.join(self.conf['model_directory'], "collect_sims_staqc_%s.pkl" % dataset.data_name)
@@ -337,6 +358,11 @@ def parse_args():
     parser.add_argument("--qc_reload_path", type=str, default="", help="Enclosing folder of the to-be-reloaded model.")
     parser.add_argument("--cc_reload_path", type=str, default="", help="Enclosing folder of the to-be-reloaded model.")
     parser.add_argument("--qq_reload_path", type=str, default="", help="Enclosing folder of the to-be-reloaded model.")
+    parser.add_argument("--resume", type=int, default=0,
+                        help="Resume training from the latest full-state checkpoint, if resume>0.")
+    parser.add_argument("--ckpt_every", type=int, default=500,
+                        help="Iterations between full-state checkpoints (0: only at the end of every epoch).")
+    parser.add_argument("--keep_ckpt", type=int, default=3, help="Number of full-state checkpoints kept.")
 
     # model setup
     parser.add_argument("--update_qc", type=int, default=1, help="If update QC model?", required=True)
@@ -344,7 +370,23 @@ def parse_args():
     parser.add_argument("--dropout", type=float, default=0.0, help="What is the dropout?", required=True)
     parser.add_argument("--emb_size", type=int, default=100, help="What is the embedding size?", required=True)
     parser.add_argument("--lstm_dims", type=int, default=200, help="What is the lstm dimension?", required=True)
+    parser.add_argument("--seqenc_packed", type=int, default=0,
+                        help="Run the sequence encoders on packed sequences, skipping padding, if seqenc_packed>0.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--sparse_emb", type=int, default=0,
+                        help="Sparse embedding gradients, trained with SparseAdam, if sparse_emb>0.")
+    parser.add_argument("--queue_size", type=int, default=0,
+                        help="Keep the encodings of the latest queue_size training candidates as extra negatives "
+                             "(models.py models only), e.g. 65536; 0 for none.")
+    parser.add_argument("--queue_temp", type=float, default=0.1,
+                        help="Temperature of the sampling of margin loss negatives from the queue.")
     parser.add_argument("--batch_size", type=int, default=32, help="What is the batch size?", required=True)
+    parser.add_argument("--async_valid", type=int, default=0,
+                        help="Run the dev evaluation in a worker process while training goes on, if async_valid>0.")
+    parser.add_argument("--bucket", type=int, default=0,
+                        help="Batch training items of similar lengths and trim their padding, if bucket>0.")
     parser.add_argument("--temp", type=str, default="", help="Name of a temporary test (not affect saved model etc).")
 
     # dataset setup
@@ -381,14 +423,23 @@ if __name__ == '__main__':
     conf['model'] = args.model
     conf['bow_dropout'] = args.dropout
     conf['seqenc_dropout'] = args.dropout
+    conf['seqenc_packed'] = args.seqenc_packed > 0
+    conf['sparse_emb'] = args.sparse_emb > 0
+    conf['queue_size'] = args.queue_size
+    conf['queue_temp'] = args.queue_temp
     conf['emb_size'] = args.emb_size
     conf['lstm_dims'] = args.lstm_dims
     conf['batch_size'] = args.batch_size
+    conf['bucket'] = args.bucket
+    conf['async_valid'] = args.async_valid
     conf['lr'] = args.lr
     conf['reload'] = args.reload
     conf['qc_reload_path'] = args.qc_reload_path
     conf['cc_reload_path'] = args.cc_reload_path
     conf['qq_reload_path'] = args.qq_reload_path
+    conf['resume'] = args.resume
+    conf['ckpt_every'] = args.ckpt_every
+    conf['keep_ckpt'] = args.keep_ckpt
     conf['optimizer'] = args.optimizer
     conf['update_qc'] = args.update_qc
     conf['update_cc'] = args.update_cc
@@ -420,6 +471,7 @@ if __name__ == '__main__':
             "qc": os.path.join(conf['ckptdir'], 'QC_%s' % model_dir_str, model_string),
             "cc": os.path.join(conf['ckptdir'], 'CC_%s' % model_dir_str, model_string),
             "qq": os.path.join(conf['ckptdir'], 'QQ_%s' % model_dir_str, model_string)}
+        conf['checkpoint_directory'] = os.path.join(conf['ckptdir'], model_dir_str, model_string, 'checkpoints')
 
         if conf['qc_reload_path'] and conf['cc_reload_path'] and conf['qq_reload_path']:
             conf['reload_model_directory'] = {
@@ -481,40 +533,42 @@ if __name__ == '__main__':
 
         if conf['optimizer'] == 'adagrad':
             optimizer = {
-                "qc": optim.Adagrad(model["qc"].parameters(), lr=conf['lr']) if model["qc"] is not None else None,
-                "cc": optim.Adagrad(model["cc"].parameters(), lr=conf['lr']) if model["cc"] is not None else None,
-                "qq": optim.Adagrad(model["qq"].parameters(), lr=conf['lr']) if model["qq"] is not None else None}
+                "qc": optim.Adagrad(dense_parameters(model["qc"]), lr=conf['lr']) if model["qc"] is not None else None,
+                "cc": optim.Adagrad(dense_parameters(model["cc"]), lr=conf['lr']) if model["cc"] is not None else None,
+                "qq": optim.Adagrad(dense_parameters(model["qq"]), lr=conf['lr']) if model["qq"] is not None else None}
             print("Recommend lr 0.01 for AdaGrad while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'sgd':
             optimizer = {
-                "qc": optim.SGD(model["qc"].parameters(), lr=conf['lr'], momentum=0.9) if model["qc"] is not None else None,
-                "cc": optim.SGD(model["cc"].parameters(), lr=conf['lr'], momentum=0.9) if model["cc"] is not None else None,
-                "qq": optim.SGD(model["qq"].parameters(), lr=conf['lr'], momentum=0.9) if model["qq"] is not None else None}
+                "qc": optim.SGD(dense_parameters(model["qc"]), lr=conf['lr'], momentum=0.9) if model["qc"] is not None else None,
+                "cc": optim.SGD(dense_parameters(model["cc"]), lr=conf['lr'], momentum=0.9) if model["cc"] is not None else None,
+                "qq": optim.SGD(dense_parameters(model["qq"]), lr=conf['lr'], momentum=0.9) if model["qq"] is not None else None}
             print("Recommend lr 0.1 for SGD (momentum 0.9) while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'rmsprop':
             optimizer = {
-                "qc": optim.RMSprop(model["qc"].parameters(), lr=conf['lr']) if model["qc"] is not None else None,
-                "cc": optim.RMSprop(model["cc"].parameters(), lr=conf['lr']) if model["cc"] is not None else None,
-                "qq": optim.RMSprop(model["qq"].parameters(), lr=conf['lr']) if model["qq"] is not None else None}
+                "qc": optim.RMSprop(dense_parameters(model["qc"]), lr=conf['lr']) if model["qc"] is not None else None,
+                "cc": optim.RMSprop(dense_parameters(model["cc"]), lr=conf['lr']) if model["cc"] is not None else None,
+                "qq": optim.RMSprop(dense_parameters(model["qq"]), lr=conf['lr']) if model["qq"] is not None else None}
             print("Recommend lr 0.01 for RMSprop while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'asgd':
             optimizer = {
-                "qc": optim.ASGD(model["qc"].parameters(), lr=conf['lr']) if model["qc"] is not None else None,
-                "cc": optim.ASGD(model["cc"].parameters(), lr=conf['lr']) if model["cc"] is not None else None,
-                "qq": optim.ASGD(model["qq"].parameters(), lr=conf['lr']) if model["qq"] is not None else None}
+                "qc": optim.ASGD(dense_parameters(model["qc"]), lr=conf['lr']) if model["qc"] is not None else None,
+                "cc": optim.ASGD(dense_parameters(model["cc"]), lr=conf['lr']) if model["cc"] is not None else None,
+                "qq": optim.ASGD(dense_parameters(model["qq"]), lr=conf['lr']) if model["qq"] is not None else None}
             print("Recommend lr 0.01 for ASGD while using %.5f." % conf['lr'])
         elif conf['optimizer'] == 'adadelta':
             optimizer = {
-                "qc": optim.Adadelta(model["qc"].parameters(), lr=conf['lr']) if model["qc"] is not None else None,
-                "cc": optim.Adadelta(model["cc"].parameters(), lr=conf['lr']) if model["cc"] is not None else None,
-                "qq": optim.Adadelta(model["qq"].parameters(), lr=conf['lr']) if model["qq"] is not None else None}
+                "qc": optim.Adadelta(dense_parameters(model["qc"]), lr=conf['lr']) if model["qc"] is not None else None,
+                "cc": optim.Adadelta(dense_parameters(model["cc"]), lr=conf['lr']) if model["cc"] is not None else None,
+                "qq": optim.Adadelta(dense_parameters(model["qq"]), lr=conf['lr']) if model["qq"] is not None else None}
             print("Recommend lr 1.00 for Adadelta while using %.5f." % conf['lr'])
         else:
             optimizer = {
-                "qc": optim.Adam(model["qc"].parameters(), lr=conf['lr'] * 0.1) if model["qc"] is not None else None,
-                "cc": optim.Adam(model["cc"].parameters(), lr=conf['lr'] * 0.1) if model["cc"] is not None else None,
-                "qq": optim.Adam(model["qq"].parameters(), lr=conf['lr']) if model["qq"] is not None else None}
+                "qc": optim.Adam(dense_parameters(model["qc"]), lr=conf['lr'] * 0.1) if model["qc"] is not None else None,
+                "cc": optim.Adam(dense_parameters(model["cc"]), lr=conf['lr'] * 0.1) if model["cc"] is not None else None,
+                "qq": optim.Adam(dense_parameters(model["qq"]), lr=conf['lr']) if model["qq"] is not None else None}
             print("Recommend lr 0.001 for Adam while using %.5f." % conf['lr'])
+        if conf['sparse_emb']:
+            optimizer = with_sparse_adam(optimizer, model)
 
         if args.mode == 'train':
             print('Training Model')
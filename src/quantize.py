@@ -0,0 +1,195 @@
+from __future__ import print_function
+
+import io
+import os
+import copy
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import utils
+from configs import get_config
+from data import load_qc_data, load_qq_data, my_collate
+from models import QCModel, QQModel
+from codesearcher import CodeSearcher, create_model_name_string
+from checkpoint import load_checkpoint
+from bench import timeit
+
+MODELS = {"qc": QCModel, "qq": QQModel}
+# config keys an exported model is rebuilt from
+EXPORT_KEYS = ["qt_len", "code_len", "qt_n_words", "code_n_words", "emb_size", "lstm_dims", "code_encoder",
+               "seqenc_packed", "lang"]
+
+
+class QuantizedEmbedding(nn.Module):
+    """
+    Inference stand-in of an nn.Embedding with a reduced precision table: int8 rows with one float scale per row
+    (symmetric, scale = max |weight| / 127), or float16 rows. Looked up rows are returned as float32.
+    """
+    def __init__(self, embedding, dtype="int8"):
+        super(QuantizedEmbedding, self).__init__()
+        self.padding_idx = embedding.padding_idx
+        weight = embedding.weight.detach().float().cpu()
+        if dtype == "int8":
+            scale = weight.abs().max(1)[0].clamp(min=1e-12) / 127.0
+            self.register_buffer("weight", torch.round(weight / scale[:, None]).to(torch.int8))
+            self.register_buffer("scale", scale)
+        elif dtype == "float16":
+            self.register_buffer("weight", weight.half())
+            self.register_buffer("scale", None)
+        else:
+            raise ValueError("Unknown embedding dtype: %s" % dtype)
+
+    def forward(self, input):
+        embedded = F.embedding(input, self.weight).float()
+        if self.scale is not None:
+            embedded = embedded * F.embedding(input, self.scale[:, None])
+        return embedded
+
+
+def quantize_embeddings(module, dtype="int8"):
+    """replaces every nn.Embedding of a module, in place, by a QuantizedEmbedding"""
+    for name, child in module.named_children():
+        if isinstance(child, nn.Embedding):
+            setattr(module, name, QuantizedEmbedding(child, dtype))
+        else:
+            quantize_embeddings(child, dtype)
+    return module
+
+
+def quantize_model(model, emb_dtype="int8"):
+    """
+    CPU inference copy of a model: the LSTM and Linear layers are dynamically quantized (int8 weights, activations
+    quantized on the fly per batch) and the embedding tables are stored at emb_dtype (see QuantizedEmbedding).
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    model = torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    return quantize_embeddings(model, emb_dtype)
+
+
+def export_quantized(model, conf, model_name, path, emb_dtype="int8"):
+    """saves a quantized model with the config it is rebuilt from, see load_quantized"""
+    qmodel = quantize_model(model, emb_dtype)
+    torch.save({"model_name": model_name, "emb_dtype": emb_dtype,
+                "config": dict((key, conf[key]) for key in EXPORT_KEYS), "state_dict": qmodel.state_dict()}, path)
+    return qmodel
+
+
+def load_quantized(path):
+    """
+    Rebuilds a model saved by export_quantized, in eval mode, on the cpu.
+    :return: model, config
+    """
+    saved = load_checkpoint(path)
+    conf = get_config(None)
+    conf.update(saved["config"])
+    conf['bow_dropout'] = conf['seqenc_dropout'] = 0.0
+    model = quantize_model(MODELS[saved["model_name"]](conf), saved["emb_dtype"])
+    model.load_state_dict(saved["state_dict"])
+    return model.eval(), conf
+
+
+def serialized_size(model):
+    """bytes of the saved state dict of a model"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def compare(searcher, model, qmodel, dataset, poolsize, batch_sizes=(1, 64), n_iter=20):
+    """
+    Dev accuracy and CPU encoding speed of a float32 model vs its quantized copy.
+    :return: {"fp32"|"int8": {"mrr": ..., "size_mb": ..., "<encoder>_bs<batch size>_ms": ...}}
+    """
+    loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=max(batch_sizes), shuffle=False,
+                                         num_workers=1, collate_fn=my_collate)
+    batch = next(iter(loader))
+    results = {}
+    for name, m in [("fp32", model), ("int8", qmodel)]:
+        print("%s:\t" % name, end="")
+        _, mrr, _, _ = searcher.eval(m, poolsize, dataset)
+        results[name] = {"mrr": mrr, "size_mb": serialized_size(m) / float(1 << 20)}
+        for encoder, field in [("query", "query"), ("cand", "pos")]:
+            encode = getattr(m, "%s_encoding" % encoder)
+            for batch_size in batch_sizes:
+                inputs = batch[field][:batch_size]
+
+                def run():
+                    with torch.no_grad():
+                        encode(inputs)
+
+                results[name]["%s_bs%d_ms" % (encoder, batch_size)] = timeit(run, n_iter) * 1000
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Export an int8 quantized QC/QQ model for CPU inference and check it on dev.")
+    parser.add_argument("-M", "--model", choices=["qc", "qq"], default="qc", help="Which model to export.")
+    parser.add_argument("--reload_path", type=str, required=True,
+                        help="Enclosing folder of the model, e.g. ../checkpoint_qcwqq/QC.")
+    parser.add_argument("--out", type=str, default="", help="Default: <model directory>/quantized_model.pt.")
+    parser.add_argument("--emb_dtype", choices=["int8", "float16"], default="int8",
+                        help="Precision of the stored embedding tables.")
+    parser.add_argument("--check", type=int, default=1,
+                        help="Compare dev MRR and encoding latency with the float32 model, if check>0.")
+    parser.add_argument('--pool_size', type=int, default=50, help="candidate pool size for evaluation")
+    parser.add_argument("--n_iter", type=int, default=20, help="Timed calls per latency measure.")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads (0: torch default).")
+
+    # model setup, to find the model directory as codesearcher.py names it
+    parser.add_argument("--dropout", type=float, default=0.0, help="What is the dropout?", required=True)
+    parser.add_argument("--emb_size", type=int, default=100, help="What is the embedding size?", required=True)
+    parser.add_argument("--lstm_dims", type=int, default=200, help="What is the lstm dimension?", required=True)
+    parser.add_argument("--seqenc_packed", type=int, default=0,
+                        help="Run the sequence encoders on packed sequences, skipping padding, if seqenc_packed>0.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--batch_size", type=int, default=32, help="What is the batch size?", required=True)
+    parser.add_argument("--lr", type=float, default=0.001, help="What is the learning rate?")
+    parser.add_argument("--optimizer", type=str,
+                        choices=["adam", "adagrad", "sgd", "rmsprop", "asgd", "adadelta"],
+                        default="adam", help="Which optimizer to use?")
+    parser.add_argument("--lang", type=str, default="SQL", help="Which language dataset to use.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    utils.use_cuda = False  # the int8 kernels are CPU only; both models are compared on the CPU
+    conf = get_config(args)
+
+    conf['model'] = args.model
+    conf['bow_dropout'] = conf['seqenc_dropout'] = 0.0
+    conf['seqenc_packed'] = args.seqenc_packed > 0
+    conf['emb_size'] = args.emb_size
+    conf['lstm_dims'] = args.lstm_dims
+    conf['batch_size'] = args.batch_size
+    conf['lr'] = args.lr
+    conf['optimizer'] = args.optimizer
+    conf['lang'] = args.lang
+
+    conf['model_directory'] = os.path.join(args.reload_path, create_model_name_string(conf))
+    out = args.out or os.path.join(conf['model_directory'], "quantized_model.pt")
+    print(" Model Directory : ")
+    print(conf['model_directory'])
+
+    searcher = CodeSearcher(conf)
+    model = MODELS[args.model](conf)
+    searcher.load_model(model)
+    model = model.cpu().eval()
+    qmodel = export_quantized(model, conf, args.model, out, emb_dtype=args.emb_dtype)
+    print("Quantized model saved to %s" % out)
+
+    if args.check > 0:
+        data = (load_qc_data if args.model == "qc" else load_qq_data)(test=False, lang=args.lang)
+        results = compare(searcher, model, load_quantized(out)[0], data["dev"], args.pool_size, n_iter=args.n_iter)
+        print("%d threads" % torch.get_num_threads())
+        for key in sorted(results["fp32"]):
+            fp32, int8 = results["fp32"][key], results["int8"][key]
+            print("%-16s fp32 %10.4f  int8 %10.4f  delta %+.4f  ratio %.2f" %
+                  (key, fp32, int8, int8 - fp32, int8 / fp32))
@@ -0,0 +1,204 @@
+from __future__ import print_function
+
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+
+import utils
+from utils import gVar, MRR_array, MAP_array, NDCG_array, ACC_array
+from configs import get_config
+from serve import SearchEngine
+from checkpoint import load_weights
+
+
+class Reranker:
+    """
+    Second stage: rescores the candidates retrieved by the dual encoder with the attention QC model
+    (models_w_attn.py), reading candidate states from a token state cache (tokencache.py) when one is given.
+    """
+    def __init__(self, model_directory, conf, token_cache=""):
+        from models_w_attn import QCModel
+        ckpt_path = os.path.join(model_directory, 'best_model.ckpt')
+        assert os.path.exists(ckpt_path), 'Weights for saved model not found'
+        self.conf = conf
+        self.model = QCModel(conf)
+        load_weights(self.model, ckpt_path)
+        if torch.cuda.is_available():
+            self.model = self.model.cuda()
+        self.model.eval()
+        self.cache = None
+        if token_cache:
+            from tokencache import open_token_cache
+            self.cache = open_token_cache(token_cache, ckpt_path)
+
+    def cand_states(self, rows, corpus):
+        """states of the corpus rows, from the cache (whose rows are the corpus rows) or encoded"""
+        if self.cache is not None:
+            return self.cache.states(rows)
+        return self.model.cand_encoding(gVar(corpus[torch.from_numpy(rows)]))
+
+    def rerank(self, qts, rows, corpus):
+        """
+        :param qts: [n_query x qt_len] query tokens
+        :param rows: [n_query x k] corpus rows retrieved for every query, -1 for none
+        :param corpus: [n_snippet x code_len] corpus tokens, see CodeSearcher.collect_code_corpus
+        :return: [n_query x k] attention scores, -inf for missing rows
+        """
+        from models_w_attn import attention_pair_bytes
+        n_query, k = rows.shape
+        pair_rows = np.maximum(rows, 0).reshape(-1)
+        scores = np.empty(n_query * k, dtype=np.float32)
+        with torch.no_grad():
+            qts_repr = self.model.query_encoding(gVar(qts))
+            # the n_query*k pairs are encoded and scored by blocks within attn_budget_mb, as pairwise_attention_scores
+            pair_bytes = attention_pair_bytes(self.model.attention, qts_repr.size(1), corpus.size(1),
+                                              qts_repr.element_size())
+            block_pairs = max(1, int(self.conf['attn_budget_mb'] * (1 << 20) // pair_bytes))
+            for start in range(0, len(pair_rows), block_pairs):
+                pairs = torch.arange(start, min(start + block_pairs, len(pair_rows)), device=qts_repr.device)
+                cands_repr = self.cand_states(pair_rows[start: start + block_pairs], corpus)
+                scores[start: start + block_pairs] = self.model.scoring(qts_repr[pairs // k], cands_repr).cpu().numpy()
+        scores = scores.reshape(n_query, k)
+        scores[rows < 0] = -np.inf
+        return scores
+
+
+def candidate_ranks(rows, positives, n_corpus):
+    """
+    :param rows: [n_query x k] ranked corpus rows of every query
+    :param positives: corpus rows of the positives of every query
+    :return: [n_query x max_pos] sorted 0-based ranks of the positives, those outside the k rows ranked last
+             (n_corpus - 1) and padding inf, as expected by the *_array metrics of utils.py
+    """
+    ranks = np.full((len(rows), max(len(p) for p in positives)), np.inf)
+    for i, (ranked, pos_rows) in enumerate(zip(rows, positives)):
+        rank_of = dict((row, rank) for rank, row in enumerate(ranked) if row >= 0)
+        ranks[i, :len(pos_rows)] = sorted(rank_of.get(row, n_corpus - 1) for row in pos_rows)
+    return ranks
+
+
+def evaluate_pipeline(engine, reranker, dataset, corpus, positives, k, topk=(1, 5, 10), batch_size=1):
+    """
+    Retrieves the top-k snippets of every query of dataset from the whole corpus with the dual encoder, then
+    reorders them with the attention model. Positives outside the top-k are ranked last by both stages.
+    :param engine: serve.SearchEngine over the index of the corpus
+    :param positives: corpus rows of the positives of each item of the dataset, see collect_code_corpus
+    :param batch_size: queries run through the pipeline together
+    :return: {stage: metrics} and {stage: per-batch latencies (s)}
+    """
+    from data import my_collate
+    data_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False,
+                                              drop_last=False, num_workers=1, collate_fn=my_collate)
+    ranks = {"retrieve": [], "rerank": []}
+    latencies = {"retrieve": [], "rerank": []}
+    n_query = 0
+    for batch in data_loader:
+        qts = batch["query"]
+        pos_rows = positives[n_query: n_query + len(qts)]
+        n_query += len(qts)
+
+        start = time.time()
+        _, rows = engine.search_rows([np.trim_zeros(q, 'b').tolist() for q in qts.numpy()], k)
+        retrieved = time.time()
+        scores = reranker.rerank(qts, rows, corpus)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        reranked = time.time()
+        latencies["retrieve"].append(retrieved - start)
+        latencies["rerank"].append(reranked - retrieved)
+
+        order = np.argsort(-scores, axis=1, kind="stable")
+        ranks["retrieve"].append(candidate_ranks(rows, pos_rows, len(corpus)))
+        ranks["rerank"].append(candidate_ranks(np.take_along_axis(rows, order, 1), pos_rows, len(corpus)))
+
+    metrics = {}
+    for stage, stage_ranks in ranks.items():
+        width = max(r.shape[1] for r in stage_ranks)
+        stage_ranks = np.concatenate([np.pad(r, ((0, 0), (0, width - r.shape[1])), constant_values=np.inf)
+                                      for r in stage_ranks])
+        metrics[stage] = {"MRR": np.mean(MRR_array(stage_ranks)), "MAP": np.mean(MAP_array(stage_ranks)),
+                          "nDCG": np.mean(NDCG_array(stage_ranks))}
+        for cut in topk:
+            metrics[stage]["R@%d" % cut] = np.mean(ACC_array(stage_ranks, cut))
+    return metrics, latencies
+
+
+def print_report(data_name, k, metrics, latencies, batch_size):
+    print("Data %s, top-%d retrieved then reranked, %d queries per batch:" % (data_name, k, batch_size))
+    for stage in ["retrieve", "rerank"]:
+        ms = np.array(latencies[stage]) * 1000.0
+        print("  %-8s %s | mean %.2fms p50 %.2fms p95 %.2fms per batch" % (
+            stage, ", ".join("%s=%.4f" % (name, value) for name, value in sorted(metrics[stage].items())),
+            ms.mean(), np.percentile(ms, 50), np.percentile(ms, 95)))
+    total = (np.array(latencies["retrieve"]) + np.array(latencies["rerank"])) * 1000.0
+    print("  total    mean %.2fms p50 %.2fms p95 %.2fms per batch" % (
+        total.mean(), np.percentile(total, 50), np.percentile(total, 95)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Retrieve code with the dual encoder QC model, then rerank the top-k with the "
+                                     "attention QC model.")
+    parser.add_argument("--index_dir", type=str, required=True,
+                        help="Index of the dual encoder written by build_index.py (holds its checkpoint).")
+    parser.add_argument("--rerank_dir", type=str, required=True,
+                        help="Model directory of the attention QC model, holding its best_model.ckpt.")
+    parser.add_argument("--token_cache", type=str, default="",
+                        help="Token state cache of the attention model (tokencache.py) over the same corpus.")
+    parser.add_argument("--k", type=int, default=100, help="Snippets retrieved by the first stage and reranked.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Queries run through the pipeline together.")
+    parser.add_argument("--splits", type=str, default="train,dev,test",
+                        help="Data splits making up the corpus, as given to build_index.py.")
+    parser.add_argument("--eval_splits", type=str, default="dev,test", help="Data splits whose queries are evaluated.")
+    parser.add_argument("--ann_path", type=str, default="",
+                        help="IVF-PQ index from ann.py to retrieve approximately instead of exactly.")
+    parser.add_argument("--nprobe", type=int, default=8, help="Inverted lists scanned per query with --ann_path.")
+    parser.add_argument("--quantize", type=int, default=0,
+                        help="Encode queries of the first stage with an int8 quantized model, if quantize>0.")
+
+    # attention model setup
+    parser.add_argument("--emb_size", type=int, default=100, help="Embedding size of the attention model.")
+    parser.add_argument("--lstm_dims", type=int, default=200, help="Lstm dimension of the attention model.")
+    parser.add_argument("--seqenc_packed", type=int, default=0,
+                        help="Whether the attention model runs on packed sequences (seqenc_packed>0).")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--lang", type=str, default="SQL", help="Which language dataset to use.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from data import load_qc_data
+    from codesearcher import CodeSearcher
+
+    args = parse_args()
+    if args.quantize > 0:
+        utils.use_cuda = False  # the int8 kernels are CPU only
+    engine = SearchEngine(args.index_dir, ann_path=args.ann_path, nprobe=args.nprobe, quantize=args.quantize > 0)
+
+    conf = get_config(args)
+    conf['model'] = "qc"
+    conf['bow_dropout'] = conf['seqenc_dropout'] = 0.0
+    conf['emb_size'] = args.emb_size
+    conf['lstm_dims'] = args.lstm_dims
+    conf['seqenc_packed'] = args.seqenc_packed > 0
+    conf['lang'] = args.lang
+    reranker = Reranker(args.rerank_dir, conf, token_cache=args.token_cache)
+
+    data = load_qc_data(test=True, lang=args.lang)
+    corpus_datasets = [data[split] for split in args.splits.split(",")]
+    corpus, _, positives = CodeSearcher(conf).collect_code_corpus(corpus_datasets)
+    # the stages address snippets by corpus row: the index (and cache) must cover the same corpus
+    corpus_names = [dataset.data_name for dataset in corpus_datasets]
+    for name, manifest in [("index", engine.manifest), ("token cache", reranker.cache and reranker.cache.manifest)]:
+        if manifest and (manifest["datasets"] != corpus_names or manifest["size"] != len(corpus)):
+            raise ValueError("The %s was not built on the corpus of splits %s." % (name, args.splits))
+
+    for split in args.eval_splits.split(","):
+        metrics, latencies = evaluate_pipeline(engine, reranker, data[split], corpus,
+                                               positives[args.splits.split(",").index(split)], args.k,
+                                               batch_size=args.batch_size)
+        print_report(data[split].data_name, args.k, metrics, latencies, args.batch_size)
@@ -0,0 +1,48 @@
+from __future__ import print_function
+
+import time
+
+import torch
+
+from utils import gVar
+
+
+class ScoreCache:
+    """
+    Encodings of a frozen model for a whole training set, computed once per training phase of the other model,
+    so that the frozen model scores batches with table lookups and dot products instead of forward passes.
+
+    Each table holds one field of every item encoded by one of the frozen model's encoders, at the row of the
+    item's query_offset. Batch rows are looked up by query_offset, and their random negatives by rand_offset:
+    the negative fields of an item are the fields of the item at its rand_offset.
+    """
+    def __init__(self, tables):
+        self.tables = tables
+
+    @classmethod
+    def build(cls, dataset, fields, collate_fn, batch_size=1024):
+        """
+        :param fields: {table name: (batch field, encoder function)}
+        """
+        start = time.time()
+        # own generator: building a cache must not move the global RNG, for checkpoints taken after it to resume exactly
+        loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False,
+                                             num_workers=1, collate_fn=collate_fn, generator=torch.Generator())
+        offsets, reprs = [], dict((name, []) for name in fields)
+        with torch.no_grad():
+            for batch in loader:
+                offsets.append(torch.as_tensor(batch["query_offset"]))
+                for name, (field, encode) in fields.items():
+                    reprs[name].append(encode(gVar(batch[field])))
+        offsets = gVar(torch.cat(offsets))
+        tables = {}
+        for name in fields:
+            encoded = torch.cat(reprs[name])
+            tables[name] = encoded.new_zeros(int(offsets.max()) + 1, encoded.size(1))
+            tables[name][offsets] = encoded
+        print("Cached %d frozen encodings of %s in %.1fs" % (len(offsets), ", ".join(sorted(tables)),
+                                                            time.time() - start))
+        return cls(tables)
+
+    def lookup(self, name, offsets):
+        return self.tables[name].index_select(0, gVar(torch.as_tensor(offsets)))
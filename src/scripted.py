@@ -0,0 +1,43 @@
+from __future__ import print_function
+
+import json
+import time
+import argparse
+
+import torch
+
+# Loader of the TorchScript models written by export_script.py. It only needs torch: no model classes, configs,
+# data or training modules are imported, so that a serving worker starts fast.
+
+META_FILE = "meta.json"
+
+
+def load_scripted(path, map_location="cpu"):
+    """
+    Loads a scripted model, with the methods query_encoding, cand_encoding, scoring and pairwise_scoring of the
+    model it was exported from.
+    :return: model in eval mode, meta (model name, vocab sizes and lengths of both encoders, checkpoint hash...)
+    """
+    extra_files = {META_FILE: ""}
+    model = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    return model.eval(), json.loads(extra_files[META_FILE])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Load a scripted model and time its cold start and query encoding.")
+    parser.add_argument("path", type=str, help="Model written by export_script.py.")
+    parser.add_argument("--batch_size", type=int, default=64)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    start = time.time()
+    model, meta = load_scripted(args.path)
+    print("Loaded %s model in %.3fs: %s" % (meta["model_name"].upper(), time.time() - start, json.dumps(meta)))
+    qts = torch.randint(2, meta["query_n_words"], (args.batch_size, meta["query_len"]))
+    with torch.no_grad():
+        start = time.time()
+        qts_repr = model.query_encoding(qts)
+        print("Encoded %d queries into %s in %.1fms" % (args.batch_size, list(qts_repr.size()),
+                                                        (time.time() - start) * 1000))
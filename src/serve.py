@@ -0,0 +1,381 @@
+from __future__ import print_function
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+import utils
+from utils import gVar, corpus_search
+from configs import get_config
+from models import QCModel
+from build_index import load_index, file_sha1
+from ann import IVFPQIndex
+from scripted import load_scripted
+from checkpoint import load_weights
+from compact_vocab import CompactVocab
+
+MAX_BODY = 1 << 20
+
+
+##################
+# Query encoding #
+##################
+class QueryVocab:
+    """
+    word -> id of question tokens; ids 0 and 1 are padding and unknown words. Reads question_vocab.json or its
+    compacted version (see compact_vocab.py).
+    :param n_words: query vocab size of the model (qt_n_words); the ids of a vocab of another size would index the
+                    wrong embeddings
+    """
+    def __init__(self, vocab_path, n_words=None):
+        with open(vocab_path) as f:
+            vocab = json.load(f)
+        if isinstance(vocab, dict):
+            compact = CompactVocab(vocab["words"], vocab["n_buckets"])
+            self.n_words, self.word_id = compact.n_words, compact.word_id
+        else:
+            word2id = dict((word, i + 2) for i, word in enumerate(vocab))
+            self.n_words, self.word_id = len(vocab) + 2, lambda word: word2id.get(word, 1)
+        if n_words is not None and self.n_words != n_words:
+            raise ValueError("Vocab %s has %d words, the model %d (see --compact_vocab of build_index.py)." % (
+                vocab_path, self.n_words, n_words))
+
+    def encode(self, text):
+        return [self.word_id(word) for word in text.lower().split()]
+
+
+class SearchEngine:
+    def __init__(self, index_dir, corpus_block=16384, verify=True, ann_path="", nprobe=8, refine_factor=0,
+                 quantize=False, scripted=""):
+        self.embeddings, self.snippet_ids, self.manifest = load_index(index_dir)
+        self.corpus_block = corpus_block
+        self.ann = IVFPQIndex.load(ann_path) if ann_path else None
+        self.nprobe = nprobe
+        self.refine_factor = refine_factor
+
+        self.conf = get_config(None)
+        self.conf.update(self.manifest["config"])
+        self.conf['bow_dropout'] = self.conf['seqenc_dropout'] = 0.0
+        if scripted:  # TorchScript model from export_script.py, the checkpoint is not read
+            if quantize:
+                raise ValueError("A scripted model cannot be quantized.")
+            self.model, meta = load_scripted(scripted)
+            if meta["model_name"] != "qc" or meta["query_n_words"] != self.conf['qt_n_words']:
+                raise ValueError("Scripted model %s is not a QC model of the index config." % scripted)
+            if verify and meta["checkpoint_sha1"] != self.manifest["checkpoint_sha1"]:
+                raise ValueError("Scripted model %s was not exported from the checkpoint of the index." % scripted)
+        else:
+            ckpt_path = self.manifest["checkpoint"]
+            if verify and file_sha1(ckpt_path) != self.manifest["checkpoint_sha1"]:
+                raise ValueError("Checkpoint %s changed since the index was built." % ckpt_path)
+            self.model = QCModel(self.conf)
+            load_weights(self.model, ckpt_path)  # mapped, shared by the workers serving the same checkpoint
+        if quantize:  # int8 query encoder, for CPU-only boxes
+            from quantize import quantize_model  # imports the training code, only loaded when needed
+            self.model = quantize_model(self.model)
+        elif torch.cuda.is_available():
+            self.model = self.model.cuda()
+        self.model.eval()
+
+    def pad(self, queries):
+        batch = np.zeros((len(queries), self.conf['qt_len']), dtype=np.int64)
+        for i, tokens in enumerate(queries):
+            tokens = tokens[:self.conf['qt_len']]
+            batch[i, :len(tokens)] = tokens
+        batch[(batch < 0) | (batch >= self.conf['qt_n_words'])] = 1  # unknown word
+        return batch
+
+    def search(self, queries, k):
+        """
+        Top-k code snippets of a batch of tokenized queries.
+        :return: list of [(snippet_id, score), ...] per query
+        """
+        topk_scores, topk_index = self.search_rows(queries, k)
+        # approximate search pads with -1 when the probed lists hold fewer than k snippets
+        return [[(self.snippet_ids[j], float(s)) for j, s in zip(index, scores) if j >= 0]
+                for index, scores in zip(topk_index, topk_scores)]
+
+    def search_rows(self, queries, k):
+        """
+        :return: [n_query x k] numpy scores and index rows of the top-k snippets of a batch of tokenized queries
+        """
+        with torch.no_grad():
+            qts_repr = self.model.query_encoding(gVar(self.pad(queries)))
+            qts_repr = qts_repr / qts_repr.norm(dim=1)[:, None]
+            if self.ann is not None:
+                refine_repr = self.embeddings if self.refine_factor > 0 else None
+                topk_scores, topk_index = self.ann.search(qts_repr.cpu().numpy(), k, nprobe=self.nprobe,
+                                                          refine_repr=refine_repr, refine_factor=self.refine_factor)
+            else:
+                topk_scores, topk_index = corpus_search(qts_repr, self.embeddings, k, corpus_block=self.corpus_block)
+                topk_scores, topk_index = topk_scores.cpu().numpy(), topk_index.cpu().numpy()
+        return topk_scores, topk_index
+
+
+#################
+# Micro-batcher #
+#################
+class LatencyStats:
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.n_requests = 0
+        self.start_time = time.time()
+
+    def add_batch(self, latencies):
+        self.latencies.extend(latencies)
+        self.batch_sizes.append(len(latencies))
+        self.n_requests += len(latencies)
+
+    def snapshot(self):
+        uptime = time.time() - self.start_time
+        stats = {"requests": self.n_requests, "uptime_s": uptime, "throughput_qps": self.n_requests / max(uptime, 1e-9)}
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000.0
+            stats.update({"p50_ms": float(np.percentile(latencies, 50)), "p99_ms": float(np.percentile(latencies, 99)),
+                          "mean_ms": float(latencies.mean()), "mean_batch_size": float(np.mean(self.batch_sizes))})
+        return stats
+
+
+class MicroBatcher:
+    """
+    Collects concurrent queries into batches of at most max_batch queries, waiting at most max_wait seconds
+    after the first one, and runs each batch through the engine in a worker thread.
+    """
+    def __init__(self, engine, max_batch=64, max_wait=0.005):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = LatencyStats()
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, tokens, k):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tokens, k, time.time(), future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            queries = [tokens for tokens, _, _, _ in batch]
+            k = max(k for _, k, _, _ in batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self.engine.search, queries, k)
+            except Exception as e:
+                for _, _, _, future in batch:
+                    if not future.cancelled():  # its client went away
+                        future.set_exception(e)
+                continue
+
+            now = time.time()
+            self.stats.add_batch([now - arrival for _, _, arrival, _ in batch])
+            for (_, k_i, _, future), result in zip(batch, results):
+                if not future.cancelled():
+                    future.set_result(result[:k_i])
+
+
+###############
+# HTTP server #
+###############
+class SearchServer:
+    """
+    Minimal HTTP/1.1 front end:
+    POST /search {"tokens": [id, ...]} or {"query": "text"}, optional "k" -> {"results": [[snippet_id, score], ...]}
+    GET /stats -> latency percentiles and throughput
+    """
+    def __init__(self, batcher, vocab=None, max_k=100):
+        self.batcher = batcher
+        self.vocab = vocab
+        self.max_k = max_k
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode("latin-1").split()[:2]
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    await self.respond(writer, 413, {"error": "request too large"})
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, payload = await self.route(method, path, body)
+                await self.respond(writer, status, payload)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/stats":
+            return 200, self.batcher.stats.snapshot()
+        if method != "POST" or path != "/search":
+            return 404, {"error": "unknown endpoint %s %s" % (method, path)}
+
+        try:
+            request = json.loads(body.decode("utf-8"))
+            k = int(request.get("k", 10))
+            if "tokens" in request:
+                tokens = [int(token) for token in request["tokens"]]
+            elif "query" in request and self.vocab is not None:
+                tokens = self.vocab.encode(request["query"])
+            else:
+                raise ValueError("give \"tokens\"%s" % (" or \"query\"" if self.vocab is not None else ""))
+            if not 0 < k <= self.max_k:
+                raise ValueError("k must be in [1, %d]" % self.max_k)
+        except (ValueError, TypeError, AttributeError) as e:
+            return 400, {"error": "bad request: %s" % e}
+
+        try:
+            results = await self.batcher.submit(tokens, k)
+        except Exception as e:
+            return 500, {"error": "search failed: %s" % e}
+        return 200, {"results": results}
+
+    async def respond(self, writer, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+                  500: "Internal Server Error"}[status]
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" %
+                      (status, reason, len(body))).encode("latin-1") + body)
+        await writer.drain()
+
+
+async def serve(engine, host, port, max_batch, max_wait, vocab=None):
+    batcher = MicroBatcher(engine, max_batch=max_batch, max_wait=max_wait)
+    server = SearchServer(batcher, vocab=vocab)
+    worker = asyncio.ensure_future(batcher.run())
+    tcp_server = await asyncio.start_server(server.handle, host, port)
+    print("Serving %d code snippets on %s:%d (max_batch=%d, max_wait=%.1fms)" %
+          (len(engine.snippet_ids), host, port, max_batch, max_wait * 1000))
+    try:
+        await tcp_server.serve_forever()
+    finally:
+        worker.cancel()
+
+
+##################
+# Load generator #
+##################
+async def http_request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(("%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n" %
+                  (method, path, len(body))).encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        if line.lower().startswith("content-length:"):
+            length = int(line.split(":")[1])
+    return status, json.loads((await reader.readexactly(length)).decode("utf-8"))
+
+
+async def load_generator(host, port, concurrency, duration, k, qt_len, qt_n_words, seed=42):
+    """
+    Sends random token queries from `concurrency` keep-alive connections for `duration` seconds
+    and reports client-side latency and throughput next to the server's /stats.
+    """
+    latencies = []
+    deadline = time.time() + duration
+
+    async def client(client_id):
+        rng = random.Random(seed + client_id)
+        reader, writer = await asyncio.open_connection(host, port)
+        while time.time() < deadline:
+            tokens = [rng.randint(2, qt_n_words - 1) for _ in range(rng.randint(3, qt_len))]
+            start = time.time()
+            status, _ = await http_request(reader, writer, "POST", "/search", {"tokens": tokens, "k": k})
+            assert status == 200, "search failed with HTTP %d" % status
+            latencies.append(time.time() - start)
+        writer.close()
+
+    start = time.time()
+    await asyncio.gather(*[client(i) for i in range(concurrency)])
+    elapsed = time.time() - start
+
+    latencies = np.array(latencies) * 1000.0
+    print("Client: requests=%d, throughput=%.1f qps, p50=%.2fms, p99=%.2fms" %
+          (len(latencies), len(latencies) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    reader, writer = await asyncio.open_connection(host, port)
+    _, stats = await http_request(reader, writer, "GET", "/stats")
+    writer.close()
+    print("Server: %s" % json.dumps(stats, sort_keys=True))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Serve code search over a prebuilt index (see build_index.py).")
+    parser.add_argument("mode", choices=["serve", "loadgen"])
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+
+    # serve
+    parser.add_argument("--index_dir", type=str, default="", help="Index written by build_index.py.")
+    parser.add_argument("--vocab", type=str, default="",
+                        help="question_vocab.json or its .compact.json, for raw text queries next to token ids.")
+    parser.add_argument("--max_batch", type=int, default=64, help="Max number of queries encoded together.")
+    parser.add_argument("--max_wait", type=float, default=5.0, help="Max wait (ms) for a batch to fill up.")
+    parser.add_argument("--corpus_block", type=int, default=16384, help="Corpus rows scored at once.")
+    parser.add_argument("--ann_path", type=str, default="",
+                        help="IVF-PQ index from ann.py to search approximately instead of exactly.")
+    parser.add_argument("--nprobe", type=int, default=8, help="Inverted lists scanned per query with --ann_path.")
+    parser.add_argument("--refine_factor", type=int, default=0,
+                        help="With --ann_path, re-score refine_factor * k candidates with the exact embeddings.")
+    parser.add_argument("--quantize", type=int, default=0,
+                        help="Encode queries with an int8 quantized model on the CPU, if quantize>0 (see quantize.py).")
+    parser.add_argument("--scripted", type=str, default="",
+                        help="Encode queries with a TorchScript model from export_script.py instead of the checkpoint.")
+
+    # loadgen
+    parser.add_argument("--concurrency", type=int, default=32, help="Number of concurrent clients.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load.")
+    parser.add_argument("--k", type=int, default=10, help="Results per query.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.mode == "serve":
+        if args.quantize > 0:
+            utils.use_cuda = False  # the int8 kernels are CPU only
+        engine = SearchEngine(args.index_dir, corpus_block=args.corpus_block, ann_path=args.ann_path,
+                              nprobe=args.nprobe, refine_factor=args.refine_factor, quantize=args.quantize > 0,
+                              scripted=args.scripted)
+        vocab = QueryVocab(args.vocab, engine.conf['qt_n_words']) if args.vocab else None
+        asyncio.run(serve(engine, args.host, args.port, args.max_batch, args.max_wait / 1000.0, vocab=vocab))
+    else:
+        conf = get_config(args)
+        asyncio.run(load_generator(args.host, args.port, args.concurrency, args.duration, args.k,
+                                   conf['qt_len'], conf['qt_n_words']))
@@ -0,0 +1,56 @@
+from __future__ import print_function
+
+import torch.nn as nn
+from torch import optim
+
+
+def sparse_parameters(model):
+    """weights of the embeddings of a model that produce sparse gradients (config sparse_emb)"""
+    return [m.weight for m in model.modules() if isinstance(m, nn.Embedding) and m.sparse]
+
+
+def dense_parameters(model):
+    """parameters of a model but its sparse embeddings, in model.parameters() order"""
+    sparse = set(id(p) for p in sparse_parameters(model))
+    return [p for p in model.parameters() if id(p) not in sparse]
+
+
+class SparseDenseOptimizer:
+    """
+    Steps an optimizer of the dense parameters of a model together with a SparseAdam of its sparse embeddings. The
+    embedding gradients then only hold the rows of the batch, and SparseAdam only reads and updates the moments of
+    those rows, instead of the whole vocabulary every step.
+    """
+    def __init__(self, dense, sparse):
+        self.dense = dense
+        self.sparse = sparse
+        self.param_groups = dense.param_groups + sparse.param_groups
+
+    def zero_grad(self):
+        self.dense.zero_grad()
+        self.sparse.zero_grad()
+
+    def step(self):
+        self.dense.step()
+        self.sparse.step()
+
+    def state_dict(self):
+        return {"dense": self.dense.state_dict(), "sparse": self.sparse.state_dict()}
+
+    def load_state_dict(self, state):
+        self.dense.load_state_dict(state["dense"])
+        self.sparse.load_state_dict(state["sparse"])
+
+
+def with_sparse_adam(optimizer, model):
+    """
+    Adds a SparseAdam, at the learning rate of optimizer, for the sparse embeddings of model.
+    :param optimizer: optimizer of dense_parameters(model), or {key: optimizer} of a dict of models (None allowed)
+    :return: SparseDenseOptimizer, or optimizer itself if model has no sparse embeddings
+    """
+    if isinstance(optimizer, dict):
+        return dict((k, with_sparse_adam(v, model[k]) if v is not None else None) for k, v in optimizer.items())
+    params = sparse_parameters(model)
+    if not params:
+        return optimizer
+    return SparseDenseOptimizer(optimizer, optim.SparseAdam(params, lr=optimizer.param_groups[0]['lr']))
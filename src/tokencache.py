@@ -0,0 +1,230 @@
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import argparse
+
+import numpy as np
+import torch
+
+from configs import get_config
+from utils import gVar
+
+STATES_FILE = "states.npy"
+OFFSETS_FILE = "offsets.npy"
+TOKENS_FILE = "tokens.npy"
+TOKEN_OFFSETS_FILE = "token_offsets.npy"
+ID_MAP_FILE = "ids.json"
+MANIFEST_FILE = "manifest.json"
+
+
+def build_token_cache(searcher, model, datasets, cache_dir, ckpt_path, batch_size=256):
+    """
+    Encodes the code corpus of some datasets once with the candidate encoder of an attention model
+    (models_w_attn.py) and writes the per-token states to cache_dir:
+    states.npy: [n_token x dim] float16 states of every snippet, trimmed to its length, snippet after snippet;
+    offsets.npy: [n_snippet + 1] int64, the states of snippet i are states[offsets[i]:offsets[i+1]];
+    tokens.npy, token_offsets.npy: the token ids of every snippet (trailing padding trimmed), the same way, to find
+    the cached snippet of a candidate;
+    ids.json: snippet id -> row; manifest.json: checkpoint hash and model config the states were computed with.
+    The cache is written next to cache_dir and renamed into place, so that readers never see a partial one.
+    """
+    from build_index import file_sha1
+    from codesearcher import create_model_name_string
+    if not searcher.conf['seqenc_packed']:
+        # without masking the attention also reads the states of padding, which trimming would drop
+        raise ValueError("The token state cache needs a length-aware model (seqenc_packed).")
+
+    tmp_dir = "%s.tmp%d" % (cache_dir.rstrip("/"), os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    snippets, snippet_ids, _ = searcher.collect_code_corpus(datasets, batch_size=batch_size)
+    lengths = snippets.ne(0).sum(1).clamp(min=1).numpy()  # the steps the length-aware encoder runs
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    dim = 2 * searcher.conf['lstm_dims']
+    print("Encoding %d distinct code snippets, %d tokens..." % (len(snippet_ids), offsets[-1]))
+
+    states = np.lib.format.open_memmap(os.path.join(tmp_dir, STATES_FILE), mode="w+", dtype=np.float16,
+                                       shape=(int(offsets[-1]), dim))
+    model = model.eval()
+    with torch.no_grad():
+        for start in range(0, len(snippet_ids), batch_size):
+            cands_repr = model.cand_encoding(gVar(snippets[start: start + batch_size])).cpu().numpy()
+            for i, cand_repr in enumerate(cands_repr):
+                row = start + i
+                states[offsets[row]: offsets[row + 1]] = cand_repr[:lengths[row]]
+    states.flush()
+    del states
+
+    tokens = [np.trim_zeros(snippet.numpy(), 'b').astype(np.int32) for snippet in snippets]
+    np.save(os.path.join(tmp_dir, OFFSETS_FILE), offsets)
+    np.save(os.path.join(tmp_dir, TOKENS_FILE), np.concatenate(tokens))
+    np.save(os.path.join(tmp_dir, TOKEN_OFFSETS_FILE), np.concatenate([[0], np.cumsum([len(t) for t in tokens])]))
+    with open(os.path.join(tmp_dir, ID_MAP_FILE), "w") as f:
+        json.dump(dict((snippet_id, row) for row, snippet_id in enumerate(snippet_ids)), f)
+
+    manifest = {
+        "checkpoint": os.path.abspath(ckpt_path),
+        "checkpoint_sha1": file_sha1(ckpt_path),
+        "model_string": create_model_name_string(searcher.conf),
+        "config": dict((key, searcher.conf[key]) for key in
+                       ["qt_len", "code_len", "qt_n_words", "code_n_words", "emb_size", "lstm_dims",
+                        "code_encoder", "seqenc_packed", "lang"]),
+        "datasets": [dataset.data_name for dataset in datasets],
+        "size": len(snippet_ids),
+        "n_tokens": int(offsets[-1]),
+        "dim": dim,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+    print("Token state cache saved to %s" % cache_dir)
+    return manifest
+
+
+class TokenStateCache:
+    """
+    Read-only view of a cache written by build_token_cache. The arrays are memory-mapped, so processes share them
+    and a lookup only reads the states of the snippets asked for.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self._arrays = {}
+        self._row_of = None
+
+    def __getstate__(self):  # pickled without its memory maps, which are reopened on use
+        state = dict(self.__dict__)
+        state["_arrays"], state["_row_of"] = {}, None
+        return state
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.cache_dir, name), mmap_mode="r")
+        return self._arrays[name]
+
+    def __len__(self):
+        return self.manifest["size"]
+
+    def lengths(self, rows):
+        offsets = self._array(OFFSETS_FILE)
+        rows = np.asarray(rows)
+        return offsets[rows + 1] - offsets[rows]
+
+    def states(self, rows):
+        """
+        :param rows: snippet rows
+        :return: [n x max length x dim] float32 states, zero past the length of each snippet like the output of a
+                 length-aware SeqEncoder
+        """
+        states, offsets = self._array(STATES_FILE), self._array(OFFSETS_FILE)
+        lengths = self.lengths(rows)
+        out = np.zeros((len(rows), max(lengths.max(), 1) if len(rows) else 1, states.shape[1]), dtype=np.float32)
+        for i, row in enumerate(rows):
+            out[i, :lengths[i]] = states[offsets[row]: offsets[row + 1]]
+        return gVar(out)
+
+    def rows_of(self, cands):
+        """cached rows of [n x code_len] candidate token ids, -1 for candidates not in the cache"""
+        if self._row_of is None:
+            tokens, offsets = self._array(TOKENS_FILE), self._array(TOKEN_OFFSETS_FILE)
+            self._row_of = dict((tokens[offsets[row]: offsets[row + 1]].tobytes(), row) for row in range(len(self)))
+        return np.array([self._row_of.get(np.trim_zeros(cand, 'b').astype(np.int32).tobytes(), -1)
+                         for cand in cands.numpy()], dtype=np.int64)
+
+    def cand_encoding(self, model, cands):
+        """
+        Stand-in for model.cand_encoding(gVar(cands)): the states of cached candidates are read from the cache,
+        the others are encoded.
+        """
+        rows = self.rows_of(cands)
+        hit = np.nonzero(rows >= 0)[0]
+        miss = np.nonzero(rows < 0)[0]
+        if len(miss) == 0:
+            return self.states(rows)
+        missed = model.cand_encoding(gVar(cands[torch.from_numpy(miss)]))
+        if len(hit) == 0:
+            return missed
+        cached = self.states(rows[hit])
+        out = missed.new_zeros((len(rows), max(missed.size(1), cached.size(1)), missed.size(2)))
+        out[gVar(torch.from_numpy(hit)), :cached.size(1)] = cached
+        out[gVar(torch.from_numpy(miss)), :missed.size(1)] = missed
+        return out
+
+
+def open_token_cache(cache_dir, ckpt_path):
+    """opens a token state cache, checking that it was built from the given checkpoint"""
+    from build_index import file_sha1
+    cache = TokenStateCache(cache_dir)
+    if file_sha1(ckpt_path) != cache.manifest["checkpoint_sha1"]:
+        raise ValueError("Token state cache %s was not built from %s." % (cache_dir, ckpt_path))
+    return cache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Cache the per-token code states of a trained attention QC model.")
+    parser.add_argument("--reload_path", type=str, required=True,
+                        help="Enclosing folder of the QC model, e.g. ../checkpoint_qcwqq/QC.")
+    parser.add_argument("--cache_dir", type=str, default="",
+                        help="Where to write the cache (default: <model directory>/token_cache).")
+    parser.add_argument("--splits", type=str, default="train,dev,test", help="Data splits making up the corpus.")
+    parser.add_argument("--encode_batch_size", type=int, default=256, help="Snippets encoded at once.")
+
+    # model setup, to find the model directory as codesearcher.py names it
+    parser.add_argument("--dropout", type=float, default=0.0, help="What is the dropout?", required=True)
+    parser.add_argument("--emb_size", type=int, default=100, help="What is the embedding size?", required=True)
+    parser.add_argument("--lstm_dims", type=int, default=200, help="What is the lstm dimension?", required=True)
+    parser.add_argument("--seqenc_packed", type=int, default=1,
+                        help="Run the sequence encoders on packed sequences, skipping padding, if seqenc_packed>0.")
+    parser.add_argument("--compact_vocab", type=int, default=0,
+                        help="Size the vocabularies from the compacted ones of compact_vocab.py, if compact_vocab>0: "
+                             "for its remapped checkpoints, on compacted inputs (not data.py batches).")
+    parser.add_argument("--batch_size", type=int, default=32, help="What is the batch size?", required=True)
+    parser.add_argument("--lr", type=float, default=0.001, help="What is the learning rate?")
+    parser.add_argument("--optimizer", type=str,
+                        choices=["adam", "adagrad", "sgd", "rmsprop", "asgd", "adadelta"],
+                        default="adam", help="Which optimizer to use?")
+    parser.add_argument("--lang", type=str, default="SQL", help="Which language dataset to use.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from data import load_qc_data
+    from models_w_attn import QCModel
+    from codesearcher import CodeSearcher, create_model_name_string
+
+    args = parse_args()
+    conf = get_config(args)
+
+    conf['model'] = "qc"
+    conf['bow_dropout'] = args.dropout
+    conf['seqenc_dropout'] = args.dropout
+    conf['seqenc_packed'] = args.seqenc_packed > 0
+    conf['emb_size'] = args.emb_size
+    conf['lstm_dims'] = args.lstm_dims
+    conf['batch_size'] = args.batch_size
+    conf['lr'] = args.lr
+    conf['optimizer'] = args.optimizer
+    conf['lang'] = args.lang
+
+    conf['model_directory'] = os.path.join(args.reload_path, create_model_name_string(conf))
+    cache_dir = args.cache_dir or os.path.join(conf['model_directory'], "token_cache")
+    print(" Model Directory : ")
+    print(conf['model_directory'])
+
+    searcher = CodeSearcher(conf)
+    model = QCModel(conf)
+    searcher.load_model(model)
+    if torch.cuda.is_available():
+        model = model.cuda()
+
+    data = load_qc_data(test=True, lang=args.lang)
+    build_token_cache(searcher, model, [data[split] for split in args.splits.split(",")], cache_dir,
+                      os.path.join(conf['model_directory'], 'best_model.ckpt'), batch_size=args.encode_batch_size)
@@ -24,6 +24,49 @@ def dot_np(data1, data2):
     return np.dot(data1, np.transpose(data2))
 
 
+def drop_diagonal(matrix):
+    """drop entry [i, i] from every row i of a [n x m] matrix (n <= m), keeping the other columns in order"""
+    n, m = matrix.shape
+    keep = np.arange(m)[None, :] != np.arange(n)[:, None]
+    return matrix[keep].reshape(n, m - 1)
+
+
+def stack_rows(rows):
+    """stack score vectors of different lengths into a [n_rows x max_len] matrix padded with -inf
+       return: scores and the valid mask
+    """
+    lengths = np.array([len(row) for row in rows])
+    valid = np.arange(lengths.max())[None, :] < lengths[:, None]
+    scores = np.full(valid.shape, -np.inf)
+    scores[valid] = np.concatenate(rows)
+    return scores, valid
+
+
+def pool_score_matrix(pos_scores, pos_number, neg_scores):
+    """lay out the scores of a candidate pool as one padded matrix
+       pos_scores: flat array with the scores of the positives of every query, query after query
+       pos_number: number of positives of each query
+       neg_scores: [n_query x n_neg] scores of the negatives of each query
+       return: scores [n_query x (max_pos + n_neg)], where row i holds the positives of query i followed by
+               its negatives; a valid mask and a positive mask of the same shape
+    """
+    n_query, n_neg = neg_scores.shape
+    pos_number = np.asarray(pos_number, dtype=np.int64)
+    max_pos = int(pos_number.max()) if n_query > 0 else 0
+
+    rows = np.repeat(np.arange(n_query), pos_number)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(pos_number) - pos_number, pos_number)
+    pos_block = np.full((n_query, max_pos), -np.inf, dtype=neg_scores.dtype)
+    pos_block[rows, cols] = pos_scores
+    pos_mask = np.zeros((n_query, max_pos + n_neg), dtype=bool)
+    pos_mask[rows, cols] = True
+
+    scores = np.concatenate([pos_block, neg_scores], axis=1)
+    valid = pos_mask.copy()
+    valid[:, max_pos:] = True
+    return scores, valid, pos_mask
+
+
 #######################################################################
 
 def asMinutes(s):
@@ -65,6 +108,70 @@ def gVar(data):
     return tensor
 
 
+def score_pool(model, qts_repr, cands_repr, all_pos_repr, all_pos_number):
+    """score a whole evaluation pool at once
+       Query i is ranked against its own positives followed by the candidates of every other query in the pool.
+       qts_repr: encoded queries
+       cands_repr: encoded candidates, one per query in the batch
+       all_pos_repr: encoded positives of all queries, stacked query after query
+       all_pos_number: number of positives of each query
+       return: scores, valid mask and positive mask, [n_query x (max_pos + n_cand - 1)] numpy arrays
+    """
+    owner = gVar(torch.from_numpy(np.repeat(np.arange(len(all_pos_number)), all_pos_number)))
+    pos_scores = model.scoring(qts_repr.index_select(0, owner), all_pos_repr).data.cpu().numpy()
+    cand_scores = model.pairwise_scoring(qts_repr, cands_repr).data.cpu().numpy()
+    return pool_score_matrix(pos_scores, all_pos_number, drop_diagonal(cand_scores))
+
+
+def corpus_search(qts_repr, corpus_repr, k, pos_scores=None, query_block=256, corpus_block=16384):
+    """exact top-k search of queries in a corpus, scanning it block by block so that the
+       [n_query x n_corpus] score matrix is never built
+       qts_repr: [n_query x dim] tensor of normalized queries
+       corpus_repr: [n_corpus x dim] normalized corpus, a tensor or a (memory-mapped) numpy array
+       k: number of results to keep per query
+       pos_scores: optional [n_query x max_pos] scores of the positives of each query, padded with -inf
+       return: top-k scores and corpus rows [n_query x k]; with pos_scores, also the number of corpus entries
+               scoring higher than each positive [n_query x max_pos]
+    """
+    n_query, n_corpus = qts_repr.size(0), len(corpus_repr)
+    k = min(k, n_corpus)
+    topk_scores = qts_repr.new_empty((n_query, k))
+    topk_index = torch.empty((n_query, k), dtype=torch.long, device=qts_repr.device)
+    beaten = None
+    if pos_scores is not None:
+        beaten = torch.zeros(pos_scores.size(), dtype=torch.long, device=qts_repr.device)
+
+    for q_start in range(0, n_query, query_block):
+        q_block = qts_repr[q_start: q_start + query_block]
+        best_scores, best_index = None, None
+        for c_start in range(0, n_corpus, corpus_block):
+            c_block = corpus_repr[c_start: c_start + corpus_block]
+            if isinstance(c_block, np.ndarray):
+                c_block = torch.from_numpy(np.array(c_block)).to(q_block.device)  # copy: memmaps are read-only
+            block_scores = torch.mm(q_block, c_block.to(q_block.dtype).t())
+
+            if beaten is not None:
+                q_pos = pos_scores[q_start: q_start + query_block]
+                beaten[q_start: q_start + query_block] += \
+                    (block_scores.unsqueeze(1) > q_pos.unsqueeze(2)).sum(2).long()
+
+            block_best, block_index = block_scores.topk(min(k, block_scores.size(1)), dim=1)
+            block_index += c_start
+            if best_scores is not None:
+                block_best = torch.cat([best_scores, block_best], 1)
+                block_index = torch.cat([best_index, block_index], 1)
+                block_best, order = block_best.topk(min(k, block_best.size(1)), dim=1)
+                block_index = block_index.gather(1, order)
+            best_scores, best_index = block_best, block_index
+
+        topk_scores[q_start: q_start + query_block] = best_scores
+        topk_index[q_start: q_start + query_block] = best_index
+
+    if beaten is not None:
+        return topk_scores, topk_index, beaten
+    return topk_scores, topk_index
+
+
 ########################
 # Metric Calculations ##
 ########################
@@ -135,9 +242,80 @@ def NDCG(real, predict):
 
 
 def IDCG(n):
-    idcg = 0
-    itemRelevance = 1
-    for i in range(n):
-        # idcg += (math.pow(2, itemRelevance) - 1.0) * (math.log(2) / math.log(i + 2))
-        idcg += (math.pow(2, itemRelevance) - 1.0) / math.log(i + 2, 2)
-    return idcg
\ No newline at end of file
+    return float(IDCG_table(n)[n])
+
+
+_IDCG_TABLE = np.zeros(1)
+
+
+def IDCG_table(n):
+    """IDCG of 0..n relevant items (binary relevance), grown on demand and shared by all NDCG calls"""
+    global _IDCG_TABLE
+    if n >= len(_IDCG_TABLE):
+        size = max(n + 1, 2 * len(_IDCG_TABLE))
+        _IDCG_TABLE = np.concatenate([[0.0], np.cumsum(1.0 / (np.log(np.arange(2, size + 1)) / math.log(2)))])
+    return _IDCG_TABLE
+
+
+##########################################
+# Metric Calculations on a score matrix ##
+##########################################
+
+def positive_ranks(scores, pos_mask, valid=None):
+    """rank the positives of every query without sorting the candidates
+       scores: [n_query x n_cand] score matrix
+       pos_mask: [n_query x n_cand] boolean positive mask, or the number of positives of each query when the
+                 positives occupy the first columns
+       valid: [n_query x n_cand] mask of the candidates that take part in the ranking (default: all)
+       return: [n_query x max_pos] 0-based ranks of the positives of each query, ascending, padded with np.inf.
+               The rank of a positive is the number of valid candidates scoring higher; ties go to the earlier
+               column, as with a stable argsort.
+    """
+    n_query, n_cand = scores.shape
+    pos_mask = np.asarray(pos_mask)
+    if pos_mask.ndim == 1:
+        pos_mask = np.arange(n_cand)[None, :] < pos_mask[:, None]
+    if valid is None:
+        valid = np.ones(scores.shape, dtype=bool)
+
+    pos_rows, pos_cols = np.nonzero(pos_mask)
+    pos_scores = scores[pos_rows, pos_cols][:, None]
+    row_scores = scores[pos_rows]
+    cols = np.arange(n_cand)[None, :]
+    beaten = (row_scores > pos_scores) | ((row_scores == pos_scores) & (cols < pos_cols[:, None]))
+    pos_rank = (beaten & valid[pos_rows]).sum(1)
+
+    pos_number = pos_mask.sum(1)
+    ranks = np.full((n_query, max(int(pos_number.max()) if n_query > 0 else 0, 1)), np.inf)
+    ranks[pos_rows, np.arange(len(pos_rows)) - np.repeat(np.cumsum(pos_number) - pos_number, pos_number)] = pos_rank
+    return np.sort(ranks, axis=1)
+
+
+def ACC_array(ranks, k=None):
+    """fraction of the positives of each query ranked at all (k=None), or within the top k"""
+    found = np.isfinite(ranks)
+    hit = found if k is None else ranks < k
+    return hit.sum(1) / found.sum(1).astype(float)
+
+
+def MRR_array(ranks):
+    return 1.0 / (1.0 + ranks[:, 0])
+
+
+def MAP_array(ranks):
+    found = np.isfinite(ranks)
+    precision = np.where(found, np.cumsum(found, axis=1) / (1.0 + ranks), 0.0)
+    return precision.sum(1) / found.sum(1)
+
+
+def NDCG_array(ranks):
+    found = np.isfinite(ranks)
+    pos_number = found.sum(1)
+    dcg = np.where(found, 1.0 / (np.log(ranks + 2) / math.log(2)), 0.0).sum(1)
+    return dcg / IDCG_table(int(pos_number.max()))[pos_number]
+
+
+def ranking_metrics(scores, pos_mask, valid=None):
+    """array counterpart of ACC, MRR, MAP and NDCG: one value per row of a score matrix"""
+    ranks = positive_ranks(scores, pos_mask, valid)
+    return ACC_array(ranks), MRR_array(ranks), MAP_array(ranks), NDCG_array(ranks)